@@ -1,507 +1,629 @@
-import json, os, platform, sys, io
+'''
+Runs the RANSAC plane segmenter: a Tk GUI (the default, see runner_gui.py),
+headless batch and watch-folder modes, parameter sweeps, and a library
+interface for other Python code:
+
+    import Ransac_runner
+    job = Ransac_runner.segment("tile.las", "tile_ransac.las", backend="python", threshold=0.1)
+    print(job.returncode, job.metrics["wall"])
+
+Every segmenter parameter is described once, in PARAMETERS; the GUI's
+widgets and the command line options are generated from it. Tk, argparse
+and the thread pool are only imported by the modes that use them, so that
+importing this module stays cheap for short-lived workers (benchmark.py
+--importOnly checks it).
+'''
+import json, os, sys, threading, time
 from os import path
-from pathlib import Path
-from sys import platform as _platform
-import tkinter as tk
-from tkinter import ttk
-from tkinter.scrolledtext import ScrolledText
-from tkinter import filedialog
-from tkinter import messagebox
-from tkinter import PhotoImage
 from subprocess import CalledProcessError, Popen, PIPE, STDOUT
 
-class FileSelector(tk.Frame):
-    def __init__(self, json_str, runner, master=None, tooltip_label=None):
-        self.tooltip_label = tooltip_label
-
-        # first make sure that the json data has the correct fields
-        j = json.loads(json_str)
-        self.name = j['name']
-        self.description = j['description']
-        self.flag = j['flags'][len(j['flags']) - 1]
-        self.parameter_type = j['parameter_type']
-        self.file_type = ""
-        if "ExistingFile" in self.parameter_type:
-            self.file_type = j['parameter_type']['ExistingFile']
-        elif "NewFile" in self.parameter_type:
-            self.file_type = j['parameter_type']['NewFile']
-        self.optional = j['optional']
-        default_value = j['default_value']
-
-        self.runner = runner
-
-        ttk.Frame.__init__(self, master, padding='0.02i')
-        self.grid()
-
-        self.bind("<Enter>", self.onEnter)
-        self.bind("<Leave>", self.onLeave)
-
-        self.label = ttk.Label(self, text=self.name, justify=tk.LEFT)
-        self.label.grid(row=0, column=0, sticky=tk.W)
-        self.label.columnconfigure(0, weight=1)
-
-        if not self.optional:
-            self.label['text'] = self.label['text'] + "*"
-
-        fs_frame = ttk.Frame(self, padding='0.0i')
-        self.value = tk.StringVar()
-        self.entry = ttk.Entry(
-            fs_frame, width=45, justify=tk.LEFT, textvariable=self.value)
-        self.entry.grid(row=0, column=0, sticky=tk.NSEW)
-        self.entry.columnconfigure(0, weight=1)
-        if default_value:
-            self.value.set(default_value)
-
-        # self.open_button = ttk.Button(fs_frame, width=4, image = self.open_file_icon, command=self.select_file, padding = '0.02i')
-        self.open_button = ttk.Button(fs_frame, width=4, text="...", command=self.select_file, padding = '0.02i')
-        self.open_button.grid(row=0, column=1, sticky=tk.E)
-        self.open_button.columnconfigure(0, weight=1)
-
-        fs_frame.grid(row=1, column=0, sticky=tk.NSEW)
-        fs_frame.columnconfigure(0, weight=10)
-        fs_frame.columnconfigure(1, weight=1)
-        # self.pack(fill=tk.BOTH, expand=1)
-        self.columnconfigure(0, weight=1)
-        self.rowconfigure(0, weight=1)
-        self.rowconfigure(1, weight=1)
-
-        # Add the bindings
-        if _platform == "darwin":
-            self.entry.bind("<Command-Key-a>", self.select_all)
-        else:
-            self.entry.bind("<Control-Key-a>", self.select_all)
-        
-    def onEnter(self, event=None):
-        self.tooltip_label.configure(text=self.description)
-        # self.update()  # this is needed for cancelling and updating the progress bar
-
-    def onLeave(self, event=None):
-        self.tooltip_label.configure(text="")
-        # self.update()  # this is needed for cancelling and updating the progress bar
-
-    def select_file(self):
-        try:
-            result = self.value.get()
-            if self.parameter_type == "Directory":
-                result = filedialog.askdirectory()
-                
-            elif "ExistingFile" in self.parameter_type:
-                ftypes = [('All files', '*.*')]
-                if 'Lidar' in self.file_type:
-                    ftypes = [("LiDAR files", ('*.las', '*.zip'))]
-
-                result = filedialog.askopenfilename(initialdir=self.runner.working_dir, title="Select file", filetypes=ftypes)
-                
-            elif "NewFile" in self.parameter_type:
-                result = filedialog.asksaveasfilename()
-                
-            self.value.set(result)
-            # update the working directory
-            self.runner.working_dir = os.path.dirname(result)
-            # print(self.runner.working_dir)
-
-        except:
-            t = "file"
-            if self.parameter_type == "Directory":
-                t = "directory"
-            messagebox.showinfo("Warning", "Could not find {}".format(t))
-
-    def get_value(self):
-        if self.value.get():
-            v = self.value.get()
-            # Do some quality assurance here.
-            # Is there a directory included?
-            if not path.dirname(v):
-                v = path.join(self.runner.working_dir, v)
-
-            # What about a file extension?
-            ext = os.path.splitext(v)[-1].lower().strip()
-            if not ext:
-                ext = ""
-                if 'Lidar' in self.file_type:
-                    ext = '.las'
-                v += ext
-            v = path.normpath(v)
-
-            return "{}='{}'".format(self.flag, v)
-        else:
-            t = "file"
-            if self.parameter_type == "Directory":
-                t = "directory"
-            if not self.optional:
-                messagebox.showinfo(
-                    "Error", "Unspecified {} parameter {}.".format(t, self.flag))
+import progress
+
+# Every parameter of a segmenter job, in the order the GUI lists them. Keys:
+#   flag         segmenter command line flag and keyword of segment()
+#   type, default
+#   label        GUI label
+#   description  GUI tooltip and --help text
+#   file         "input" or "output" for the files of a job, which are not
+#                job parameters
+#   python       understood by the python backend only; passed on when it
+#                differs from the default
+#   engine_flag  the segmenter's flag, where it differs from flag
+#   choices      allowed values
+#   gui          shown in the GUI (python options with the python backend
+#                only), with gui_default as its initial value if given
+#   optional     may be left empty in the GUI
+PARAMETERS = [
+    {"flag": "lidarFile", "type": str, "default": "", "file": "input", "gui": True,
+     "label": "Input File (*.las)", "description": "Name of the input points .las file."},
+    {"flag": "outputFile", "type": str, "default": "", "file": "output", "gui": True,
+     "label": "Output File", "description": "Name of the output points .las file."},
+    {"flag": "searchDist", "type": float, "default": 1.5, "gui": True,
+     "label": "Search Distance (m)", "description": "Point neighbourhood Search Distance."},
+    {"flag": "iterations", "type": int, "default": 50, "gui": True,
+     "label": "Number of Iterations", "description": "How many times would you like to iterate."},
+    {"flag": "threshold", "type": float, "default": 0.15, "gui": True,
+     "label": "Residual Threshold Value", "description": "Minimum Threshold."},
+    {"flag": "maxSlope", "type": float, "default": 75.0, "gui": True,
+     "label": "Max Plane Slope (Degrees)", "description": "Maximum Slope of Plane (Displayed in Degrees)."},
+    {"flag": "numSamples", "type": int, "default": 5, "gui": True,
+     "label": "Number of Samples (Per Neighbourhood)", "description": "Number of Samples."},
+    {"flag": "acceptableModelSize", "type": int, "default": 10, "gui": True,
+     "label": "Desired Model Size (Num Points)", "description": "Minimum number of points in the model."},
+    {"flag": "tileSize", "type": float, "default": 0.0, "python": True, "label": "Tile Size (m)",
+     "description": "Process the file in square XY tiles of this size to bound memory (0: whole file at once)."},
+    {"flag": "cacheDir", "type": str, "default": "", "python": True, "label": "Neighbourhood Cache",
+     "description": "Directory for cached neighbourhood indexes (default: no caching)."},
+    {"flag": "cacheSize", "type": float, "default": 20.0, "python": True, "label": "Cache Size (GB)",
+     "description": "Size limit of the neighbourhood cache directory in GB."},
+    {"flag": "confidence", "type": float, "default": 0.0, "python": True, "label": "Confidence",
+     "description": "Stop a neighbourhood's search once an all-inlier sample has been drawn with this "
+                    "probability (0: always run all iterations)."},
+    {"flag": "sampling", "type": str, "default": "uniform", "python": True, "choices": ("uniform", "prosac"),
+     "label": "Sampling", "description": "prosac samples the nearest neighbours first."},
+    {"flag": "scoring", "type": str, "default": "rmse", "python": True, "choices": ("rmse", "msac"),
+     "label": "Scoring", "description": "msac ranks models by truncated quadratic loss rather than by the RMSE "
+                                        "of their refit."},
+    {"flag": "search", "type": str, "default": "exhaustive", "python": True, "choices": ("exhaustive", "seeded"),
+     "label": "Search", "description": "seeded first tries planes accepted at nearby points."},
+    {"flag": "prescreen", "type": str, "default": "off", "python": True, "choices": ("off", "on"),
+     "label": "Pre-screen", "description": "on settles clearly planar and clearly scattered or linear "
+                                           "neighbourhoods from their covariance alone."},
+    {"flag": "minPlanarity", "type": float, "default": 0.5, "python": True, "label": "Min Planarity",
+     "description": "Pre-screen: neighbourhoods at least this planar (and within maxSlope) are labelled planar."},
+    {"flag": "maxScattering", "type": float, "default": 0.3, "python": True, "label": "Max Scattering",
+     "description": "Pre-screen: neighbourhoods at least this scattered are rejected."},
+    {"flag": "maxLinearity", "type": float, "default": 0.95, "python": True, "label": "Max Linearity",
+     "description": "Pre-screen: neighbourhoods at least this linear are rejected."},
+    {"flag": "voxelSize", "type": float, "default": 0.0, "python": True, "label": "Voxel Size (m)",
+     "description": "Search planes on neighbourhoods reduced to cubes of this size, and label at full "
+                    "resolution (0: off)."},
+    # -j/--workers of batch and serve is the number of tiles processed at
+    # once, so the engine's --workers goes by another name.
+    {"flag": "engineWorkers", "type": int, "default": 1, "python": True, "engine_flag": "workers", "gui": True,
+     "gui_default": 0, "optional": True, "label": "Worker Processes",
+     "description": "Processes running RANSAC (0: one per physical core)."},
+    {"flag": "instrumentEvery", "type": int, "default": 0, "python": True, "label": "Instrument Every",
+     "description": "Write per-neighbourhood instrumentation next to the output, keeping the records of every "
+                    "Nth point (0: off)."},
+    {"flag": "profileInterval", "type": float, "default": 0.0, "python": True, "label": "Profile Interval (ms)",
+     "description": "With instrumentEvery, also sample the call stack every this many milliseconds (0: off)."},
+]
+
+# The job parameters of both backends and those of the python backend only,
+# as (flag, type, default), and the options whose segmenter flag has another
+# name.
+SEGMENTER_PARAMETERS = [(p["flag"], p["type"], p["default"]) for p in PARAMETERS
+                        if "file" not in p and not p.get("python")]
+PYTHON_ENGINE_OPTIONS = [(p["flag"], p["type"], p["default"]) for p in PARAMETERS if p.get("python")]
+ENGINE_FLAGS = dict((p["flag"], p["engine_flag"]) for p in PARAMETERS if "engine_flag" in p)
+
+def engine_flag(spec):
+    ''' The segmenter's flag for a PARAMETERS entry.
+    '''
+    return spec.get("engine_flag", spec["flag"])
+
+def gui_parameters(backend="binary"):
+    ''' The PARAMETERS entries the GUI shows for a backend, in order.
+    '''
+    return [p for p in PARAMETERS if p.get("gui") and (backend == "python" or not p.get("python"))]
+
+def resolve_parameters(params, backend="binary"):
+    ''' Checks job parameters (a dict by flag) against PARAMETERS, converts
+    them to their types and fills in defaults. Raises ValueError for unknown
+    names, values outside their choices and python-only options set for the
+    binary backend.
+    '''
+    specs = dict((p["flag"], p) for p in PARAMETERS if "file" not in p)
+    unknown = set(params) - set(specs)
+    if unknown:
+        raise ValueError("Unknown parameter(s): {}".format(", ".join(sorted(unknown))))
+    resolved = dict((flag, spec["default"]) for flag, spec in specs.items())
+    for flag, value in params.items():
+        spec = specs[flag]
+        resolved[flag] = spec["type"](value)
+        if "choices" in spec and resolved[flag] not in spec["choices"]:
+            raise ValueError("{} must be one of {}, got '{}'.".format(flag, ", ".join(spec["choices"]), value))
+    if backend != "python":
+        python_only = [flag for flag, spec in specs.items() if spec.get("python") and resolved[flag] != spec["default"]]
+        if python_only:
+            raise ValueError("Options {} need --backend python.".format(", ".join("--" + f for f in python_only)))
+    return resolved
+
+def format_progress(event):
+    ''' Progress bar label for a structured progress event.
+    '''
+    text = "{}:".format(event["label"])
+    if event.get("rate"):
+        text += " {:,.0f} pts/s".format(event["rate"])
+    if event.get("eta") is not None:
+        text += ", ETA {}:{:02d}".format(int(event["eta"]) // 60, int(event["eta"]) % 60)
+    return text
+
+def format_metrics(metrics):
+    ''' One-line stage timing summary of a run's metrics.
+    '''
+    parts = []
+    for stage in progress.STAGES:
+        timing = metrics.get("stages", {}).get(stage)
+        if timing:
+            parts.append("{} {:.1f} s".format(stage, timing["wall"]))
+    text = "Stage times: " + ", ".join(parts) if parts else "Wall time {:.1f} s".format(metrics.get("wall", 0.0))
+    if metrics.get("points_per_second"):
+        text += " ({:,.0f} pts/s)".format(metrics["points_per_second"])
+    iterations = metrics.get("iterations")
+    if iterations and iterations.get("neighbourhoods"):
+        text += ", {:.1f} of {} iterations per neighbourhood".format(iterations["mean"], iterations["budget"])
+    return text
+
+# "binary" runs the compiled Ransac_seg tool, "python" the NumPy
+# implementation in ransac_engine.py. Both take the same command line.
+BACKENDS = ("binary", "python")
+
+# Segmenter flags that do not change the output, left out of result cache
+# keys.
+OUTPUT_NEUTRAL_FLAGS = ("wd", "lidarFile", "outputFile", "metricsFile", "progress", "iterationLog",
+                        "cacheDir", "cacheSize", "engineWorkers")
+
+# Modules whose code determines the python backend's output; their digest
+# is its engine version in result cache keys.
+PYTHON_ENGINE_MODULES = ("ransac_engine.py", "las_io.py", "tiling.py", "parallel.py", "cache.py")
+
+def segmenter_exe():
+    ''' Path of the compiled Ransac_seg executable next to this script.
+    '''
+    ext = '.exe' if os.name == 'nt' else ''
+    return path.join(path.dirname(path.abspath(__file__)), "Ransac_seg{}".format(ext))
+
+def segmenter_command(backend="binary", exe=None):
+    ''' The program part of a segmenter command line for the given backend.
+    '''
+    if backend == "python":
+        return [sys.executable, path.join(path.dirname(path.abspath(__file__)), "ransac_engine.py")]
+    return [exe or segmenter_exe()]
+
+def parse_flag(arg):
+    ''' (name, value) of a "--name=value" argument with the quotes around
+    the value removed, or None for anything else.
+    '''
+    if not arg.startswith("--") or "=" not in arg:
         return None
-
-    def select_all(self, event):
-        self.entry.select_range(0, tk.END)
-        return 'break'
-
-class DataInput(tk.Frame):
-    def __init__(self, json_str, master=None, tooltip_label=None):
-        self.tooltip_label = tooltip_label
-
-        # first make sure that the json data has the correct fields
-        j = json.loads(json_str)
-        self.name = j['name']
-        self.description = j['description']
-        self.flag = j['flags'][len(j['flags']) - 1]
-        self.parameter_type = j['parameter_type']
-        self.optional = j['optional']
-        default_value = j['default_value']
-
-        ttk.Frame.__init__(self, master)
-        self.grid()
-        self['padding'] = '0.1i'
-
-        self.bind("<Enter>", self.onEnter)
-        self.bind("<Leave>", self.onLeave)
-
-        self.label = ttk.Label(self, text=self.name, justify=tk.LEFT)
-        self.label.grid(row=0, column=0, sticky=tk.W)
-        self.label.columnconfigure(0, weight=1)
-
-        self.value = tk.StringVar()
-        if default_value:
-            self.value.set(default_value)
-        else:
-            self.value.set("")
-
-        self.entry = ttk.Entry(self, justify=tk.LEFT, textvariable=self.value)
-        self.entry.grid(row=0, column=1, sticky=tk.NSEW)
-        self.entry.columnconfigure(1, weight=10)
-
-        if not self.optional:
-            self.label['text'] = self.label['text'] + "*"
-
-        if ("Integer" in self.parameter_type or
-            "Float" in self.parameter_type or
-                "Double" in self.parameter_type):
-            self.entry['justify'] = 'right'
-
-        # Add the bindings
-        if _platform == "darwin":
-            self.entry.bind("<Command-Key-a>", self.select_all)
-        else:
-            self.entry.bind("<Control-Key-a>", self.select_all)
-
-        # self.pack(fill=tk.BOTH, expand=1)
-        self.columnconfigure(0, weight=1)
-        self.columnconfigure(1, weight=10)
-        self.rowconfigure(0, weight=1)
-
-    def onEnter(self, event=None):
-        self.tooltip_label.configure(text=self.description)
-        # self.update()  # this is needed for cancelling and updating the progress bar
-
-    def onLeave(self, event=None):
-        self.tooltip_label.configure(text="")
-        self.update()  # this is needed for cancelling and updating the progress bar
-
-    def RepresentsInt(self, s):
-        try:
-            int(s)
-            return True
-        except ValueError:
+    name, value = arg[2:].split("=", 1)
+    return name, value.strip("'\"")
+
+def result_parameters(args):
+    ''' The parameters of a segmenter command line that determine its
+    output, as sorted (name, value) pairs with defaults filled in and values
+    converted to their types, so the GUI and batch mode agree on them.
+    '''
+    options = dict((flag, (kind, default)) for flag, kind, default in SEGMENTER_PARAMETERS + PYTHON_ENGINE_OPTIONS)
+    names = dict((engine_flag, flag) for flag, engine_flag in ENGINE_FLAGS.items())
+    params = dict((flag, default) for flag, (_, default) in options.items())
+    for arg in args:
+        parsed = parse_flag(arg)
+        if parsed is None:
+            continue
+        name, value = parsed
+        name = names.get(name, name)
+        params[name] = options[name][0](value) if name in options else value
+    return sorted((name, value) for name, value in params.items() if name not in OUTPUT_NEUTRAL_FLAGS)
+
+def engine_version(backend="binary", exe=None):
+    ''' Identifies the segmenter build in result cache keys: a digest of the
+    compiled executable, or of the python engine's modules.
+    '''
+    import cache
+    if backend == "python":
+        files = [path.join(path.dirname(path.abspath(__file__)), name) for name in PYTHON_ENGINE_MODULES]
+    else:
+        files = [exe or segmenter_exe()]
+    return "{}:{}".format(backend, cache.make_key(*(cache.file_digest(f) for f in files)))
+
+class JobResults(object):
+    ''' The result cache in front of segmenter jobs (see cache.ResultCache),
+    shared by the GUI and batch threads. With bypass set, jobs always run and
+    their results replace the cached ones.
+    '''
+    def __init__(self, root, max_bytes, engine, bypass=False):
+        import cache
+        self.cache = cache.ResultCache(root, max_bytes)
+        self.engine = engine
+        self.bypass = bypass
+        self.lock = threading.Lock()
+
+    def key(self, input_file, args):
+        return self.cache.key(input_file, result_parameters(args), self.engine)
+
+    def restore(self, key, output_file, metrics_file=None):
+        ''' Puts a cached result in place. Returns False if the job must run.
+        '''
+        if self.bypass:
             return False
-
-    def RepresentsFloat(self, s):
+        with self.lock:
+            return self.cache.restore(key, output_file, metrics_file)
+
+    def store(self, key, output_file, metrics_file=None):
+        with self.lock:
+            self.cache.store(key, output_file, metrics_file)
+
+    def summary(self):
+        return self.cache.summary() + (", bypassed" if self.bypass else "")
+
+
+class BatchJob(object):
+    ''' One tile of a segmenter job. cancel() stops its segmenter and wait()
+    blocks until it has finished; both may be called from any thread.
+    '''
+    def __init__(self, input_file, output_file):
+        self.input_file = input_file
+        self.output_file = output_file
+        self.log_file = os.path.splitext(output_file)[0] + ".log"
+        self.metrics_file = metrics_path(output_file)
+        self.metrics = None
+        self.returncode = None
+        self.elapsed = 0.0
+        self.error = None
+        self.cached = False
+        self.cancelled = False
+        self.proc = None
+        self.finished = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True
+        proc = self.proc
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+
+    def wait(self, timeout=None):
+        ''' Returns True once the job has finished, False on a timeout.
+        '''
+        return self.finished.wait(timeout)
+
+def metrics_path(output_file):
+    ''' The metrics file written next to an output.
+    '''
+    return os.path.splitext(output_file)[0] + ".metrics.json"
+
+def expand_inputs(patterns):
+    ''' Expands file names and glob patterns (shells on Windows do not) into
+    a sorted list of unique input files.
+    '''
+    import glob
+    files = []
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches and path.isfile(pattern):
+            matches = [pattern]
+        files.extend(path.abspath(m) for m in matches)
+    return sorted(set(files))
+
+def batch_command(command, job, params, working_dir, backend="binary"):
+    ''' Builds the same command line runner_gui.Gui.run_tool sends to the segmenter.
+    '''
+    args = list(command) + ["run", "--wd=\"{}\"".format(working_dir)]
+    args.append("--lidarFile='{}'".format(job.input_file))
+    args.append("--outputFile='{}'".format(job.output_file))
+    for flag, _, _ in SEGMENTER_PARAMETERS:
+        args.append("--{}={}".format(flag, params[flag]))
+    if backend == "python":
+        args.append("--metricsFile={}".format(job.metrics_file))
+        args.append("--progress=json")
+        for flag, _, default in PYTHON_ENGINE_OPTIONS:
+            if params.get(flag, default) != default:
+                args.append("--{}={}".format(ENGINE_FLAGS.get(flag, flag), params[flag]))
+    return args
+
+def run_job(command, job, params, working_dir, backend="binary", results=None, on_event=None, on_line=None):
+    ''' Runs the segmenter on a single tile, writing its output to the job's
+    log file and its stage timings to the job's metrics file. Returns the job
+    with its exit code and metrics filled in. With results (a JobResults) a
+    cached output is restored instead of running the segmenter again, and a
+    new one is cached. on_event, if given, is called with every progress
+    event of the run, and on_line with every line of its output.
+    '''
+    try:
+        return _run_job(command, job, params, working_dir, backend, results, on_event, on_line)
+    finally:
+        job.finished.set()
+
+def _run_job(command, job, params, working_dir, backend, results, on_event, on_line):
+    start = time.time()
+    adapter = progress.TextProgressAdapter()
+    args = batch_command(command, job, params, working_dir, backend)
+    key = None
+    try:
+        if results is not None:
+            key = results.key(job.input_file, args)
+            if results.restore(key, job.output_file, job.metrics_file):
+                job.cached = True
+                job.returncode = 0
+                job.elapsed = time.time() - start
+                return load_metrics(job)
+            # The segmenter may write into an existing output, which may be a
+            # read-only link into the cache restored by an earlier version.
+            import cache
+            cache.remove_file(job.output_file)
+        # The python backend sends structured progress events on stderr;
+        # the compiled tool's text progress goes through an adapter.
+        structured = backend == "python"
+        with open(job.log_file, "w") as log:
+            job.proc = Popen(args, shell=False, stdout=PIPE, stderr=PIPE if structured else STDOUT, bufsize=1,
+                             universal_newlines=True)
+            # A cancel() between the check and Popen would miss the process.
+            if job.cancelled:
+                job.proc.terminate()
+            for line in _output_lines(job.proc, structured):
+                event = progress.parse_event(line) if structured else None
+                if event is None:
+                    log.write(line)
+                    if on_line is not None:
+                        on_line(line)
+                    if not structured:
+                        event = adapter.feed(line)
+                if event is not None and event["type"] == "progress" and on_event is not None:
+                    on_event(event)
+            job.returncode = job.proc.wait()
+        if job.cancelled:
+            job.error = "cancelled"
+    except (OSError, ValueError, CalledProcessError) as err:
+        job.error = str(err)
+        job.returncode = -1
+    job.proc = None
+    job.elapsed = time.time() - start
+
+    # The python backend writes its own metrics; for the compiled tool they
+    # are derived from its text output.
+    if backend != "python" or not path.isfile(job.metrics_file):
+        progress.write_metrics(job.metrics_file, adapter.metrics(
+            input=job.input_file, output=job.output_file, params=params, returncode=job.returncode))
+    # Archives of several tiles have one output per tile, which are not
+    # cached.
+    if key is not None and job.returncode == 0 and path.isfile(job.output_file):
         try:
-            float(s)
-            return True
-        except ValueError:
-            return False
-
-    def get_value(self):
-        v = self.value.get()
-        if v:
-            if "Integer" in self.parameter_type:
-                if self.RepresentsInt(self.value.get()):
-                    return "{}={}".format(self.flag, self.value.get())
-                else:
-                    messagebox.showinfo(
-                        "Error", "Error converting parameter {} to type Integer.".format(self.flag))
-            elif "Float" in self.parameter_type:
-                if self.RepresentsFloat(self.value.get()):
-                    return "{}={}".format(self.flag, self.value.get())
-                else:
-                    messagebox.showinfo(
-                        "Error", "Error converting parameter {} to type Float.".format(self.flag))
-            elif "Double" in self.parameter_type:
-                if self.RepresentsFloat(self.value.get()):
-                    return "{}={}".format(self.flag, self.value.get())
-                else:
-                    messagebox.showinfo(
-                        "Error", "Error converting parameter {} to type Double.".format(self.flag))
-            else:  # String or StringOrNumber types
-                return "{}='{}'".format(self.flag, self.value.get())
-        else:
-            if not self.optional:
-                messagebox.showinfo(
-                    "Error", "Unspecified non-optional parameter {}.".format(self.flag))
-        return None
-
-    def select_all(self, event):
-        self.entry.select_range(0, tk.END)
-        return 'break'
-
-class Gui(tk.Frame):
-    def __init__(self, tool_name=None, master=None):
-        if platform.system() == 'Windows':
-            self.ext = '.exe'
-        else:
-            self.ext = ''
-        self.exe_name = "./Ransac_seg{}".format(self.ext) 
-
-        self.exe_path = path.dirname(path.abspath(__file__))
-
-        self.cancel_op = False
-
-        ttk.Frame.__init__(self, master)
-        self.script_dir = os.path.dirname(os.path.realpath(__file__))
-        self.grid()
-        self.tool_name = tool_name
-        self.master.title("RANSAC PLANE SEGMENTATION")
-        # if _platform == "darwin":
-        #     os.system(
-        #         '''/usr/bin/osascript -e 'tell app "Finder" to set frontmost of process "Python" to true' ''')
-        
-        #########################################################
-        #              Overall/Top level Frame                  #
-        #########################################################     
-        #define left-side frame (toplevel_frame) and right-side frame (overall_frame)
-        # toplevel_frame = ttk.Frame(self, padding='0.1i')
-        overall_frame = ttk.Frame(self, padding='0.1i')
-        #set-up layout
-        overall_frame.grid(row=0, column=0, sticky=tk.NSEW)
-        # toplevel_frame.grid(row=0, column=0, sticky=tk.NSEW) 
-
-        ##################
-        # Tool tip label #
-        ##################
-        tooltip_frame = ttk.Frame(overall_frame, padding='0.1i')
-        self.tt_label = ttk.Label(tooltip_frame, text="")
-        style = ttk.Style()
-        style.configure("Blue.Label", foreground="dark blue")
-        self.tt_label.configure(style="Blue.Label")
-        self.tt_label.grid(row=0, column=0, sticky=tk.W)
-        tooltip_frame.grid(row=4, column=0, columnspan=2, sticky=tk.NSEW)
-        
-        # Add GUI elements
-        self.elements_frame = ttk.Frame(overall_frame, padding='0.1i')
-
-        # input file:
-        param_num = 0
-        # input file:
-        param_str = '{ "name":"Input File (*.las)",  "description": "Name of the input points .las file.", "flags": ["-i", "--lidarFile"], "parameter_type": {"ExistingFile":"Lidar"}, "optional": "False", "default_value": null}'
-        fs1 = FileSelector(param_str, self, self.elements_frame, self.tt_label)
-        fs1.grid(row=param_num, column=0, sticky=tk.NSEW)
-        param_num += 1 
-
-        # Outputfile:
-        param_str = '{ "name":"Output File",  "description": "Name of the output points .las file.", "flags": ["-o", "--outputFile"], "parameter_type": {"NewFile":"Lidar"}, "optional": "False", "default_value": null}'
-        fs2 = FileSelector(param_str, self, self.elements_frame, self.tt_label)
-        fs2.grid(row=param_num, column=0, sticky=tk.NSEW)
-        param_num += 1
-
-        # Search Distance:
-        param_str = '{ "name":"Search Distance (m)",  "description": "Point neighbourhood Search Distance.", "flags": ["--searchDist"], "parameter_type": "Float", "optional": "False", "default_value": "1.50"}'
-        di3 = DataInput(param_str, self.elements_frame, self.tt_label)
-        di3.grid(row=param_num, column=0, sticky=tk.NSEW)
-        param_num += 1 
-
-        # Iterations: 
-        param_str = '{ "name":"Number of Iterations",  "description": "How many times would you like to iterate (Default: 50).", "flags": ["--iterations"], "parameter_type": "Integer", "optional": "False", "default_value": "50"}'
-        di4 = DataInput(param_str, self.elements_frame, self.tt_label)
-        di4.grid(row=param_num, column=0, sticky=tk.NSEW)
-        param_num += 1 
-
-        # Threshold Residuals:
-        param_str = '{ "name":"Residual Threshold Value",  "description": "Minimum Threshold (Default: 0.15).", "flags": ["--threshold"], "parameter_type": "Float", "optional": "False", "default_value": "0.15"}'
-        di5 = DataInput(param_str, self.elements_frame, self.tt_label)
-        di5.grid(row=param_num, column=0, sticky=tk.NSEW)
-        param_num += 1 
-
-        # Max Slope:
-        param_str = '{ "name":"Max Plane Slope (Degrees)",  "description": "Maximum Slope of Plane (Displayed in Degrees).", "flags": ["--maxSlope"], "parameter_type": "Float", "optional": "False", "default_value": "75.0"}'
-        di6 = DataInput(param_str, self.elements_frame, self.tt_label)
-        di6.grid(row=param_num, column=0, sticky=tk.NSEW)
-        param_num += 1 
-
-        # Number of Samples:
-        param_str = '{ "name":"Number of Samples (Per Neighbourhood)",  "description": "Number of Samples (Default: 10).", "flags": ["--numSamples"], "parameter_type": "Integer", "optional": "False", "default_value": "5"}'
-        di7 = DataInput(param_str, self.elements_frame, self.tt_label)
-        di7.grid(row=param_num, column=0, sticky=tk.NSEW)
-        param_num += 1
-
-        # Acceptable Model Size:
-        param_str = '{ "name":"Desired Model Size (Num Points)",  "description": "Minimum number of points in the model.", "flags": ["--acceptableModelSize"], "parameter_type": "Integer", "optional": "False", "default_value": "10"}'
-        di8 = DataInput(param_str, self.elements_frame, self.tt_label)
-        di8.grid(row=param_num, column=0, sticky=tk.NSEW)
-        param_num += 1
-        self.elements_frame.grid(row=0, column=0, sticky=tk.NSEW)
-
-        #########################################################
-        #                   Buttons Frame                       #
-        #########################################################
-
-        #Create the elements of the buttons frame
-        buttons_frame = ttk.Frame(overall_frame, padding='0.1i')
-        self.run_button = ttk.Button(buttons_frame, text="Run", width=8, command=self.run_tool)
-        self.quit_button = ttk.Button(buttons_frame, text="Cancel", width=8, command=self.cancel_operation)
-        self.close_button = ttk.Button(buttons_frame, text="Close", width=8, command=self.quit)
-
-        #Define layout of the frame
-        self.run_button.grid(row=0, column=0)
-        self.quit_button.grid(row=0, column=1)
-        self.close_button.grid(row=0, column=2)
-        buttons_frame.grid(row=1, column=0, columnspan=2, sticky=tk.E)
-
-        #########################################################
-        #                  Output Frame                         #
-        #########################################################              
-        #Create the elements of the output frame
-        output_frame = ttk.Frame(overall_frame)
-        outlabel = ttk.Label(output_frame, text="Output:", justify=tk.LEFT)
-        self.out_text = ScrolledText(output_frame, width=63, height=8, wrap=tk.NONE, padx=7, pady=7, exportselection = 0)
-        output_scrollbar = ttk.Scrollbar(output_frame, orient=tk.HORIZONTAL, command = self.out_text.xview)
-        self.out_text['xscrollcommand'] = output_scrollbar.set
-        #Retreive and insert the text for the current tool
-        # k = wbt.tool_help(self.tool_name)   
-        # self.out_text.insert(tk.END, k)
-        #Define layout of the frame
-        outlabel.grid(row=0, column=0, sticky=tk.NW)
-        self.out_text.grid(row=1, column=0, sticky=tk.NSEW)
-        output_frame.grid(row=2, column=0, columnspan = 2, sticky=(tk.NS, tk.E))
-        output_scrollbar.grid(row=2, column=0, sticky=(tk.W, tk.E))
-
-        #Configure rows and columns of the frame
-        self.out_text.columnconfigure(0, weight=1)
-        output_frame.columnconfigure(0, weight=1)
-        # Add the binding
-        if _platform == "darwin":
-            self.out_text.bind("<Command-Key-a>", self.select_all)
+            results.store(key, job.output_file, job.metrics_file)
+        except OSError as err:
+            job.error = "result not cached: {}".format(err)
+    return load_metrics(job)
+
+def _output_lines(proc, structured):
+    ''' The lines of a segmenter's stdout and, when structured, its stderr
+    in the order they arrive. Both streams are read on threads of their own
+    so that neither pipe can fill up and stall the segmenter.
+    '''
+    if not structured:
+        for line in proc.stdout:
+            yield line
+        return
+    import queue
+    lines = queue.Queue()
+    for stream in (proc.stdout, proc.stderr):
+        reader = threading.Thread(target=_read_stream, args=(stream, lines))
+        reader.daemon = True
+        reader.start()
+    open_streams = 2
+    while open_streams:
+        line = lines.get()
+        if line is None:
+            open_streams -= 1
         else:
-            self.out_text.bind("<Control-Key-a>", self.select_all)
-            
-        #########################################################
-        #                  Progress Frame                       #
-        #########################################################        
-        #Create the elements of the progress frame
-        progress_frame = ttk.Frame(overall_frame, padding='0.1i')
-        self.progress_label = ttk.Label(progress_frame, text="Progress:", justify=tk.LEFT)
-        self.progress_var = tk.DoubleVar()
-        self.progress = ttk.Progressbar(progress_frame, orient="horizontal", variable=self.progress_var, length=200, maximum=100)
-
-        #Define layout of the frame
-        self.progress_label.grid(row=0, column=0, sticky=tk.E, padx=5)
-        self.progress.grid(row=0, column=1, sticky=tk.E)
-        progress_frame.grid(row=3, column=0, columnspan = 2, sticky=tk.SE)
-
-        self.working_dir = str(Path.home())
-
-    def run_tool(self):
+            yield line
+
+def _read_stream(stream, lines):
+    ''' Moves the lines of stream into a queue; None marks its end.
+    '''
+    try:
+        for line in stream:
+            lines.put(line)
+    finally:
+        stream.close()
+        lines.put(None)
+
+def load_metrics(job):
+    try:
+        with open(job.metrics_file) as f:
+            job.metrics = json.load(f)
+    except (OSError, ValueError):
+        job.metrics = None
+    return job
+
+class Segmenter(object):
+    ''' A reusable segmenter job: a backend and a set of parameters (keyword
+    arguments by flag, see PARAMETERS), applied to any number of tiles. run()
+    segments a tile on the calling thread, start() on a thread of its own;
+    both return the tile's BatchJob. With results (a JobResults) outputs are
+    restored from and stored in the result cache.
+
+    The callbacks are called on the thread running the tile: on_event(job,
+    event) with its progress events (see progress.py), on_line(job, line)
+    with every line of the segmenter's output and on_finish(job) once it
+    has finished.
+    '''
+    def __init__(self, backend="binary", exe=None, results=None, on_event=None, on_line=None, on_finish=None,
+                 **params):
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of {}, got '{}'.".format(", ".join(BACKENDS), backend))
+        self.backend = backend
+        self.command = segmenter_command(backend, exe)
+        self.params = resolve_parameters(params, backend)
+        self.results = results
+        self.on_event = on_event
+        self.on_line = on_line
+        self.on_finish = on_finish
+
+    def run(self, input_file, output_file, job=None):
+        ''' Segments input_file (a .las file, or with the python backend a
+        .zip of them) into output_file and returns the finished BatchJob.
+        '''
+        if job is None:
+            job = BatchJob(path.abspath(input_file), path.abspath(output_file))
+        on_event = (lambda event: self.on_event(job, event)) if self.on_event is not None else None
+        on_line = (lambda line: self.on_line(job, line)) if self.on_line is not None else None
         try:
-            args = []
-            for widget in self.elements_frame.winfo_children():
-                v = widget.get_value()
-                if v:
-                    args.append(v)
-                elif not widget.optional:
-                    messagebox.showinfo(
-                        "Error", "Non-optional tool parameter not specified.")
-                    return
-
-            ''' 
-            Runs a tool and specifies tool arguments.
-            Returns 0 if completes without error.
-            Returns 1 if error encountered (details are sent to callback).
-            Returns 2 if process is cancelled by user.
-            '''
-
-            os.chdir(self.exe_path)
-            args2 = []
-            
-            args2.append("." + path.sep + self.exe_name)
-            # args2.append("--run=\"{}\"".format(to_camelcase(tool_name)))
-            args2.append("run")
-
-            if self.working_dir not in args2:
-                args2.append("--wd=\"{}\"".format(self.working_dir)) 
-
-            for arg in args:
-                args2.append(arg)
-
-            cl = ""
-            for v in args2:
-                cl += v + " "
-            self.custom_callback(cl.strip() + "\n")
-
-            proc = Popen(args2, shell=False, stdout=PIPE, stderr=STDOUT, bufsize=1, universal_newlines=True)
-
-            while True:
-                line = proc.stdout.readline()
-                sys.stdout.flush()
-                if line != '':
-                    if not self.cancel_op:
-                        self.custom_callback(line.strip())
-                    else:
-                        self.cancel_op = False
-                        proc.terminate()
-                        return 2
-
-                else:
-                    break
-
-            return 0
-        except (OSError, ValueError, CalledProcessError) as err:
-            self.custom_callback(str(err))
-            return 1
+            os.makedirs(path.dirname(job.output_file), exist_ok=True)
+            _run_job(self.command, job, self.params, path.dirname(job.output_file), self.backend, self.results,
+                     on_event, on_line)
+            if self.on_finish is not None:
+                self.on_finish(job)
         finally:
-            self.progress_var.set(0)
-            self.progress_label['text'] = "Completion:"
+            job.finished.set()
+        return job
 
-    def custom_callback(self, value):
-        ''' A custom callback for dealing with tool output.
+    def start(self, input_file, output_file):
+        ''' Starts segmenting input_file on a new thread and returns its
+        BatchJob at once.
         '''
-        if "%" in value:
-            try:
-                str_array = value.split(" ")
-                label = value.replace(
-                    str_array[len(str_array) - 1], "").strip()
-                progress = float(
-                    str_array[len(str_array) - 1].replace("%", "").strip())
-                self.progress_var.set(int(progress))
-                self.progress_label['text'] = label
-            except ValueError as e:
-                print("Problem converting parsed data into number: ", e)
-            except Exception as e:
-                print(e)
-        else:
-            self.print_line_to_output(value)
-
-        self.update()  # this is needed for cancelling and updating the progress bar
-
-    def print_to_output(self, value):
-        self.out_text.insert(tk.END, value)
-        self.out_text.see(tk.END)
-
-    def print_line_to_output(self, value):
-        self.out_text.insert(tk.END, value + "\n")
-        self.out_text.see(tk.END)
-        
-    def cancel_operation(self):
-        # wbt.cancel_op = True
-        self.print_line_to_output("Cancelling operation...")
-        self.progress.update_idletasks()
-
-    def select_all(self, event):
-        self.out_text.tag_add(tk.SEL, "1.0", tk.END)
-        self.out_text.mark_set(tk.INSERT, "1.0")
-        self.out_text.see(tk.INSERT)
-        return 'break'
-
-def main():
-    gui = Gui()
+        job = BatchJob(path.abspath(input_file), path.abspath(output_file))
+        thread = threading.Thread(target=self.run, args=(input_file, output_file, job))
+        thread.daemon = True
+        thread.start()
+        return job
+
+def segment(input_file, output_file, backend="binary", exe=None, results=None, on_event=None, **params):
+    ''' Segments one tile and returns its finished BatchJob: returncode is 0
+    on success and metrics holds the run's stage timings. params are the
+    segmenter parameters by flag (see PARAMETERS); the rest are as for
+    Segmenter.
+    '''
+    return Segmenter(backend, exe, results, on_event, **params).run(input_file, output_file)
+
+def run_batch(inputs, output_dir, params, workers=None, suffix="_ransac", exe=None, echo=print, backend="binary",
+              results=None):
+    ''' Segments every input tile on a pool of threads, each running
+    one segmenter process at a time, restoring the outputs found in results
+    (a JobResults), if given. Returns the list of finished BatchJob objects,
+    in input order.
+    '''
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    segmenter = Segmenter(backend, exe, results, **params)
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    for input_file in inputs:
+        stem = os.path.splitext(path.basename(input_file))[0]
+        jobs.append(BatchJob(input_file, path.join(path.abspath(output_dir), stem + suffix + ".las")))
+
+    echo("Processing {} tile(s) with {} worker(s)...".format(len(jobs), workers))
+    # Each job is its own segmenter process, so threads are enough to keep
+    # the pool busy.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(segmenter.run, job.input_file, job.output_file, job) for job in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            job = future.result()
+            status = "ok" if job.returncode == 0 else "FAILED ({})".format(job.error or job.returncode)
+            if job.cached:
+                status += ", cached"
+            echo("[{}/{}] {} {} ({:.1f} s)".format(done, len(jobs), path.basename(job.input_file), status, job.elapsed))
+            if job.returncode == 0 and job.metrics:
+                echo("      " + format_metrics(job.metrics))
+    return jobs
+
+def print_summary(jobs, echo=print, results=None):
+    failed = [job for job in jobs if job.returncode != 0]
+    echo("\nSummary: {} tile(s), {} succeeded, {} failed, {:.1f} s total worker time".format(
+        len(jobs), len(jobs) - len(failed), len(failed), sum(job.elapsed for job in jobs)))
+    if results is not None:
+        echo(results.summary())
+    for job in jobs:
+        echo("  {:>4}  {}  -> {}".format(job.returncode, job.input_file, job.output_file))
+    for job in failed:
+        echo("See {} for the output of {}".format(job.log_file, path.basename(job.input_file)))
+
+def add_job_arguments(parser):
+    ''' Options shared by batch and serve: output naming, the executable
+    and the segmenter parameters of PARAMETERS.
+    '''
+    parser.add_argument("--suffix", default="_ransac", help="Suffix added to output file names.")
+    parser.add_argument("--exe", default=None, help="Path of the Ransac_seg executable.")
+    for spec in PARAMETERS:
+        if "file" in spec:
+            continue
+        parser.add_argument("--" + spec["flag"], type=spec["type"], default=spec["default"], choices=spec.get("choices"),
+                            help="{}{} (default: {})".format("python backend only. " if spec.get("python") else "",
+                                                             spec["description"].replace("%", "%%"), spec["default"]))
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="RANSAC plane segmentation of LiDAR tiles.")
+    parser.add_argument("--backend", choices=BACKENDS, default="binary",
+                        help="Segmentation engine: the compiled Ransac_seg tool or the NumPy implementation.")
+    parser.add_argument("--resultCache", default="",
+                        help="Directory of cached outputs; jobs already run with the same input, parameters and "
+                             "engine are restored from it instead of recomputed (default: no caching).")
+    parser.add_argument("--resultCacheSize", type=float, default=20.0, help="Size limit of the result cache in GB.")
+    parser.add_argument("--bypassResultCache", action="store_true",
+                        help="Run every job even if its result is cached, and cache the new result.")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("gui", help="Launch the graphical interface (default).")
+    batch = sub.add_parser("batch", help="Segment many tiles without a GUI.")
+    batch.add_argument("inputs", nargs="+", help="Input .las files or glob patterns.")
+    batch.add_argument("-o", "--outputDir", required=True, help="Directory for the output .las files.")
+    batch.add_argument("-j", "--workers", type=int, default=None, help="Number of tiles processed at once (default: CPU count).")
+    add_job_arguments(batch)
+    serve = sub.add_parser("serve", help="Segment the tiles dropped into a watch directory (see watch_service.py).")
+    serve.add_argument("watchDir", help="Directory watched for new .las and .zip files.")
+    serve.add_argument("-o", "--outputDir", required=True, help="Directory for the output .las files.")
+    serve.add_argument("--failedDir", required=True, help="Directory failed inputs and their logs are moved to.")
+    serve.add_argument("-j", "--workers", type=int, default=1, help="Number of tiles processed at once.")
+    serve.add_argument("--port", type=int, default=8765, help="Localhost port of the JSON status endpoint (0: none).")
+    serve.add_argument("--stateFile", default=None, help="Queue state file (default: .ransac_queue.json in the watch directory).")
+    serve.add_argument("--settle", type=float, default=5.0,
+                       help="Seconds a file must stay unchanged before it is queued.")
+    serve.add_argument("--poll", type=float, default=1.0, help="Seconds between scans of the watch directory.")
+    serve.add_argument("--once", action="store_true", help="Exit once the files present have been processed.")
+    add_job_arguments(serve)
+    sub.add_parser("sweep", add_help=False,
+                   help="Evaluate lists/ranges of parameters on one file (python backend; see sweep.py --help).")
+    # Everything after "sweep" is handed to sweep.py unparsed.
+    args, extra = parser.parse_known_args(argv)
+    if args.command == "sweep":
+        args.sweep_args = extra
+    elif extra:
+        parser.error("unrecognized arguments: {}".format(" ".join(extra)))
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "sweep":
+        import sweep
+        return sweep.main(args.sweep_args)
+    results = None
+    if args.resultCache:
+        exe = getattr(args, "exe", None)
+        try:
+            results = JobResults(args.resultCache, args.resultCacheSize * 1e9, engine_version(args.backend, exe),
+                                 args.bypassResultCache)
+        except OSError as err:
+            print("Result cache disabled: {}".format(err))
+    if args.command in ("batch", "serve"):
+        try:
+            params = resolve_parameters(dict((flag, getattr(args, flag)) for flag, _, _ in
+                                             SEGMENTER_PARAMETERS + PYTHON_ENGINE_OPTIONS), args.backend)
+        except ValueError as err:
+            print(err)
+            return 2
+    if args.command == "serve":
+        import watch_service
+        service = watch_service.WatchService(args.watchDir, args.outputDir, args.failedDir, params, args.workers,
+                                             args.backend, args.exe, args.stateFile, args.settle, args.poll,
+                                             args.suffix, results)
+        service.serve(args.port, args.once)
+        if results is not None:
+            print(results.summary())
+        return 0
+    if args.command == "batch":
+        inputs = expand_inputs(args.inputs)
+        if not inputs:
+            print("No input files match {}".format(" ".join(args.inputs)))
+            return 1
+        jobs = run_batch(inputs, args.outputDir, params, args.workers, args.suffix, args.exe, backend=args.backend,
+                         results=results)
+        print_summary(jobs, results=results)
+        return 0 if all(job.returncode == 0 for job in jobs) else 1
+
+    import runner_gui
+    gui = runner_gui.Gui(backend=args.backend, results=results)
     gui.mainloop()
-main()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+'''
+End-to-end benchmarks of the Python segmentation backend on synthetic tiles.
+
+Every combination of the point counts and parameter lists is run as a
+separate ransac_engine.py process on a tile from synthetic_las.py (tiles are
+generated once and kept in the data directory). Each case records the stage
+times and points/sec from the run's metrics file, the peak RSS of the
+process, and the precision and recall of the planar labels (class 0)
+against the tile's ground truth. Results are written to a JSON file:
+
+    python benchmark.py --points 1e4,1e5,1e6 --iterations 25,50 -o baseline.json
+
+and a later run can be compared against it, exiting with status 1 when a
+case got slower, used more memory or labelled less accurately:
+
+    python benchmark.py --points 1e4,1e5,1e6 --iterations 25,50 -o new.json --baseline baseline.json
+
+Dense tiles show the speed and accuracy traded by voxel-reduced searches:
+
+    python benchmark.py --points 2e4 --density 150 --voxelSize 0,0.2,0.3,0.5 -o voxels.json
+
+--importOnly instead times "import Ransac_runner" in fresh interpreters,
+the start-up cost of a headless worker, and fails when it exceeds the
+import budget or pulls in Tk, NumPy or another module of
+HEADLESS_EXCLUDED:
+
+    python benchmark.py --importOnly --importBudget 50
+'''
+import argparse, itertools, json, os, platform, subprocess, sys, time
+
+import numpy as np
+
+import las_io
+import ransac_engine
+import synthetic_las
+from sweep import parse_values
+
+BENCHMARKED_PARAMETERS = ["searchDist", "iterations", "numSamples", "confidence", "voxelSize"]
+
+# Default regression tolerances: relative for speed and memory, absolute
+# for precision and recall.
+SPEED_TOLERANCE = 0.2
+MEMORY_TOLERANCE = 0.2
+ACCURACY_TOLERANCE = 0.01
+
+# Median milliseconds "import Ransac_runner" may take (as reported by
+# python -X importtime), over IMPORT_RUNS fresh interpreters, and modules
+# that only the GUI and the engine itself need.
+IMPORT_BUDGET_MS = 50.0
+IMPORT_RUNS = 9
+HEADLESS_EXCLUDED = ("tkinter", "numpy", "argparse", "concurrent.futures")
+
+
+def tile_name(data_dir, points, density, seed):
+    return os.path.join(data_dir, "synthetic_{}_d{:g}_s{}.las".format(int(points), density, seed))
+
+
+def ensure_tile(data_dir, points, density, seed, echo=print):
+    ''' Path of the synthetic tile, generating it on first use.
+    '''
+    file_name = tile_name(data_dir, points, density, seed)
+    if not os.path.exists(file_name):
+        echo("Generating {} points -> {}".format(int(points), file_name))
+        os.makedirs(data_dir, exist_ok=True)
+        temp = file_name + ".part"
+        synthetic_las.generate(temp, points, density, seed)
+        os.replace(temp, file_name)
+    return file_name
+
+
+def run_process(command, log_file):
+    ''' Runs command with its output in log_file. Returns (exit code, peak
+    RSS in bytes); the RSS is None where the OS does not report it.
+    '''
+    with open(log_file, "w") as log:
+        proc = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        if not hasattr(os, "wait4"):
+            return proc.wait(), None
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return proc.returncode, usage.ru_maxrss * scale
+
+
+def accuracy(output_file):
+    ''' (precision, recall) of the planar labels in a segmented synthetic
+    tile. The output is a copy of the input, so the truth is still there.
+    '''
+    las = las_io.LasFile(output_file)
+    predicted = las.classification() == ransac_engine.NEVER_CLASSIFIED
+    truth = synthetic_las.truth(las)
+    hits = np.count_nonzero(predicted & truth)
+    precision = hits / float(max(np.count_nonzero(predicted), 1))
+    recall = hits / float(max(np.count_nonzero(truth), 1))
+    return precision, recall
+
+
+def case_key(case):
+    # Results from before a parameter was benchmarked ran with its default.
+    return tuple([int(case["points"])] + [case["params"].get(name, ransac_engine.DEFAULT_PARAMS[name])
+                                          for name in BENCHMARKED_PARAMETERS])
+
+
+def run_case(lidar_file, points, params, work_dir, seed=0, keep_output=False):
+    stem = "case_{}_{}".format(int(points), "_".join("{:g}".format(params[n]) for n in BENCHMARKED_PARAMETERS))
+    output_file = os.path.join(work_dir, stem + ".las")
+    metrics_file = os.path.join(work_dir, stem + ".metrics.json")
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ransac_engine.py"), "run",
+               "--lidarFile=" + lidar_file, "--outputFile=" + output_file, "--metricsFile=" + metrics_file,
+               "--seed={}".format(seed)]
+    command += ["--{}={}".format(name, value) for name, value in sorted(params.items())]
+    started = time.perf_counter()
+    returncode, peak_rss = run_process(command, os.path.join(work_dir, stem + ".log"))
+    case = {"points": int(points), "params": params, "returncode": returncode,
+            "elapsed": time.perf_counter() - started, "peak_rss": peak_rss}
+    if returncode == 0:
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+        case["stages"] = dict((name, timing["wall"]) for name, timing in metrics["stages"].items())
+        case["points_per_second"] = metrics.get("points_per_second")
+        case["mean_iterations"] = metrics.get("iterations", {}).get("mean")
+        case["precision"], case["recall"] = accuracy(output_file)
+        if not keep_output:
+            os.remove(output_file)
+    return case
+
+
+def run_benchmarks(sizes, grid, data_dir, density=10.0, seed=1, keep_output=False, echo=print):
+    cases = []
+    work_dir = os.path.join(data_dir, "runs")
+    os.makedirs(work_dir, exist_ok=True)
+    combos = list(itertools.product(*(grid[name] for name in BENCHMARKED_PARAMETERS)))
+    for points in sizes:
+        lidar_file = ensure_tile(data_dir, points, density, seed, echo)
+        for values in combos:
+            params = dict(zip(BENCHMARKED_PARAMETERS, values))
+            case = run_case(lidar_file, points, params, work_dir, keep_output=keep_output)
+            echo(format_case(case))
+            cases.append(case)
+    return cases
+
+
+def case_name(case):
+    return "{} pts ".format(case["points"]) + " ".join(
+        "{}={:g}".format(name, case["params"][name]) for name in BENCHMARKED_PARAMETERS)
+
+
+def format_case(case):
+    text = case_name(case)
+    if case["returncode"] != 0:
+        return text + "  FAILED (exit code {})".format(case["returncode"])
+    stages = " ".join("{} {:.2f}s".format(name, secs) for name, secs in case["stages"].items())
+    rss = "{:.0f} MB".format(case["peak_rss"] / 1e6) if case["peak_rss"] else "n/a"
+    return text + "  {:,.0f} pts/s  RSS {}  P {:.3f}  R {:.3f}  [{}]".format(
+        case["points_per_second"] or 0.0, rss, case["precision"], case["recall"], stages)
+
+
+def metadata(density, seed):
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "density": density,
+        "data_seed": seed,
+    }
+
+
+def compare(cases, baseline, speed_tolerance=SPEED_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE,
+            accuracy_tolerance=ACCURACY_TOLERANCE):
+    ''' Regressions of cases against baseline cases, as a list of messages.
+    '''
+    previous = dict((case_key(case), case) for case in baseline)
+    regressions = []
+    for case in cases:
+        old = previous.get(case_key(case))
+        if old is None or old["returncode"] != 0:
+            continue
+        name = case_name(case)
+        if case["returncode"] != 0:
+            regressions.append("{}: failed with exit code {}".format(name, case["returncode"]))
+            continue
+        if old.get("points_per_second") and case["points_per_second"] < old["points_per_second"] * (1 - speed_tolerance):
+            regressions.append("{}: {:,.0f} pts/s, was {:,.0f}".format(
+                name, case["points_per_second"], old["points_per_second"]))
+        if old.get("peak_rss") and case["peak_rss"] and case["peak_rss"] > old["peak_rss"] * (1 + memory_tolerance):
+            regressions.append("{}: peak RSS {:.0f} MB, was {:.0f} MB".format(
+                name, case["peak_rss"] / 1e6, old["peak_rss"] / 1e6))
+        for metric in ("precision", "recall"):
+            if case[metric] < old[metric] - accuracy_tolerance:
+                regressions.append("{}: {} {:.4f}, was {:.4f}".format(name, metric, case[metric], old[metric]))
+    return regressions
+
+
+def measure_import(module="Ransac_runner", runs=IMPORT_RUNS):
+    ''' Imports module in runs fresh interpreters with -X importtime.
+    Returns the module's cumulative import times in milliseconds, their
+    median, and the modules of HEADLESS_EXCLUDED that were imported.
+    '''
+    times, excluded = [], set()
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError("import {} failed:\n{}".format(module, proc.stderr))
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or line.endswith("| imported package"):
+                continue
+            _, cumulative, name = line.split("|")
+            if name.strip() in HEADLESS_EXCLUDED:
+                excluded.add(name.strip())
+            if name.strip() == module:
+                times.append(int(cumulative) / 1000.0)
+    times.sort()
+    return {"module": module, "runs_ms": times, "median_ms": times[len(times) // 2], "excluded": sorted(excluded)}
+
+
+def check_import(result, budget=IMPORT_BUDGET_MS):
+    ''' Budget violations of a measure_import result, as a list of messages.
+    '''
+    regressions = []
+    if result["median_ms"] > budget:
+        regressions.append("import {}: {:.1f} ms, budget {:.1f} ms".format(result["module"], result["median_ms"], budget))
+    if result["excluded"]:
+        regressions.append("import {} imports {}".format(result["module"], ", ".join(result["excluded"])))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Python backend on synthetic LAS tiles.")
+    parser.add_argument("--points", default="1e4,1e5", help="Comma separated tile sizes, from 1e4 up to 1e8.")
+    for name in BENCHMARKED_PARAMETERS:
+        parser.add_argument("--" + name, default=str(ransac_engine.DEFAULT_PARAMS[name]),
+                            help="Comma separated values and start:stop:step ranges.")
+    parser.add_argument("--density", type=float, default=10.0, help="Points per square metre of the tiles.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic tiles.")
+    parser.add_argument("--dataDir", default="benchmark_data", help="Directory for generated tiles and run logs.")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="Results file.")
+    parser.add_argument("--baseline", default="", help="Compare the results with this results file.")
+    parser.add_argument("--speedTolerance", type=float, default=SPEED_TOLERANCE,
+                        help="Allowed relative drop in points/sec.")
+    parser.add_argument("--memoryTolerance", type=float, default=MEMORY_TOLERANCE,
+                        help="Allowed relative growth of peak RSS.")
+    parser.add_argument("--accuracyTolerance", type=float, default=ACCURACY_TOLERANCE,
+                        help="Allowed absolute drop in precision and recall.")
+    parser.add_argument("--keepOutput", action="store_true", help="Keep the segmented tiles.")
+    parser.add_argument("--importOnly", action="store_true",
+                        help="Check the import time of Ransac_runner instead of running the benchmarks.")
+    parser.add_argument("--importBudget", type=float, default=IMPORT_BUDGET_MS,
+                        help="With --importOnly, the median milliseconds importing Ransac_runner may take.")
+    args = parser.parse_args(argv)
+
+    if args.importOnly:
+        imported = measure_import()
+        print("import {}: median {:.1f} ms over {} runs (budget {:.1f} ms)".format(
+            imported["module"], imported["median_ms"], len(imported["runs_ms"]), args.importBudget))
+        regressions = check_import(imported, args.importBudget)
+        for message in regressions:
+            print("  " + message)
+        return 1 if regressions else 0
+
+    try:
+        sizes = [int(n) for n in parse_values(args.points, float)]
+        grid = dict((name, parse_values(getattr(args, name), type(ransac_engine.DEFAULT_PARAMS[name])))
+                    for name in BENCHMARKED_PARAMETERS)
+    except ValueError as err:
+        parser.error(str(err))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    cases = run_benchmarks(sizes, grid, args.dataDir, args.density, args.seed, args.keepOutput)
+    with open(args.output, "w") as f:
+        json.dump({"meta": metadata(args.density, args.seed), "cases": cases}, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(args.output))
+
+    failed = [case for case in cases if case["returncode"] != 0]
+    if baseline is None:
+        return 1 if failed else 0
+    regressions = compare(cases, baseline["cases"], args.speedTolerance, args.memoryTolerance, args.accuracyTolerance)
+    if not regressions:
+        print("No regressions against {}.".format(args.baseline))
+        return 1 if failed else 0
+    print("{} regression(s) against {}:".format(len(regressions), args.baseline))
+    for message in regressions:
+        print("  " + message)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+'''
+On-disk caches for the Python segmentation backend.
+
+Entries live in subdirectories of a cache directory named after their key.
+Looking an entry up refreshes its modification time, and the least recently
+used entries are evicted whenever the directory grows past its size limit.
+
+NeighbourCache keeps the filtered points and neighbourhoods of input files
+for the engine; ResultCache keeps whole segmented outputs for the runner.
+'''
+import hashlib, json, os, shutil, stat, tempfile
+
+import numpy as np
+
+import las_io
+import ransac_engine
+
+# Bump when the filtering rules or the neighbourhood file layout change, so
+# stale entries are never reused.
+NEIGHBOUR_FORMAT = "neighbours-v3 filter=not(7,18),last-return sort=distance,index order=morton xyz=quantized"
+
+# Bump when the layout of result cache entries changes.
+RESULT_FORMAT = "results-v1"
+
+_TEMP_PREFIX = ".tmp-"
+
+
+def file_digest(file_name, block_size=1 << 22):
+    ''' SHA-256 of a file's contents, as a hex string.
+    '''
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_key(*parts):
+    return hashlib.sha256("\n".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:40]
+
+
+def directory_size(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class CacheDirectory(object):
+    ''' A size-bounded directory of cache entries with LRU eviction.
+    '''
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def lookup(self, key):
+        ''' Path of the entry for key, or None. A hit marks it recently used.
+        '''
+        entry = os.path.join(self.root, key)
+        if not os.path.isdir(entry):
+            return None
+        try:
+            os.utime(entry)
+        except OSError:
+            return None
+        return entry
+
+    def store(self, key, build):
+        ''' Creates the entry for key by calling build(directory) on an empty
+        temporary directory, then moves it into place and evicts old entries.
+        Returns the entry's path.
+        '''
+        temp = tempfile.mkdtemp(prefix=_TEMP_PREFIX, dir=self.root)
+        entry = os.path.join(self.root, key)
+        try:
+            build(temp)
+            try:
+                os.rename(temp, entry)
+            except OSError:
+                # Another process stored the same entry first.
+                if not os.path.isdir(entry):
+                    raise
+        finally:
+            remove_tree(temp)
+        self.evict(keep=key)
+        return entry
+
+    def entries(self):
+        ''' (mtime, size, name) of every entry, least recently used first.
+        '''
+        result = []
+        for name in os.listdir(self.root):
+            entry = os.path.join(self.root, name)
+            if name.startswith(_TEMP_PREFIX) or not os.path.isdir(entry):
+                continue
+            try:
+                result.append((os.path.getmtime(entry), directory_size(entry), name))
+            except OSError:
+                pass
+        return sorted(result)
+
+    def evict(self, keep=None):
+        ''' Removes least recently used entries until the directory fits its
+        size limit. The entry named keep is never removed.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            remove_tree(os.path.join(self.root, name))
+            total -= size
+
+
+class StoredNeighbourhoods(object):
+    ''' Neighbourhoods read back from a cache entry. All arrays are memory
+    mapped; see ransac_engine.Neighbourhoods for the interface.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.rows = np.load(os.path.join(directory, "rows.npy"), mmap_mode="r")
+        self.xyz = load_points(directory)
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        self.indices = load_raw(directory, "indices")
+        self.query_rows = np.load(os.path.join(directory, "query_rows.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.query_rows)
+
+    def chunk(self, start, stop):
+        stop = min(stop, len(self.query_rows))
+        offsets = np.asarray(self.offsets[start:stop + 1])
+        indices = np.asarray(self.indices[offsets[0]:offsets[-1]], dtype=np.int64)
+        return np.asarray(self.query_rows[start:stop]), offsets - offsets[0], indices
+
+
+def save_neighbourhoods(neighbourhoods, directory, progress=None):
+    ''' Writes the filtered points and every neighbourhood of a
+    ransac_engine.Neighbourhoods to directory as CSR arrays (offsets +
+    indices) in query order, streaming the indices so only one chunk is in
+    memory.
+    '''
+    nb = neighbourhoods
+    np.save(os.path.join(directory, "rows.npy"), nb.rows)
+    np.save(os.path.join(directory, "query_rows.npy"), nb.query_rows)
+    save_points(nb.xyz, directory)
+    # Neighbour lists dominate the entry's size, so use 32-bit indices when
+    # they fit.
+    index_type = ransac_engine.index_type(len(nb.rows))
+    offsets = np.zeros(len(nb) + 1, dtype=np.int64)
+    with open(os.path.join(directory, "indices." + index_type.str[1:]), "wb") as f:
+        for start in range(0, len(nb), ransac_engine.CHUNK_SIZE):
+            rows, chunk_offsets, indices = nb.chunk(start, start + ransac_engine.CHUNK_SIZE)
+            offsets[start + 1:start + len(rows) + 1] = offsets[start] + chunk_offsets[1:]
+            indices.astype(index_type).tofile(f)
+            if progress is not None:
+                progress("Building neighbourhood index", start + len(rows), len(nb))
+    np.save(os.path.join(directory, "offsets.npy"), offsets)
+
+
+def save_points(xyz, directory):
+    ''' Writes coordinates as X, Y and Z arrays plus quantization.npy
+    (scale and offset) when they are las_io.QuantizedPoints, and as xyz.npy
+    otherwise.
+    '''
+    if isinstance(xyz, las_io.QuantizedPoints):
+        for name in ("X", "Y", "Z"):
+            np.save(os.path.join(directory, name + ".npy"), getattr(xyz, name))
+        np.save(os.path.join(directory, "quantization.npy"), np.array([xyz.scale, xyz.offset]))
+    else:
+        np.save(os.path.join(directory, "xyz.npy"), xyz)
+
+
+def load_points(directory):
+    ''' Memory-maps the coordinates written by save_points.
+    '''
+    if not os.path.exists(os.path.join(directory, "quantization.npy")):
+        return np.load(os.path.join(directory, "xyz.npy"), mmap_mode="r")
+    scale, offset = np.load(os.path.join(directory, "quantization.npy"))
+    X, Y, Z = (np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in ("X", "Y", "Z"))
+    return las_io.QuantizedPoints(X, Y, Z, scale, offset)
+
+
+def load_raw(directory, name):
+    ''' Memory-maps a headerless array written as <name>.<dtype code>.
+    '''
+    for file_name in os.listdir(directory):
+        base, _, code = file_name.partition(".")
+        if base == name:
+            dtype = np.dtype("<" + code)
+            file_name = os.path.join(directory, file_name)
+            if os.path.getsize(file_name) == 0:
+                return np.zeros(0, dtype=dtype)
+            return np.memmap(file_name, dtype=dtype, mode="r")
+    raise IOError("Cache entry {} has no {} array.".format(directory, name))
+
+
+class NeighbourCache(object):
+    ''' Caches the filtered points and radius neighbourhoods of LAS files,
+    keyed by file contents, filtering rules and search distance, so runs that
+    only change the RANSAC parameters skip filtering and the index build.
+    '''
+    def __init__(self, root, max_bytes):
+        self.directory = CacheDirectory(root, max_bytes)
+
+    def key(self, las, search_dist):
+        parts = [NEIGHBOUR_FORMAT, file_digest(las.file_name), repr(float(search_dist))]
+        if getattr(las, "member", None):
+            # A LAS file inside a zip archive (las_io.ZipLasMember).
+            parts.append(las.member)
+        return make_key(*parts)
+
+    def load_or_build(self, las, search_dist, progress=None):
+        key = self.key(las, search_dist)
+        entry = self.directory.lookup(key)
+        if entry is None:
+            print("Building neighbourhood index cache...\n", flush=True)
+            nb = ransac_engine.Neighbourhoods(*las.read_quantized(), search_dist=search_dist)
+            entry = self.directory.store(key, lambda directory: save_neighbourhoods(nb, directory, progress))
+        else:
+            print("Using cached neighbourhood index {}\n".format(entry), flush=True)
+        return StoredNeighbourhoods(entry)
+
+
+class ResultCache(object):
+    ''' Segmented output files keyed by the input file's contents, the
+    parameters that determine the output and the engine version, so a job
+    that was already run returns its output without recomputing it.
+
+    A hit is restored as a copy of the cached file, so editing a restored
+    output cannot change the entry. hits and misses count the lookups of
+    this instance.
+    '''
+    OUTPUT = "output.las"
+    METRICS = "metrics.json"
+
+    def __init__(self, root, max_bytes):
+        self.directory = CacheDirectory(root, max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, input_file, params, engine_version):
+        ''' Key of a job: params is a list of (name, value) pairs.
+        '''
+        return make_key(RESULT_FORMAT, file_digest(input_file), engine_version,
+                        *("{}={!r}".format(name, value) for name, value in sorted(params)))
+
+    def restore(self, key, output_file, metrics_file=None):
+        ''' Puts the cached output for key at output_file (and its metrics,
+        if any, in metrics_file). Returns False on a miss.
+        '''
+        entry = self.directory.lookup(key)
+        if entry is None or not os.path.isfile(os.path.join(entry, self.OUTPUT)):
+            self.misses += 1
+            return False
+        remove_file(output_file)
+        shutil.copyfile(os.path.join(entry, self.OUTPUT), output_file)
+        if metrics_file and os.path.isfile(os.path.join(entry, self.METRICS)):
+            with open(os.path.join(entry, self.METRICS)) as f:
+                metrics = json.load(f)
+            metrics["result_cache"] = "hit"
+            with open(metrics_file, "w") as f:
+                json.dump(metrics, f, indent=2, sort_keys=True)
+        self.hits += 1
+        return True
+
+    def store(self, key, output_file, metrics_file=None):
+        ''' Caches a finished job's output (and metrics file). Returns the
+        entry's path.
+        '''
+        existing = self.directory.lookup(key)
+        if existing is not None:
+            # A recomputed result replaces the cached one.
+            remove_tree(existing)
+
+        def build(directory):
+            cached = os.path.join(directory, self.OUTPUT)
+            shutil.copyfile(output_file, cached)
+            if metrics_file and os.path.isfile(metrics_file):
+                shutil.copyfile(metrics_file, os.path.join(directory, self.METRICS))
+        return self.directory.store(key, build)
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return "Result cache: {} hit(s), {} miss(es){}".format(
+            self.hits, self.misses, " ({:.0%} hits)".format(self.hits / float(lookups)) if lookups else "")
+
+
+def remove_file(file_name):
+    ''' Removes a file if it exists, read-only or not. Windows refuses to
+    remove read-only files, such as the cached outputs and the outputs
+    restored from them by earlier versions.
+    '''
+    if not os.path.lexists(file_name):
+        return
+    try:
+        os.remove(file_name)
+    except PermissionError:
+        os.chmod(file_name, stat.S_IWRITE | stat.S_IREAD)
+        os.remove(file_name)
+
+
+def remove_tree(directory):
+    ''' Removes a directory tree as far as possible, including read-only
+    files.
+    '''
+    def retry(function, name, _):
+        try:
+            os.chmod(name, stat.S_IWRITE | stat.S_IREAD)
+            function(name)
+        except OSError:
+            pass
+    shutil.rmtree(directory, onerror=retry)
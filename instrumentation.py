@@ -0,0 +1,235 @@
+'''
+Per-neighbourhood instrumentation of segmentation runs.
+
+Instrumentation is an IterationLog that also keeps, for every neighbourhood,
+the number of neighbours, the iterations used, the hypotheses rejected by
+the slope gate, the neighbours labelled on the accepted plane and whether a
+plane was found. Every neighbourhood goes into fixed-size histograms; the
+per-point records are kept for every Nth point only, so it can stay on for
+production runs. Optionally a StackSampler samples the call stack of the
+engine (and of its worker processes) at a fixed interval.
+
+The results go to a directory next to the output, <output>.instrumentation:
+
+    point.i8, neighbours.i4, iterations.i4,   headerless per-point columns of
+    slope_rejected.i4, inliers.i4, found.u1   the sampled points (see load)
+    chunk_seconds.f8                          time spent on each chunk
+    histograms.npz                            the histograms, see HISTOGRAMS
+    profile.folded                            sampled stacks, in the folded
+                                              format of flame graph tools
+    summary.json                              counts and settings
+
+    python ransac_engine.py run --lidarFile=in.las --outputFile=out.las --instrumentEvery=100 --profileInterval=10
+'''
+import collections, json, os, sys, threading, time
+
+import numpy as np
+
+import ransac_engine
+
+# Neighbour counts above this share the histograms' last bin.
+MAX_NEIGHBOURS = 1024
+
+# Bins of the histogram of inliers / neighbours.
+RATIO_BINS = 20
+
+# Frames kept per sampled stack, innermost first.
+MAX_DEPTH = 64
+
+# Per-point columns and their on-disk types.
+COLUMNS = [
+    ("point", np.int64),
+    ("neighbours", np.int32),
+    ("iterations", np.int32),
+    ("slope_rejected", np.int32),
+    ("inliers", np.int32),
+    ("found", np.uint8),
+]
+
+# Neighbourhood outcomes counted in the "outcomes" histogram.
+OUTCOMES = ["too_small", "prescreen_planar", "prescreen_rejected", "reused", "ransac_found", "ransac_not_found"]
+
+HISTOGRAMS = {
+    "neighbours": "neighbourhoods by neighbour count (last bin: MAX_NEIGHBOURS or more)",
+    "iterations": "searched or reused neighbourhoods by iterations used",
+    "slope_rejected": "searched neighbourhoods by hypotheses rejected at the slope gate",
+    "inlier_ratio": "neighbourhoods with neighbours by labelled / neighbours, in RATIO_BINS bins",
+    "outcomes": "neighbourhoods by outcome, in the order of summary.json's outcomes",
+    "searched_by_neighbours": "searched neighbourhoods by neighbour count",
+    "iterations_by_neighbours": "iterations used by searched neighbourhoods, by neighbour count",
+    "work_by_neighbours": "neighbours x iterations of searched neighbourhoods, by neighbour count",
+}
+
+
+def output_directory(output_file):
+    return os.path.splitext(output_file)[0] + ".instrumentation"
+
+
+class StackSampler(object):
+    ''' Samples the call stack of a thread (by default the one creating the
+    sampler) every interval seconds from a daemon thread, counting each
+    distinct stack. take() returns the counts so far and starts over.
+    seconds is the time spent sampling, the sampler's own overhead.
+    '''
+    def __init__(self, interval, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            started = time.perf_counter()
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                stack.append("{}:{}".format(os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name))
+                frame = frame.f_back
+            frame = None
+            with self._lock:
+                self.counts[";".join(reversed(stack))] += 1
+                self.samples += 1
+                self.seconds += time.perf_counter() - started
+
+    def take(self):
+        with self._lock:
+            counts, self.counts = self.counts, collections.Counter()
+        return counts
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class Instrumentation(ransac_engine.IterationLog):
+    ''' An IterationLog that writes the instrumentation described above to
+    directory. Records of points whose id is a multiple of every are kept;
+    the histograms cover all neighbourhoods. profile_interval > 0 samples the
+    stacks of this thread and of parallel workers every that many seconds.
+    Chunks may arrive in any order, so the columns are in arrival order.
+    '''
+    def __init__(self, directory, file_name=None, budget=ransac_engine.DEFAULT_PARAMS["iterations"], every=1,
+                 profile_interval=0.0):
+        ransac_engine.IterationLog.__init__(self, file_name, budget)
+        self.directory = directory
+        self.every = max(int(every), 1)
+        self.profile_interval = profile_interval
+        os.makedirs(directory, exist_ok=True)
+        self.columns = dict((name, open(os.path.join(directory, "{}.{}".format(name, np.dtype(kind).str[1:])), "wb"))
+                            for name, kind in COLUMNS + [("chunk_seconds", np.float64)])
+        self.histograms = {
+            "neighbours": np.zeros(MAX_NEIGHBOURS + 1, dtype=np.int64),
+            "slope_rejected": np.zeros(budget + 1, dtype=np.int64),
+            "inlier_ratio": np.zeros(RATIO_BINS, dtype=np.int64),
+            "outcomes": np.zeros(len(OUTCOMES), dtype=np.int64),
+            "searched_by_neighbours": np.zeros(MAX_NEIGHBOURS + 1, dtype=np.int64),
+            "iterations_by_neighbours": np.zeros(MAX_NEIGHBOURS + 1, dtype=np.int64),
+            "work_by_neighbours": np.zeros(MAX_NEIGHBOURS + 1, dtype=np.int64),
+        }
+        self.recorded = 0
+        self.stacks = collections.Counter()
+        self.sampler = StackSampler(profile_interval) if profile_interval > 0 else None
+
+    def __call__(self, point_ids, sizes, iterations, **details):
+        ransac_engine.IterationLog.__call__(self, point_ids, sizes, iterations)
+        stacks = details.pop("stacks", None)
+        if stacks:
+            self.stacks.update(dict(("worker;" + stack, count) for stack, count in stacks.items()))
+        if "seconds" in details:
+            np.float64(details["seconds"]).tofile(self.columns["chunk_seconds"])
+        if "inliers" not in details:
+            return
+        sizes = np.asarray(sizes)
+        slope_rejected, inliers, found = details["slope_rejected"], details["inliers"], details["found"]
+        h = self.histograms
+        capped = np.minimum(sizes, MAX_NEIGHBOURS)
+        h["neighbours"] += np.bincount(capped, minlength=MAX_NEIGHBOURS + 1)
+        searched = iterations > 0
+        h["slope_rejected"] += np.bincount(np.minimum(slope_rejected[searched], self.budget),
+                                           minlength=self.budget + 1)
+        has_neighbours = sizes > 0
+        ratio = inliers[has_neighbours] / sizes[has_neighbours].astype(np.float64)
+        h["inlier_ratio"] += np.bincount(np.minimum((ratio * RATIO_BINS).astype(np.int64), RATIO_BINS - 1),
+                                         minlength=RATIO_BINS)
+        h["outcomes"] += [
+            np.count_nonzero(iterations == ransac_engine.TOO_SMALL),
+            np.count_nonzero(iterations == ransac_engine.SCREENED_PLANAR),
+            np.count_nonzero(iterations == ransac_engine.SCREENED_OUT),
+            np.count_nonzero(iterations == 0),
+            np.count_nonzero(searched & found),
+            np.count_nonzero(searched & ~found),
+        ]
+        bins = capped[searched]
+        h["searched_by_neighbours"] += np.bincount(bins, minlength=MAX_NEIGHBOURS + 1)
+        h["iterations_by_neighbours"] += np.bincount(bins, iterations[searched], MAX_NEIGHBOURS + 1).astype(np.int64)
+        h["work_by_neighbours"] += np.bincount(bins, sizes[searched] * iterations[searched].astype(np.float64),
+                                               MAX_NEIGHBOURS + 1).astype(np.int64)
+
+        keep = np.asarray(point_ids) % self.every == 0
+        values = {"point": point_ids, "neighbours": sizes, "iterations": iterations,
+                  "slope_rejected": slope_rejected, "inliers": inliers, "found": found}
+        for name, kind in COLUMNS:
+            np.asarray(values[name])[keep].astype(kind).tofile(self.columns[name])
+        self.recorded += int(np.count_nonzero(keep))
+
+    def close(self):
+        ransac_engine.IterationLog.close(self)
+        if self.columns is None:
+            return
+        for f in self.columns.values():
+            f.close()
+        self.columns = None
+        sampler_samples, sampler_seconds = 0, 0.0
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.stacks.update(self.sampler.take())
+            sampler_samples, sampler_seconds = self.sampler.samples, self.sampler.seconds
+        if self.stacks:
+            with open(os.path.join(self.directory, "profile.folded"), "w") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write("{} {}\n".format(stack, count))
+        np.savez(os.path.join(self.directory, "histograms.npz"), iterations=self.counts, **self.histograms)
+        chunk_seconds = np.fromfile(os.path.join(self.directory, "chunk_seconds.f8"), dtype=np.float64)
+        summary = {
+            "every": self.every,
+            "recorded": self.recorded,
+            "max_neighbours": MAX_NEIGHBOURS,
+            "ratio_bins": RATIO_BINS,
+            "outcomes": dict(zip(OUTCOMES, self.histograms["outcomes"].tolist())),
+            "iterations": self.summary(),
+            "chunks": {
+                "count": len(chunk_seconds),
+                "seconds": float(chunk_seconds.sum()),
+                "max_seconds": float(chunk_seconds.max()) if len(chunk_seconds) else 0.0,
+            },
+            "profile": {
+                "interval": self.profile_interval,
+                "samples": sum(self.stacks.values()),
+                "sampler_seconds": sampler_seconds,
+                "sampler_samples": sampler_samples,
+            },
+        }
+        with open(os.path.join(self.directory, "summary.json"), "w") as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+
+def load(directory):
+    ''' Reads instrumentation back: a dict of the memory-mapped per-point
+    columns and chunk_seconds, plus "histograms" (a dict by name) and
+    "summary".
+    '''
+    import cache
+    result = dict((name, cache.load_raw(directory, name)) for name, _ in COLUMNS + [("chunk_seconds", None)])
+    with np.load(os.path.join(directory, "histograms.npz")) as histograms:
+        result["histograms"] = dict((name, histograms[name]) for name in histograms.files)
+    with open(os.path.join(directory, "summary.json")) as f:
+        result["summary"] = json.load(f)
+    return result
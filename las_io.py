@@ -0,0 +1,539 @@
+'''
+Memory-mapped LAS reading and writing for the Python segmentation backend.
+
+Point records are exposed as a NumPy structured array mapped straight from
+the file, for point data formats 0-10. Only the fields the segmenter needs
+are interpreted: coordinates, return numbers and classification. Output
+files are a byte copy of the input with the classification field patched.
+
+LAS files inside zip archives (ZipLasMember) are read as streams instead,
+a chunk of records at a time, without extracting them.
+'''
+import os, shutil, struct, zipfile
+
+import numpy as np
+
+# Standard record layouts of point data formats 0-5.
+_BASE_FIELDS = [
+    ("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"),
+    ("intensity", "<u2"),
+    ("return_bits", "u1"),
+    ("classification_bits", "u1"),
+    ("scan_angle_rank", "i1"),
+    ("user_data", "u1"),
+    ("point_source_id", "<u2"),
+]
+_GPS_FIELDS = [("gps_time", "<f8")]
+_RGB_FIELDS = [("red", "<u2"), ("green", "<u2"), ("blue", "<u2")]
+_NIR_FIELDS = [("nir", "<u2")]
+_WAVE_FIELDS = [
+    ("wave_packet_index", "u1"),
+    ("wave_offset", "<u8"),
+    ("wave_size", "<u4"),
+    ("wave_return_location", "<f4"),
+    ("wave_dx", "<f4"), ("wave_dy", "<f4"), ("wave_dz", "<f4"),
+]
+
+# Formats 6-10 widen the return numbers to 4 bits and give classification a
+# byte of its own, with the flag bits moved to a separate byte.
+_EXTENDED_FIELDS = [
+    ("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"),
+    ("intensity", "<u2"),
+    ("return_bits", "u1"),
+    ("flag_bits", "u1"),
+    ("classification_bits", "u1"),
+    ("user_data", "u1"),
+    ("scan_angle", "<i2"),
+    ("point_source_id", "<u2"),
+    ("gps_time", "<f8"),
+]
+
+POINT_FORMAT_FIELDS = {
+    0: _BASE_FIELDS,
+    1: _BASE_FIELDS + _GPS_FIELDS,
+    2: _BASE_FIELDS + _RGB_FIELDS,
+    3: _BASE_FIELDS + _GPS_FIELDS + _RGB_FIELDS,
+    4: _BASE_FIELDS + _GPS_FIELDS + _WAVE_FIELDS,
+    5: _BASE_FIELDS + _GPS_FIELDS + _RGB_FIELDS + _WAVE_FIELDS,
+    6: _EXTENDED_FIELDS,
+    7: _EXTENDED_FIELDS + _RGB_FIELDS,
+    8: _EXTENDED_FIELDS + _RGB_FIELDS + _NIR_FIELDS,
+    9: _EXTENDED_FIELDS + _WAVE_FIELDS,
+    10: _EXTENDED_FIELDS + _RGB_FIELDS + _NIR_FIELDS + _WAVE_FIELDS,
+}
+
+# Points patched per step when writing, bounding the temporary memory.
+WRITE_CHUNK = 1 << 20
+
+
+class LasError(Exception):
+    pass
+
+
+class LasHeader(object):
+    ''' The parts of the public header block needed to locate and decode the
+    point records.
+    '''
+    def __init__(self, raw):
+        if raw[:4] != b"LASF":
+            raise LasError("Not a LAS file (missing LASF signature).")
+        self.raw = raw
+        self.version = (raw[24], raw[25])
+        self.header_size, self.offset_to_points, self.number_of_vlrs = struct.unpack_from("<HII", raw, 94)
+        self.point_format, self.record_length, legacy_count = struct.unpack_from("<BHI", raw, 104)
+        # Bits 6 and 7 flag compressed (LAZ) data.
+        self.point_format &= 0x3F
+        self.scale = np.array(struct.unpack_from("<3d", raw, 131))
+        self.offset = np.array(struct.unpack_from("<3d", raw, 155))
+        max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from("<6d", raw, 179)
+        self.mins = np.array((min_x, min_y, min_z))
+        self.maxs = np.array((max_x, max_y, max_z))
+        self.number_of_points = legacy_count
+        if self.version >= (1, 4) and len(raw) >= 255:
+            count_14 = struct.unpack_from("<Q", raw, 247)[0]
+            if count_14:
+                self.number_of_points = count_14
+
+
+def point_dtype(point_format, record_length):
+    ''' Structured dtype of one point record, with any extra bytes past the
+    standard fields kept as an opaque trailer.
+    '''
+    if point_format not in POINT_FORMAT_FIELDS:
+        raise LasError("Unsupported point data format {}.".format(point_format))
+    dtype = np.dtype(POINT_FORMAT_FIELDS[point_format])
+    if record_length < dtype.itemsize:
+        raise LasError("Point record length {} is too short for format {}.".format(record_length, point_format))
+    if record_length > dtype.itemsize:
+        dtype = np.dtype(POINT_FORMAT_FIELDS[point_format] + [("extra_bytes", "V{}".format(record_length - dtype.itemsize))])
+    return dtype
+
+
+class LasFile(object):
+    ''' A LAS file whose point records are memory-mapped, read-only, as a
+    NumPy structured array. Nothing is read until it is accessed.
+    '''
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, "rb") as f:
+            self.header = LasHeader(f.read(375))
+        self.dtype = point_dtype(self.header.point_format, self.header.record_length)
+        self.extended = self.header.point_format >= 6
+        self.points = map_points(file_name, self.header, self.dtype, "r")
+
+    def __len__(self):
+        return len(self.points)
+
+    def xyz(self, index=slice(None)):
+        ''' Scaled coordinates of the points at index (a slice or an array of
+        point numbers) as an (n, 3) float64 array.
+        '''
+        return decode_xyz(self.points[index], self.header)
+
+    def return_number(self, index=slice(None)):
+        return decode_returns(self.points[index], self.extended)[0]
+
+    def number_of_returns(self, index=slice(None)):
+        return decode_returns(self.points[index], self.extended)[1]
+
+    def classification(self, index=slice(None)):
+        return decode_classification(self.points[index], self.extended)
+
+    def read(self, index=slice(None)):
+        ''' The fields the segmenter uses for the points at index, gathered in
+        one pass: (xyz, classification, return_number, number_of_returns).
+        '''
+        points = self.points[index]
+        return_number, number_of_returns = decode_returns(points, self.extended)
+        return decode_xyz(points, self.header), decode_classification(points, self.extended), return_number, number_of_returns
+
+    def read_quantized(self, index=slice(None)):
+        ''' Like read, but with the coordinates kept as stored: returns
+        (QuantizedPoints, classification, return_number, number_of_returns).
+        Records are read in blocks, so the whole records of all points are
+        never in memory at once.
+        '''
+        source = self.points[index] if isinstance(index, slice) else np.asarray(index)
+        count = len(source)
+        fields = [np.empty(count, dtype=np.int32) for _ in range(3)]
+        classification, return_number, number_of_returns = (np.empty(count, dtype=np.uint8) for _ in range(3))
+        for start in range(0, count, WRITE_CHUNK):
+            stop = min(start + WRITE_CHUNK, count)
+            if isinstance(index, slice):
+                points = np.asarray(source[start:stop])
+            else:
+                points = self.points[source[start:stop]]
+            for i, name in enumerate(("X", "Y", "Z")):
+                fields[i][start:stop] = points[name]
+            classification[start:stop] = decode_classification(points, self.extended)
+            return_number[start:stop], number_of_returns[start:stop] = decode_returns(points, self.extended)
+        xyz = QuantizedPoints(fields[0], fields[1], fields[2], self.header.scale, self.header.offset)
+        return xyz, classification, return_number, number_of_returns
+
+    def write(self, file_name, classification):
+        ''' Writes a byte copy of this file (header, VLRs, points and anything
+        after them) with the classification of every point replaced. Formats
+        0-5 keep their synthetic/key-point/withheld flag bits.
+        '''
+        classification = np.asarray(classification, dtype=np.uint8)
+        if len(classification) != len(self.points):
+            raise LasError("Expected {} classification values, got {}.".format(len(self.points), len(classification)))
+        replace_file(self.file_name, file_name)
+        patch_classification(file_name, classification)
+
+
+def is_zip(file_name):
+    return str(file_name).lower().endswith(".zip") and zipfile.is_zipfile(file_name)
+
+
+def zip_members(archive):
+    ''' Names of the LAS files in a zip archive, in archive order. Members
+    that are not uncompressed LAS files (no LASF signature, or LAZ) are
+    skipped. Only the start of each member is decompressed.
+    '''
+    members = []
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            with zf.open(info) as f:
+                start = f.read(105)
+            if len(start) == 105 and start[:4] == b"LASF" and not start[104] & 0xC0:
+                members.append(info.filename)
+    return members
+
+
+def member_outputs(output_file, members):
+    ''' Output file names for the members of an archive: output_file itself
+    for a single member, <output stem>_<member stem>.las otherwise.
+    '''
+    if len(members) == 1:
+        return [output_file]
+    stem = os.path.splitext(output_file)[0]
+    return ["{}_{}.las".format(stem, os.path.splitext(os.path.basename(member))[0]) for member in members]
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+class ZipLasMember(object):
+    ''' A LAS file inside a zip archive, read as a stream: the header is
+    parsed, then the point records are decoded WRITE_CHUNK at a time straight
+    from the archive, so nothing is extracted to disk and only one chunk of
+    records is in memory. Offers the LasFile methods that read every point
+    in order.
+    '''
+    def __init__(self, archive, member):
+        self.archive = archive
+        self.member = member
+        self.file_name = archive
+        with self.open() as f:
+            start = _read_exact(f, 227)
+            if len(start) < 227:
+                raise LasError("{} in {} is not a LAS file.".format(member, archive))
+            offset_to_points = struct.unpack_from("<I", start, 96)[0]
+            # The header and VLRs, copied verbatim into outputs.
+            self.prefix = start + _read_exact(f, max(offset_to_points - len(start), 0))
+        self.header = LasHeader(self.prefix[:375])
+        self.dtype = point_dtype(self.header.point_format, self.header.record_length)
+        self.extended = self.header.point_format >= 6
+
+    def open(self):
+        ''' The member as a binary stream.
+        '''
+        with zipfile.ZipFile(self.archive) as zf:
+            return zf.open(self.member)
+
+    def __len__(self):
+        return self.header.number_of_points
+
+    def _blocks(self, stream):
+        ''' Yields (start, records) for every chunk of point records of an
+        open stream past the prefix. records reuses one buffer.
+        '''
+        buffer = np.empty(min(WRITE_CHUNK, max(len(self), 1)), dtype=self.dtype)
+        raw = memoryview(buffer.view(np.uint8))
+        for start in range(0, len(self), WRITE_CHUNK):
+            count = min(WRITE_CHUNK, len(self) - start)
+            size = count * self.dtype.itemsize
+            filled = 0
+            while filled < size:
+                read = stream.readinto(raw[filled:size])
+                if not read:
+                    raise LasError("{} in {} is truncated: expected {} points, found {}.".format(
+                        self.member, self.archive, len(self), start + filled // self.dtype.itemsize))
+                filled += read
+            yield start, buffer[:count]
+
+    def _records(self):
+        with self.open() as f:
+            _read_exact(f, len(self.prefix))
+            for block in self._blocks(f):
+                yield block
+
+    def read_quantized(self, index=slice(None)):
+        ''' Like LasFile.read_quantized, for all points only.
+        '''
+        if not (isinstance(index, slice) and index == slice(None)):
+            raise LasError("Points inside zip archives can only be read in order.")
+        count = len(self)
+        fields = [np.empty(count, dtype=np.int32) for _ in range(3)]
+        classification, return_number, number_of_returns = (np.empty(count, dtype=np.uint8) for _ in range(3))
+        for start, points in self._records():
+            stop = start + len(points)
+            for i, name in enumerate(("X", "Y", "Z")):
+                fields[i][start:stop] = points[name]
+            classification[start:stop] = decode_classification(points, self.extended)
+            return_number[start:stop], number_of_returns[start:stop] = decode_returns(points, self.extended)
+        xyz = QuantizedPoints(fields[0], fields[1], fields[2], self.header.scale, self.header.offset)
+        return xyz, classification, return_number, number_of_returns
+
+    def read(self, index=slice(None)):
+        xyz, classification, return_number, number_of_returns = self.read_quantized(index)
+        return xyz[:], classification, return_number, number_of_returns
+
+    def classification(self, index=slice(None)):
+        return self.read_quantized(index)[1]
+
+    def write(self, file_name, classification):
+        ''' Like LasFile.write: streams the member into file_name, an
+        uncompressed LAS file, with the classification replaced.
+        '''
+        classification = np.asarray(classification, dtype=np.uint8)
+        if len(classification) != len(self):
+            raise LasError("Expected {} classification values, got {}.".format(len(self), len(classification)))
+        if os.path.lexists(file_name):
+            os.remove(file_name)
+        with self.open() as source, open(file_name, "wb") as target:
+            target.write(_read_exact(source, len(self.prefix)))
+            for start, records in self._blocks(source):
+                records["classification_bits"] = encode_classification(
+                    records["classification_bits"], classification[start:start + len(records)], self.extended)
+                target.write(records.tobytes())
+            # Anything after the points, such as extended VLRs.
+            shutil.copyfileobj(source, target)
+
+
+def open_las(file_name, member=None):
+    ''' A LasFile, or the ZipLasMember named member of a zip archive.
+    '''
+    return LasFile(file_name) if member is None else ZipLasMember(file_name, member)
+
+
+class QuantizedPoints(object):
+    ''' Coordinates stored the way LAS stores them: int32 X, Y and Z arrays
+    (structure of arrays, 12 bytes a point) with the header's scale and
+    offset. Indexing decodes rows to float64 (k, 3) arrays, like an (n, 3)
+    coordinate array; local() gives float32 offsets from center points.
+    '''
+    def __init__(self, X, Y, Z, scale, offset):
+        self.X, self.Y, self.Z = X, Y, Z
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.X)
+
+    def __getitem__(self, rows):
+        x = self.X[rows]
+        xyz = np.empty((len(x), 3))
+        xyz[:, 0] = x * self.scale[0] + self.offset[0]
+        xyz[:, 1] = self.Y[rows] * self.scale[1] + self.offset[1]
+        xyz[:, 2] = self.Z[rows] * self.scale[2] + self.offset[2]
+        return xyz
+
+    def take(self, rows):
+        ''' The points at rows, as a new QuantizedPoints.
+        '''
+        return QuantizedPoints(self.X[rows], self.Y[rows], self.Z[rows], self.scale, self.offset)
+
+    def local(self, rows, centers, out=None):
+        ''' Offsets of the points at rows from the points at centers, both
+        row arrays of the same length, as float32 (k, 3). The integer
+        differences are exact, so only the final scaling rounds.
+        '''
+        if out is None:
+            out = np.empty((len(rows), 3), dtype=np.float32)
+        for i, field in enumerate((self.X, self.Y, self.Z)):
+            out[:, i] = (field[rows].astype(np.int64) - field[centers]) * self.scale[i]
+        return out
+
+    @property
+    def nbytes(self):
+        return self.X.nbytes + self.Y.nbytes + self.Z.nbytes
+
+
+def replace_file(source, destination):
+    ''' Copies source to a new file at destination. An existing destination
+    is removed first instead of being overwritten in place, as it may be a
+    read-only hard link into the result cache made by an earlier version.
+    '''
+    if os.path.lexists(destination) and not os.path.samefile(source, destination):
+        os.remove(destination)
+    shutil.copyfile(source, destination)
+
+
+def decode_xyz(points, header):
+    xyz = np.empty((len(points), 3))
+    for i, name in enumerate(("X", "Y", "Z")):
+        xyz[:, i] = points[name] * header.scale[i] + header.offset[i]
+    return xyz
+
+
+def decode_returns(points, extended):
+    ''' (return_number, number_of_returns) of a block of point records.
+    '''
+    bits = points["return_bits"]
+    if extended:
+        return bits & 0x0F, bits >> 4
+    return bits & 0x07, (bits >> 3) & 0x07
+
+
+def decode_classification(points, extended):
+    bits = points["classification_bits"]
+    return np.array(bits) if extended else bits & 0x1F
+
+
+def map_points(file_name, header, dtype, mode):
+    ''' Memory-maps the point records of a LAS file without copying them.
+    '''
+    count = header.number_of_points
+    available = (os.path.getsize(file_name) - header.offset_to_points) // dtype.itemsize
+    if available < count:
+        raise LasError("{} is truncated: expected {} points, found {}.".format(file_name, count, available))
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file_name, dtype=dtype, mode=mode, offset=header.offset_to_points, shape=(count,))
+
+
+class ClassificationWriter(object):
+    ''' Overwrites the classification field of an existing LAS file in place
+    through a read-write memory map.
+    '''
+    def __init__(self, file_name):
+        with open(file_name, "rb") as f:
+            self.header = LasHeader(f.read(375))
+        dtype = point_dtype(self.header.point_format, self.header.record_length)
+        self.points = map_points(file_name, self.header, dtype, "r+")
+        self.field = self.points["classification_bits"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def set(self, index, classification):
+        ''' Sets the classification of the points at index (a slice or an
+        array of point numbers).
+        '''
+        self.field[index] = encode_classification(self.field[index], classification, self.header.point_format >= 6)
+
+    def close(self):
+        if isinstance(self.points, np.memmap):
+            self.points.flush()
+        self.field = self.points = None
+
+
+def encode_classification(bits, classification, extended):
+    ''' The classification bytes of point records with the classification
+    replaced; formats 0-5 keep their flag bits.
+    '''
+    if extended:
+        return np.asarray(classification, dtype=np.uint8)
+    return (bits & 0xE0) | (np.asarray(classification, dtype=np.uint8) & 0x1F)
+
+
+def patch_classification(file_name, classification):
+    ''' Overwrites the classification field of every point of an existing LAS
+    file in place.
+    '''
+    with ClassificationWriter(file_name) as writer:
+        for start in range(0, len(classification), WRITE_CHUNK):
+            index = slice(start, start + WRITE_CHUNK)
+            writer.set(index, classification[index])
+
+
+class LasWriter(object):
+    ''' Streams point records into a new LAS file: LAS 1.2 for point formats
+    0-3 and LAS 1.4 for formats 6-8. The header's point counts and bounds are
+    filled in by close().
+    '''
+    def __init__(self, file_name, point_format, scale=(0.001, 0.001, 0.001), offset=(0.0, 0.0, 0.0)):
+        if point_format in (0, 1, 2, 3):
+            self.version, self.header_size = (1, 2), 227
+        elif point_format in (6, 7, 8):
+            self.version, self.header_size = (1, 4), 375
+        else:
+            raise LasError("Writing point data format {} is not supported.".format(point_format))
+        self.point_format = point_format
+        self.dtype = point_dtype(point_format, np.dtype(POINT_FORMAT_FIELDS[point_format]).itemsize)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.count = 0
+        self.returns = np.zeros(15, dtype=np.int64)
+        self.mins = np.full(3, np.inf)
+        self.maxs = np.full(3, -np.inf)
+        self.file = open(file_name, "wb")
+        self.file.write(b"\0" * self.header_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def empty(self, count):
+        ''' A zeroed block of count point records to fill in and write.
+        '''
+        return np.zeros(count, dtype=self.dtype)
+
+    def set_xyz(self, points, xyz):
+        ''' Stores scaled coordinates in the integer X, Y, Z fields.
+        '''
+        for i, name in enumerate(("X", "Y", "Z")):
+            points[name] = np.round((xyz[:, i] - self.offset[i]) / self.scale[i])
+
+    def write(self, points):
+        if len(points) == 0:
+            return
+        xyz = decode_xyz(points, self)
+        self.mins = np.minimum(self.mins, xyz.min(axis=0))
+        self.maxs = np.maximum(self.maxs, xyz.max(axis=0))
+        return_number = decode_returns(points, self.point_format >= 6)[0]
+        self.returns += np.bincount(np.clip(return_number, 1, 15) - 1, minlength=15)
+        points.astype(self.dtype, copy=False).tofile(self.file)
+        self.count += len(points)
+
+    def close(self):
+        if self.file is None:
+            return
+        if not self.count:
+            self.mins = self.maxs = np.zeros(3)
+        header = bytearray(self.header_size)
+        header[0:4] = b"LASF"
+        header[24], header[25] = self.version
+        header[26:58] = b"ransac_engine".ljust(32, b"\0")
+        header[58:90] = b"las_io.LasWriter".ljust(32, b"\0")
+        struct.pack_into("<HII", header, 94, self.header_size, self.header_size, 0)
+        legacy = self.point_format < 6 and self.count < 2 ** 32
+        struct.pack_into("<BHI", header, 104, self.point_format, self.dtype.itemsize, self.count if legacy else 0)
+        struct.pack_into("<5I", header, 111, *[int(n) if legacy and n < 2 ** 32 else 0 for n in self.returns[:5]])
+        struct.pack_into("<3d", header, 131, *self.scale)
+        struct.pack_into("<3d", header, 155, *self.offset)
+        struct.pack_into("<6d", header, 179, self.maxs[0], self.mins[0], self.maxs[1], self.mins[1],
+                         self.maxs[2], self.mins[2])
+        if self.version == (1, 4):
+            struct.pack_into("<Q", header, 247, self.count)
+            struct.pack_into("<15Q", header, 255, *[int(n) for n in self.returns])
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.close()
+        self.file = None
@@ -0,0 +1,193 @@
+'''
+Multi-core segmentation of one cloud on a pool of worker processes.
+
+The filtered coordinates, the neighbour search index, the query order, the
+point ids and the output labels live in shared memory blocks that every
+worker maps, so no point data is pickled: a task is just the number of its
+first query, and it returns only iteration counts. Neighbourhoods read from
+the cache are memory mapped by the workers straight from the cache entry.
+
+Tasks are CHUNK_SIZE consecutive queries of the spatially ordered query
+list, hypotheses are seeded per point and the seeded search shares models
+within a chunk only, so the labels are the same as a single-process run
+whatever the number of workers and the order the chunks finish in.
+'''
+import os
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+import las_io
+import ransac_engine
+
+
+class SharedArrays(object):
+    ''' NumPy arrays in named shared memory blocks, by name. The owning
+    process adds arrays with create() and finally calls close(unlink=True);
+    workers map the same blocks with attach(spec) using the picklable spec.
+    '''
+    def __init__(self):
+        self.arrays = {}
+        self.spec = {}
+        self.blocks = []
+
+    def create(self, name, array):
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[...] = array
+        self.arrays[name] = shared
+        self.spec[name] = (block.name, array.shape, array.dtype.str)
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        self = cls()
+        for name, (block_name, shape, dtype) in spec.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            self.blocks.append(block)
+            self.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        self.spec = dict(spec)
+        return self
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self, unlink=False):
+        # Views must be released before their blocks can be closed.
+        self.arrays = {}
+        for block in self.blocks:
+            block.close()
+            if unlink:
+                block.unlink()
+        self.blocks = []
+
+
+class SharedNeighbourhoods(object):
+    ''' A ransac_engine.Neighbourhoods rebuilt from shared arrays, with the
+    same chunk interface.
+    '''
+    def __init__(self, shared, radius):
+        if "xyz" in shared.arrays:
+            self.xyz = shared["xyz"]
+        else:
+            self.xyz = las_io.QuantizedPoints(shared["X"], shared["Y"], shared["Z"], *shared["quantization"])
+        self.tree_rows = shared["tree_rows"]
+        self.query_rows = shared["query_rows"]
+        self.index = ransac_engine.RadiusIndex.from_arrays(
+            self.xyz, radius, dict((name, shared["index_" + name]) for name in ransac_engine.RadiusIndex.ARRAYS),
+            self.tree_rows)
+
+    def __len__(self):
+        return len(self.query_rows)
+
+    def chunk(self, start, stop):
+        rows = self.query_rows[start:stop]
+        offsets, indices = self.index.query(self.xyz[rows])
+        return rows, offsets, self.tree_rows[indices]
+
+
+def share_neighbourhoods(nb, shared):
+    ''' Copies the arrays of a Neighbourhoods into shared memory. Returns
+    what a worker needs to open them: ("shared", radius).
+    '''
+    if isinstance(nb.xyz, las_io.QuantizedPoints):
+        for name in ("X", "Y", "Z"):
+            shared.create(name, getattr(nb.xyz, name))
+        shared.create("quantization", np.array([nb.xyz.scale, nb.xyz.offset]))
+    else:
+        shared.create("xyz", nb.xyz)
+    shared.create("tree_rows", nb.tree_rows)
+    shared.create("query_rows", nb.query_rows)
+    for name in ransac_engine.RadiusIndex.ARRAYS:
+        shared.create("index_" + name, np.asarray(getattr(nb.index, name)))
+    return ("shared", nb.index.radius)
+
+
+# Per-process state of the workers, set by _init_worker.
+_worker = {}
+
+
+def _init_worker(spec, source, params, seed, profile_interval=0.0):
+    shared = SharedArrays.attach(spec)
+    _worker["shared"] = shared
+    if source[0] == "shared":
+        _worker["nb"] = SharedNeighbourhoods(shared, source[1])
+    else:
+        import cache
+        _worker["nb"] = cache.StoredNeighbourhoods(source[1])
+    _worker["params"] = params
+    _worker["seed"] = seed
+    _worker["sampler"] = None
+    if profile_interval > 0:
+        import instrumentation
+        _worker["sampler"] = instrumentation.StackSampler(profile_interval)
+
+
+def _label_chunk(start):
+    ''' Labels one chunk into the shared planar array. Returns (center ids,
+    neighbourhood sizes, iterations used, details) for the iteration log.
+    '''
+    shared = _worker["shared"]
+    planar_rows, center_ids, sizes, used, details = ransac_engine.label_chunk(
+        _worker["nb"], start, shared["row_ids"], _worker["params"], _worker["seed"])
+    # Every writer stores the same value, so overlapping chunks need no lock.
+    shared["planar"][planar_rows] = 1
+    if _worker["sampler"] is not None:
+        details["stacks"] = _worker["sampler"].take()
+    return start, center_ids, sizes, used, details
+
+
+def label_parallel(nb, row_ids, params, seed, workers, progress=None, iteration_log=None):
+    ''' Runs ransac_engine.label_chunk over all chunks of nb on a pool of
+    workers. Returns the boolean planar mask over nb's rows. If
+    iteration_log samples stacks (see instrumentation.Instrumentation), the
+    workers sample theirs too and send them along with their chunks.
+    '''
+    shared = SharedArrays()
+    try:
+        if hasattr(nb, "directory"):
+            source = ("stored", nb.directory)
+        else:
+            source = share_neighbourhoods(nb, shared)
+        shared.create("row_ids", row_ids)
+        planar = shared.create("planar", np.zeros(len(nb.xyz), dtype=np.uint8))
+        chunks = range(0, len(nb), ransac_engine.CHUNK_SIZE)
+        done = 0
+        profile_interval = getattr(iteration_log, "profile_interval", 0.0)
+        initargs = (shared.spec, source, params, seed, profile_interval)
+        with Pool(min(workers, len(chunks)), _init_worker, initargs) as pool:
+            for start, center_ids, sizes, used, details in pool.imap_unordered(_label_chunk, chunks):
+                done += min(ransac_engine.CHUNK_SIZE, len(nb) - start)
+                if iteration_log is not None:
+                    iteration_log(center_ids, sizes, used, **details)
+                if progress is not None:
+                    progress("Iterating through each neighbourhood", done, len(nb))
+        return planar.astype(bool)
+    finally:
+        planar = None
+        shared.close(unlink=True)
+
+
+def physical_cores():
+    ''' Best guess at the number of physical cores, for the default worker
+    count: hyperthreads rarely help a NumPy-bound workload.
+    '''
+    try:
+        with open("/proc/cpuinfo") as f:
+            cores = set()
+            physical = core = None
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "physical id":
+                    physical = value.strip()
+                elif key == "core id":
+                    core = value.strip()
+                    cores.add((physical, core))
+            if cores:
+                return len(cores)
+    except OSError:
+        pass
+    return os.cpu_count() or 1
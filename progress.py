@@ -0,0 +1,207 @@
+'''
+Structured progress and stage timing for segmentation runs.
+
+The engine reports progress as JSON lines, one event per line, on a stream
+of its own (stderr when run with --progress=json), leaving stdout for the
+human-readable log. Events look like:
+
+    {"type": "progress", "stage": "ransac", "label": "...", "done": 4096, "total": 20000,
+     "rate": 1234.5, "eta": 12.9, "elapsed": 3.3}
+    {"type": "stage", "stage": "ransac", "wall": 16.2, "cpu": 16.0, "points": 20000}
+    {"type": "done", "wall": 20.1, "cpu": 19.5, "points": 20000, "stages": {...}}
+
+Stages are "read" (reading and filtering), "index" (neighbourhood search
+structure), "ransac" and "write". The final metrics are also written to a
+per-run JSON file when one is given.
+
+TextProgressAdapter turns the free-text output of the compiled Ransac_seg
+tool into the same events, without CPU times.
+'''
+import json, time
+
+STAGES = ("read", "index", "ransac", "write")
+
+# Minimum seconds between two progress events of the same stage.
+MIN_INTERVAL = 0.2
+
+
+def _clock():
+    return time.perf_counter(), time.process_time()
+
+
+def make_progress(stage, label, done, total, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0.0
+    eta = (total - done) / rate if rate > 0 else None
+    return {"type": "progress", "stage": stage, "label": label, "done": int(done), "total": int(total),
+            "rate": rate, "eta": eta, "elapsed": elapsed}
+
+
+class _Stage(object):
+    def __init__(self, reporter, name):
+        self.reporter = reporter
+        self.name = name
+
+    def __enter__(self):
+        self.reporter.begin(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.reporter.end()
+
+
+class ProgressReporter(object):
+    ''' Times the stages of a run and reports its progress.
+
+    Use "with reporter.stage(name):" around each stage and pass the reporter
+    as the progress(label, done, total) callback of the engine. Progress is
+    printed as "<label>: <n>%" text lines when text is True and sent as JSON
+    events to json_stream when one is given.
+    '''
+    def __init__(self, json_stream=None, text=True):
+        self.json_stream = json_stream
+        self.text = text
+        self.started = _clock()
+        self.stages = {}
+        self.points = 0
+        self.current = None
+        self.stage_started = None
+        self.last_event = 0.0
+        self.last_percent = None
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def begin(self, name):
+        self.current = name
+        self.stage_started = _clock()
+        self.last_event = 0.0
+        self.last_percent = None
+
+    def end(self):
+        wall, cpu = _clock()
+        timing = self.stages.setdefault(self.current, {"wall": 0.0, "cpu": 0.0})
+        timing["wall"] += wall - self.stage_started[0]
+        timing["cpu"] += cpu - self.stage_started[1]
+        self.emit({"type": "stage", "stage": self.current, "wall": timing["wall"], "cpu": timing["cpu"],
+                   "points": self.points})
+        self.current = None
+
+    def __call__(self, label, done, total):
+        if self.text:
+            percent = (label, int(100.0 * done / total) if total else 100)
+            if percent != self.last_percent:
+                self.last_percent = percent
+                print("{}: {}%".format(*percent), flush=True)
+        now = time.perf_counter()
+        if self.json_stream is not None and (done >= total or now - self.last_event >= MIN_INTERVAL):
+            self.last_event = now
+            start = self.stage_started[0] if self.stage_started else self.started[0]
+            self.emit(make_progress(self.current, label, done, total, now - start))
+
+    def emit(self, event):
+        if self.json_stream is not None:
+            self.json_stream.write(json.dumps(event) + "\n")
+            self.json_stream.flush()
+
+    def metrics(self, **extra):
+        wall, cpu = _clock()
+        result = {"wall": wall - self.started[0], "cpu": cpu - self.started[1], "points": self.points,
+                  "stages": self.stages}
+        ransac = self.stages.get("ransac")
+        if ransac and ransac["wall"] > 0:
+            result["points_per_second"] = self.points / ransac["wall"]
+        result.update(extra)
+        return result
+
+    def finish(self, metrics_file=None, **extra):
+        ''' Sends the "done" event and writes the metrics file, if any.
+        Returns the metrics.
+        '''
+        result = self.metrics(**extra)
+        self.emit(dict(result, type="done"))
+        if metrics_file:
+            write_metrics(metrics_file, result)
+        return result
+
+
+def write_metrics(file_name, metrics):
+    with open(file_name, "w") as f:
+        json.dump(metrics, f, indent=2, sort_keys=True)
+
+
+def parse_event(line):
+    ''' The event encoded in a JSON progress line, or None for anything else.
+    '''
+    line = line.strip()
+    if not line.startswith("{"):
+        return None
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    return event if isinstance(event, dict) and "type" in event else None
+
+
+def parse_percent(line):
+    ''' Returns (label, percent) for text progress lines such as
+    "Outputting Data: 42%", or None for ordinary log lines.
+    '''
+    parts = line.rsplit(" ", 1)
+    if len(parts) != 2 or not parts[1].endswith("%"):
+        return None
+    try:
+        return parts[0].strip(), float(parts[1][:-1])
+    except ValueError:
+        return None
+
+
+class TextProgressAdapter(object):
+    ''' Derives progress events and stage wall times from the text output of
+    the compiled Ransac_seg tool. feed(line) returns an event or None.
+    '''
+    LABEL_STAGES = {
+        "Reading input data & creating point/values array:": "read",
+        "Iterating through each neighbourhood:": "ransac",
+        "Outputting Data:": "write",
+    }
+    INDEX_START = "building Kdtree"
+    INDEX_END = "Tree Complete"
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.current = None
+        self.stage_started = None
+
+    def _switch(self, name):
+        now = time.perf_counter()
+        if self.current is not None:
+            self.stages[self.current] = {"wall": now - self.stage_started, "cpu": None}
+        self.current = name
+        self.stage_started = now
+
+    def feed(self, line):
+        line = line.strip()
+        if self.INDEX_START in line:
+            self._switch("index")
+            return None
+        if self.INDEX_END in line:
+            self._switch(None)
+            return None
+        parsed = parse_percent(line)
+        if parsed is None:
+            return None
+        label, percent = parsed
+        stage = self.LABEL_STAGES.get(label, label.rstrip(":"))
+        if stage != self.current:
+            self._switch(stage)
+        event = make_progress(stage, label.rstrip(":"), percent, 100, time.perf_counter() - self.stage_started)
+        # Only percentages are known, not point counts.
+        event["rate"] = None
+        return event
+
+    def metrics(self, **extra):
+        self._switch(None)
+        result = {"wall": time.perf_counter() - self.started, "cpu": None, "stages": self.stages}
+        result.update(extra)
+        return result
@@ -0,0 +1,1330 @@
+'''
+NumPy implementation of the RANSAC plane segmentation in RANSAC_Seg.
+
+It follows the same steps as the compiled tool (noise and intermediate return
+filtering, radius neighbourhoods, sampled plane hypotheses with a slope gate,
+inlier refits and the center point containment test) but evaluates all
+hypotheses of a neighbourhood, and many neighbourhoods, as batched array
+operations. It accepts the same command line as the Ransac_seg executable:
+
+    python ransac_engine.py run --lidarFile=in.las --outputFile=out.las --searchDist=1.5
+'''
+import argparse, sys, time
+
+import numpy as np
+
+import las_io
+import progress
+
+# ASPRS classes used by the segmenter.
+NEVER_CLASSIFIED = 0
+UNCLASSIFIED = 1
+LOW_POINT = 7
+HIGH_NOISE = 18
+
+DEFAULT_PARAMS = {
+    "searchDist": 1.5,
+    "iterations": 50,
+    "threshold": 0.15,
+    "maxSlope": 75.0,
+    "numSamples": 5,
+    "acceptableModelSize": 10,
+    # Python backend only. confidence > 0 enables adaptive RANSAC, which stops
+    # a neighbourhood's search once an all-inlier sample has been drawn with
+    # this probability; iterations is then the upper limit.
+    "confidence": 0.0,
+    "sampling": "uniform",
+    "scoring": "rmse",
+    # "seeded" first tries planes accepted at nearby points before running a
+    # full search (see label_neighbourhoods).
+    "search": "exhaustive",
+    # "on" settles clearly planar and clearly scattered or linear
+    # neighbourhoods from their covariance alone (see prescreen).
+    "prescreen": "off",
+    "minPlanarity": 0.5,
+    "maxScattering": 0.3,
+    "maxLinearity": 0.95,
+    # voxelSize > 0 draws and scores hypotheses on each neighbourhood reduced
+    # to a grid of cubes of this size, and labels the full neighbourhood only
+    # with the winning plane (see voxel_neighbourhoods).
+    "voxelSize": 0.0,
+}
+
+# Allowed values of the string parameters. "prosac" samples the nearest
+# neighbours first; "msac" ranks models by truncated quadratic loss rather
+# than by the RMSE of their refit.
+PARAM_CHOICES = {
+    "sampling": ("uniform", "prosac"),
+    "scoring": ("rmse", "msac"),
+    "search": ("exhaustive", "seeded"),
+    "prescreen": ("off", "on"),
+}
+
+# Iterations drawn and scored at once in adaptive mode.
+ADAPTIVE_BLOCK = 8
+
+# Iterations over which PROSAC sampling grows to the whole neighbourhood.
+PROSAC_GROWTH = 20
+
+# Seeded search: centers fully searched between two rounds of model reuse,
+# and how much worse than the cached plane's RMSE a reused plane may fit.
+SEED_WAVE = 256
+SEED_RMSE_RATIO = 1.5
+
+# Iteration counts reported for neighbourhoods that RANSAC never saw: too
+# small to fit, labelled planar by the pre-screen, or rejected by it.
+TOO_SMALL = -1
+SCREENED_PLANAR = -2
+SCREENED_OUT = -3
+
+# Maximum number of (hypothesis, neighbour) residuals evaluated in one batched
+# call. Bounds the temporary memory of a batch to a few hundred MB.
+BATCH_BUDGET = 1 << 22
+
+# Number of query points whose neighbourhoods are gathered at once.
+CHUNK_SIZE = 4096
+
+
+def resolve_params(params):
+    ''' Fills in defaults and checks for unknown parameter names.
+    '''
+    unknown = set(params) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError("Unknown parameter(s): {}".format(", ".join(sorted(unknown))))
+    resolved = dict(DEFAULT_PARAMS)
+    resolved.update(params)
+    for name, choices in PARAM_CHOICES.items():
+        if resolved[name] not in choices:
+            raise ValueError("{} must be one of {}, got '{}'.".format(name, ", ".join(choices), resolved[name]))
+    if not 0.0 <= resolved["confidence"] < 1.0:
+        raise ValueError("confidence must be in [0, 1), got {}.".format(resolved["confidence"]))
+    if resolved["voxelSize"] < 0:
+        raise ValueError("voxelSize must not be negative, got {}.".format(resolved["voxelSize"]))
+    return resolved
+
+
+def filter_points(classification, return_number, number_of_returns):
+    ''' Returns (candidates, last_only): points that are not low or high noise,
+    and the subset of those that are last (or only) returns.
+    '''
+    candidates = (classification != LOW_POINT) & (classification != HIGH_NOISE)
+    last_only = candidates & (return_number == number_of_returns)
+    return candidates, last_only
+
+
+def index_type(count):
+    ''' The smallest integer type that can index count items.
+    '''
+    return np.dtype(np.int32 if count < 2 ** 31 else np.int64)
+
+
+class RadiusIndex(object):
+    ''' Fixed-radius neighbour search over a uniform grid with cells one search
+    distance wide, so every neighbour of a point lies in the 27 surrounding
+    cells. Stands in for the kd-tree withinRadius query.
+
+    points is an (n, 3) array or anything indexed like one, such as
+    las_io.QuantizedPoints. With rows, only those points are indexed, without
+    copying them, and query results are positions in rows.
+    '''
+    def __init__(self, points, radius, rows=None):
+        if not hasattr(points, "local"):
+            points = np.asarray(points, dtype=np.float64)
+        self.points = points
+        self.rows = rows
+        self.radius = float(radius)
+        count = len(points) if rows is None else len(rows)
+        if count:
+            # Points are read block by block, so a quantized working set is
+            # never decoded whole.
+            blocks = [(start, min(start + las_io.WRITE_CHUNK, count)) for start in range(0, count, las_io.WRITE_CHUNK)]
+            bounds = np.array([(block.min(axis=0), block.max(axis=0))
+                               for block in (self._coords(np.arange(*b)) for b in blocks)])
+            self.origin = bounds[:, 0].min(axis=0)
+            # floor is monotonic, so the largest cell is that of the largest
+            # coordinates.
+            self.dims = self._cells(bounds[:, 1].max(axis=0)[None])[0] + 1
+            keys = np.concatenate([self._keys(self._cells(self._coords(np.arange(*b)))) for b in blocks])
+        else:
+            self.origin = np.zeros(3)
+            self.dims = np.ones(3, dtype=np.int64)
+            keys = np.zeros(0, dtype=np.int64)
+        self.order = np.argsort(keys, kind="stable").astype(index_type(count))
+        self.cell_keys, self.cell_start, self.cell_count = np.unique(
+            keys[self.order], return_index=True, return_counts=True)
+
+    # The arrays that make up an index besides its points, for rebuilding it
+    # from shared memory.
+    ARRAYS = ("origin", "dims", "order", "cell_keys", "cell_start", "cell_count")
+
+    @classmethod
+    def from_arrays(cls, points, radius, arrays, rows=None):
+        ''' An index made of existing arrays (a dict with the names in ARRAYS)
+        without copying them.
+        '''
+        index = cls.__new__(cls)
+        index.points = points
+        index.rows = rows
+        index.radius = float(radius)
+        for name in cls.ARRAYS:
+            setattr(index, name, arrays[name])
+        return index
+
+    def _coords(self, positions):
+        return self.points[positions if self.rows is None else self.rows[positions]]
+
+    def _cells(self, points):
+        return np.floor((points - self.origin) / self.radius).astype(np.int64)
+
+    def _keys(self, cells):
+        return (cells[:, 2] * self.dims[1] + cells[:, 1]) * self.dims[0] + cells[:, 0]
+
+    def query(self, queries):
+        ''' Neighbours within the search radius of each query point, in CSR
+        form: the neighbours of query q are indices[offsets[q]:offsets[q + 1]],
+        sorted by distance (then index), like withinRadius(sortResults=true).
+        '''
+        queries = np.asarray(queries, dtype=np.float64)
+        nq = len(queries)
+        if nq == 0 or len(self.cell_keys) == 0:
+            return np.zeros(nq + 1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        qcells = self._cells(queries)
+        starts = []
+        counts = []
+        for dz in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    cells = qcells + (dx, dy, dz)
+                    inside = np.all((cells >= 0) & (cells < self.dims), axis=1)
+                    keys = self._keys(np.where(inside[:, None], cells, 0))
+                    pos = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+                    hit = inside & (self.cell_keys[pos] == keys)
+                    starts.append(self.cell_start[pos])
+                    counts.append(np.where(hit, self.cell_count[pos], 0))
+        starts = np.stack(starts, axis=1).ravel()
+        counts = np.stack(counts, axis=1).ravel()
+        owner = np.repeat(np.arange(nq), 27)
+
+        # Expand each (query, cell) pair into its run of candidate points.
+        total = counts.sum()
+        run_start = np.cumsum(counts) - counts
+        sorted_pos = np.repeat(starts - run_start, counts) + np.arange(total)
+        candidates = self.order[sorted_pos]
+        owner = np.repeat(owner, counts)
+
+        d2 = np.sum((self._coords(candidates) - queries[owner]) ** 2, axis=1)
+        keep = d2 <= self.radius * self.radius
+        candidates, owner, d2 = candidates[keep], owner[keep], d2[keep]
+        order = np.lexsort((candidates, d2, owner))
+        offsets = np.zeros(nq + 1, dtype=np.int64)
+        np.cumsum(np.bincount(owner, minlength=nq), out=offsets[1:])
+        return offsets, candidates[order]
+
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def _splitmix64(x):
+    z = x + _GOLDEN
+    z = (z ^ (z >> np.uint64(30))) * _MIX1
+    z = (z ^ (z >> np.uint64(27))) * _MIX2
+    return z ^ (z >> np.uint64(31))
+
+
+def sample_indices(seed, point_ids, sizes, iterations, num_samples, first=0):
+    ''' Random sample positions, shape (len(point_ids), iterations, num_samples),
+    each drawn uniformly from 0..n-1 like rand(n-1) in RANSAC_Seg. sizes is
+    either n per point or, to draw from a growing prefix of the neighbours,
+    n per point and iteration.
+
+    Draws come from a counter-based hash of (seed, point id, draw number), so
+    a point gets the same hypotheses however the points are batched, ordered
+    or split between processes. first skips the draws of earlier iterations.
+    '''
+    with np.errstate(over="ignore"):
+        keys = _splitmix64(np.uint64(seed) ^ _splitmix64(np.asarray(point_ids, dtype=np.uint64)))
+        counters = np.arange(first * num_samples, (first + iterations) * num_samples, dtype=np.uint64)
+        bits = _splitmix64(keys[:, None] + counters[None, :])
+    uniform = (bits >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+    uniform = uniform.reshape(len(keys), iterations, num_samples)
+    sizes = np.asarray(sizes, dtype=np.float64)
+    sizes = sizes[:, None, None] if sizes.ndim == 1 else sizes[:, :, None]
+    return (uniform * sizes).astype(np.int64)
+
+
+def prosac_sizes(sizes, num_samples, iterations, first=0):
+    ''' Number of nearest neighbours sampled from in each iteration of
+    PROSAC-style guided sampling, shape (len(sizes), iterations).
+
+    Neighbourhoods are sorted by distance from the center point, and the
+    center's own plane is the one RANSAC has to find, so the first draws
+    come from the closest points and the pool grows linearly to the whole
+    neighbourhood over PROSAC_GROWTH iterations.
+    '''
+    sizes = np.asarray(sizes)
+    step = np.arange(first + 1, first + iterations + 1, dtype=np.float64)
+    pool = np.ceil(sizes[:, None] * np.minimum(step / PROSAC_GROWTH, 1.0)).astype(np.int64)
+    return np.minimum(np.maximum(pool, 2 * num_samples), sizes[:, None])
+
+
+def _planes_from_moments(count, first, second):
+    ''' Least squares planes from point moments, batched over the leading axes.
+
+    count: number of points, first: sum of coordinates (..., 3), second: sums
+    of xx, xy, xz, yy, yz, zz (..., 6). Returns (normal, d, variances) with the
+    unit normal taken from the smallest eigenvector of the covariance matrix
+    and variances its eigenvalues in ascending order.
+    '''
+    count = np.maximum(count, 1)[..., None]
+    mean = first / count
+    m = second / count
+    cov = np.empty(first.shape[:-1] + (3, 3))
+    cov[..., 0, 0] = m[..., 0] - mean[..., 0] * mean[..., 0]
+    cov[..., 0, 1] = cov[..., 1, 0] = m[..., 1] - mean[..., 0] * mean[..., 1]
+    cov[..., 0, 2] = cov[..., 2, 0] = m[..., 2] - mean[..., 0] * mean[..., 2]
+    cov[..., 1, 1] = m[..., 3] - mean[..., 1] * mean[..., 1]
+    cov[..., 1, 2] = cov[..., 2, 1] = m[..., 4] - mean[..., 1] * mean[..., 2]
+    cov[..., 2, 2] = m[..., 5] - mean[..., 2] * mean[..., 2]
+    variances, vectors = np.linalg.eigh(cov)
+    normal = vectors[..., :, 0]
+    d = -np.sum(normal * mean, axis=-1)
+    return normal, d, variances
+
+
+def _products(points):
+    ''' The six distinct coordinate products xx, xy, xz, yy, yz, zz, in
+    float64 whatever the type of points.
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    x, y, z = points[..., 0], points[..., 1], points[..., 2]
+    return np.stack((x * x, x * y, x * z, y * y, y * z, z * z), axis=-1)
+
+
+def _slope(normal):
+    return np.degrees(np.arccos(np.minimum(np.abs(normal[..., 2]), 1.0)))
+
+
+class _Scratch(object):
+    ''' Named float32 buffers that grow as needed and are reused from one
+    batch to the next. A buffer's contents are only valid until it is
+    requested again.
+    '''
+    def __init__(self):
+        self.buffers = {}
+
+    def __call__(self, name, shape):
+        size = int(np.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or len(buffer) < size:
+            buffer = self.buffers[name] = np.empty(size, dtype=np.float32)
+        return buffer[:size].reshape(shape)
+
+
+_scratch = _Scratch()
+
+
+def _offsets(points, centers, center_rows, neighbours, owner, out=None):
+    ''' float32 offsets of the neighbours (rows of points) from their
+    center points, neighbour k belonging to center owner[k]. Quantized
+    points are subtracted as integers, so only the final scaling rounds;
+    without center_rows the float64 centers are used.
+    '''
+    if isinstance(points, las_io.QuantizedPoints) and center_rows is not None:
+        return points.local(neighbours, center_rows[owner], out)
+    if out is None:
+        out = np.empty((len(neighbours), 3), dtype=np.float32)
+    np.subtract(points[neighbours], centers[owner], out=out, casting="same_kind")
+    return out
+
+
+def _gather(points, centers, offsets, indices, rows, center_rows=None):
+    ''' Padded neighbourhoods of the given query rows as float32 local
+    coordinates relative to their center points: returns (local (B, n_max,
+    3), valid (B, n_max), sizes (B,)). local is a scratch buffer, overwritten
+    by the next call.
+    '''
+    sizes = offsets[rows + 1] - offsets[rows]
+    n_max = sizes.max()
+    b = len(rows)
+    valid = np.arange(n_max)[None, :] < sizes[:, None]
+    flat = _flat_positions(offsets, rows, sizes)
+    owner = np.repeat(rows, sizes)
+    local = _scratch("local", (b, n_max, 3))
+    local.fill(0.0)
+    local[valid] = _offsets(points, centers, center_rows, indices[flat], owner, _scratch("flat", (len(flat), 3)))
+    return local, valid, sizes
+
+
+def draw_hypotheses(local, sizes, point_ids, iterations, num_samples, seed, first=0, sampling="uniform"):
+    ''' Plane hypotheses through random samples of a batch of padded
+    neighbourhoods, all fitted in one batched call. Returns (normal (B, I, 3),
+    d (B, I), usable (B, I), slope (B, I)) where usable is False for samples
+    RANSAC_Seg's fromPoints gives up on (fewer than three points, collinear).
+
+    Draw i does not depend on the total number of iterations, so the
+    hypotheses for fewer iterations are a prefix of these, and first draws
+    iterations first.. of that sequence. sampling is "uniform" or "prosac"
+    (see prosac_sizes).
+    '''
+    b = len(local)
+    if sampling == "prosac":
+        sizes = prosac_sizes(sizes, num_samples, iterations, first)
+    idx = sample_indices(seed, point_ids, sizes, iterations, num_samples, first)
+    samples = local[np.arange(b)[:, None, None], idx].astype(np.float64)
+    normal, d, variances = _planes_from_moments(
+        np.full((b, iterations), float(num_samples)), samples.sum(axis=2), _products(samples).sum(axis=2))
+    usable = (num_samples >= 3) & (variances[..., 1] > 1e-12 * np.maximum(variances[..., 2], 1e-300))
+    return normal, d, usable, _slope(normal)
+
+
+def required_iterations(inlier_ratio, num_samples, confidence):
+    ''' Iterations needed to draw an all-inlier sample with the given
+    confidence when a fraction inlier_ratio of the points are inliers.
+    '''
+    p = np.asarray(inlier_ratio, dtype=np.float64) ** num_samples
+    with np.errstate(divide="ignore"):
+        return np.where(p > 0, np.log1p(-confidence) / np.log1p(-np.minimum(p, 1.0)), np.inf)
+
+
+class ModelSearch(object):
+    ''' The state of the sequential best-model search of a batch of
+    neighbourhoods, carried from one block of hypotheses to the next: the
+    best model so far, the largest accepted inlier count, the iterations
+    used, the hypotheses those iterations rejected at the slope gate and
+    whether the search has stopped.
+    '''
+    def __init__(self, count):
+        self.cost = np.full(count, np.inf)
+        self.rmse = np.full(count, np.inf)
+        self.normal = np.zeros((count, 3))
+        self.d = np.zeros(count)
+        self.inliers = np.zeros(count, dtype=np.int64)
+        self.iterations = np.zeros(count, dtype=np.int64)
+        self.slope_rejected = np.zeros(count, dtype=np.int64)
+        self.done = np.zeros(count, dtype=bool)
+
+    def score(self, local, valid, sizes, hypotheses, first, params, rows=None, weights=None):
+        ''' Runs iterations first.. of RANSAC on the neighbourhoods of the
+        given rows (all of them by default) with the given block of drawn
+        hypotheses: the slope gate, inlier test, refit and best model search.
+
+        For voxel-reduced neighbourhoods local holds the voxel centroids and
+        weights their (counts (B, V), sums (B, V, 3), products (B, V, 6)) as
+        padded by _gather_voxels. A voxel is an inlier when its centroid is;
+        inliers are then counted in points and refitted from the moments of
+        all the points in inlier voxels.
+        '''
+        if rows is None:
+            rows = np.arange(len(self.cost))
+        b = len(local)
+        threshold = params["threshold"]
+        normal, d, usable, slope = hypotheses
+        iterations = normal.shape[1]
+        hypothesis_ok = usable & (slope < params["maxSlope"])
+
+        # Inliers of every hypothesis at once.
+        residuals = np.abs(np.einsum("bnk,bik->bin", local, normal) + d[..., None])
+        inliers = (residuals < threshold) & valid[:, None, :]
+        inliers &= hypothesis_ok[..., None]
+
+        # Refit every hypothesis to its inliers through weighted moments.
+        selected = inliers.astype(np.float64)
+        if weights is None:
+            inlier_count = inliers.sum(axis=2)
+            first_moments, second_moments = selected @ local, selected @ _products(local)
+        else:
+            counts, sums, products = weights
+            inlier_count = np.rint(selected @ counts[..., None].astype(np.float64))[..., 0].astype(np.int64)
+            first_moments, second_moments = selected @ sums, selected @ products
+            sizes = counts.sum(axis=1)
+        refit_normal, refit_d, refit_var = _planes_from_moments(
+            inlier_count.astype(np.float64), first_moments, second_moments)
+        rmse = np.sqrt(np.maximum(refit_var[..., 0], 0.0))
+        accepted = hypothesis_ok & (inlier_count >= params["acceptableModelSize"])
+        accepted &= np.abs(refit_d) < threshold  # the center point is the local origin
+        rmse = np.where(accepted, rmse, np.inf)
+        if params["scoring"] == "msac":
+            # Truncated quadratic loss of the hypothesis over the whole
+            # neighbourhood instead of the refit's RMSE over its inliers.
+            loss = np.minimum(residuals, threshold) ** 2
+            if weights is not None:
+                loss = loss * weights[0][:, None, :]
+            loss = np.where(valid[:, None, :], loss, 0.0).sum(axis=2)
+            cost = np.where(accepted, loss, np.inf)
+        else:
+            cost = rmse
+
+        # Replay the sequential search: keep the first strictly lower cost and
+        # stop after an improving model that covers every point or fits
+        # exactly, or, in adaptive mode, once enough iterations have been
+        # drawn for the best inlier ratio found so far.
+        previous_best = np.minimum.accumulate(np.concatenate((self.cost[rows, None], cost[:, :-1]), axis=1), axis=1)
+        improved = cost < previous_best
+        stop = improved & ((inlier_count == sizes[:, None]) | (rmse == 0.0))
+        accepted_count = np.where(accepted, inlier_count, 0)
+        best_inliers = np.maximum(np.maximum.accumulate(accepted_count, axis=1), self.inliers[rows, None])
+        if params["confidence"] > 0:
+            needed = required_iterations(best_inliers / sizes[:, None].astype(np.float64),
+                                         params["numSamples"], params["confidence"])
+            stop |= np.arange(first + 1, first + iterations + 1)[None, :] >= needed
+        stopped = stop.any(axis=1)
+        last = np.where(stopped, stop.argmax(axis=1), iterations - 1)
+        cost = np.where(np.arange(iterations)[None, :] <= last[:, None], cost, np.inf)
+        best = cost.argmin(axis=1)
+        batch = np.arange(b)
+        better = cost[batch, best] < self.cost[rows]
+        update = rows[better]
+        self.cost[update] = cost[batch, best][better]
+        self.rmse[update] = rmse[batch, best][better]
+        self.normal[update] = refit_normal[batch, best][better]
+        self.d[update] = refit_d[batch, best][better]
+        self.inliers[rows] = best_inliers[batch, last]
+        self.iterations[rows] = first + last + 1
+        self.slope_rejected[rows] += np.count_nonzero(
+            (usable & ~hypothesis_ok) & (np.arange(iterations)[None, :] <= last[:, None]), axis=1)
+        self.done[rows] |= stopped
+
+    def labels(self, local, valid, threshold):
+        ''' The neighbours on each neighbourhood's best plane, (B, n_max).
+        '''
+        return _plane_labels(local, valid, self.normal, self.d, threshold) & np.isfinite(self.rmse)[:, None]
+
+
+def score_hypotheses(local, valid, sizes, hypotheses, params):
+    ''' RANSAC for the first params["iterations"] drawn hypotheses. Returns
+    (planar (B, n_max), rmse (B,)): the neighbours on the accepted plane and
+    that plane's RMSE, inf where no model was accepted.
+    '''
+    search = ModelSearch(len(local))
+    search.score(local, valid, sizes, tuple(h[:, :params["iterations"]] for h in hypotheses), 0, params)
+    return search.labels(local, valid, params["threshold"]), search.rmse
+
+
+def _fit_batch(local, valid, sizes, point_ids, params, seed, weights=None):
+    ''' Runs RANSAC for a batch of padded neighbourhoods and returns the
+    finished ModelSearch. weights are those of voxel-reduced neighbourhoods
+    (see ModelSearch.score), where sizes are the numbers of voxels drawn
+    from.
+
+    In adaptive mode (confidence > 0) hypotheses are drawn and scored
+    ADAPTIVE_BLOCK iterations at a time, and neighbourhoods drop out of the
+    batch as soon as their search stops.
+    '''
+    iterations = params["iterations"]
+    block = ADAPTIVE_BLOCK if params["confidence"] > 0 else iterations
+    search = ModelSearch(len(local))
+    active = np.arange(len(local))
+    first = 0
+    while first < iterations and len(active):
+        count = min(block, iterations - first)
+        hypotheses = draw_hypotheses(local[active], sizes[active], point_ids[active], count, params["numSamples"],
+                                     seed, first, params["sampling"])
+        search.score(local[active], valid[active], sizes[active], hypotheses, first, params, active,
+                     None if weights is None else tuple(w[active] for w in weights))
+        active = active[~search.done[active]]
+        first += count
+    return search
+
+
+def _flat_positions(offsets, rows, sizes):
+    ''' Positions in the CSR indices array of the neighbours of rows.
+    '''
+    return np.repeat(offsets[rows], sizes) + (np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes))
+
+
+def _size_batches(rows, sizes, iterations):
+    ''' Splits rows, sorted by neighbourhood size, into batches whose padded
+    residual matrices fit BATCH_BUDGET.
+    '''
+    start = 0
+    while start < len(rows):
+        n_max = sizes[rows[min(start + CHUNK_SIZE, len(rows)) - 1]]
+        b = max(1, min(CHUNK_SIZE, BATCH_BUDGET // max(1, iterations * n_max)))
+        yield rows[start:start + b]
+        start += b
+
+
+class ModelCache(object):
+    ''' Accepted planes of the seeded search for one chunk of neighbourhoods,
+    kept per neighbour: each of the given rows remembers the lowest-RMSE
+    plane it was labelled on so far, in global coordinates (normal . p + d
+    = 0). Rows outside the chunk have no plane.
+    '''
+    def __init__(self, rows):
+        self.keys = np.unique(rows)
+        count = len(self.keys)
+        self.normal = np.zeros((count, 3))
+        self.d = np.zeros(count)
+        self.rmse = np.full(count, np.inf)
+
+    def _slots(self, rows):
+        slots = np.minimum(np.searchsorted(self.keys, rows), max(len(self.keys) - 1, 0))
+        return slots, (self.keys[slots] == rows) if len(self.keys) else np.zeros(len(rows), dtype=bool)
+
+    def planes(self, rows):
+        ''' (normal, d, rmse) of rows, with rmse inf where there is none.
+        '''
+        slots, known = self._slots(rows)
+        if not len(self.keys):
+            return np.zeros((len(rows), 3)), np.zeros(len(rows)), np.full(len(rows), np.inf)
+        return self.normal[slots], self.d[slots], np.where(known, self.rmse[slots], np.inf)
+
+    def store(self, rows, centers, sizes, on_plane, normal, d, rmse):
+        ''' Records the planes of a batch of neighbourhoods for their
+        labelled neighbours. rows and on_plane are flat over the batch's
+        neighbours, the rest per neighbourhood, with d relative to centers.
+        '''
+        d = d - np.sum(normal * centers, axis=1)
+        owner = np.repeat(np.arange(len(sizes)), sizes)[on_plane]
+        if len(owner) == 0:
+            return
+        slots = self._slots(rows[on_plane])[0]
+        order = np.lexsort((rmse[owner], slots))
+        slots, owner = slots[order], owner[order]
+        first = np.r_[True, slots[1:] != slots[:-1]]
+        slots, owner = slots[first], owner[first]
+        better = rmse[owner] < self.rmse[slots]
+        slots, owner = slots[better], owner[better]
+        self.normal[slots] = normal[owner]
+        self.d[slots] = d[owner]
+        self.rmse[slots] = rmse[owner]
+
+
+def reuse_models(local, valid, centers, normal, d, rmse, params):
+    ''' Tests cached planes (global coordinates, see ModelCache) on a batch
+    of padded neighbourhoods with the acceptance rules of a RANSAC model:
+    enough inliers, a refit within the slope limit that passes through the
+    center point, and an RMSE no worse than SEED_RMSE_RATIO times the
+    cached plane's. Returns (accepted, refit normal, refit d, refit rmse)
+    with d relative to the centers.
+    '''
+    threshold = params["threshold"]
+    d = d + np.sum(normal * centers, axis=1)
+    inliers = (np.abs(np.einsum("bnk,bk->bn", local, normal) + d[:, None]) < threshold) & valid
+    count = inliers.sum(axis=1)
+    weights = inliers.astype(np.float64)
+    refit_normal, refit_d, refit_var = _planes_from_moments(
+        count.astype(np.float64), np.einsum("bn,bnk->bk", weights, local),
+        np.einsum("bn,bnk->bk", weights, _products(local)))
+    refit_rmse = np.sqrt(np.maximum(refit_var[:, 0], 0.0))
+    accepted = count >= params["acceptableModelSize"]
+    accepted &= np.abs(refit_d) < threshold
+    accepted &= _slope(refit_normal) < params["maxSlope"]
+    accepted &= refit_rmse <= SEED_RMSE_RATIO * rmse
+    return accepted, refit_normal, refit_d, refit_rmse
+
+
+def _plane_labels(local, valid, normal, d, threshold):
+    return (np.abs(np.einsum("bnk,bk->bn", local, normal) + d[:, None]) <= threshold) & valid
+
+
+def _search_rows(points, centers, center_ids, offsets, indices, rows, center_rows, params, seed, labelled, used,
+                 models=None, details=None):
+    ''' Full RANSAC search of the neighbourhoods of rows, filling in
+    labelled and used and, in seeded mode, the model cache and, if given,
+    the slope_rejected and found arrays of details.
+
+    With params["voxelSize"] > 0 the search runs on the voxel-reduced
+    neighbourhoods instead (see _search_voxel_rows).
+    '''
+    if params["voxelSize"] > 0:
+        _search_voxel_rows(points, centers, center_ids, offsets, indices, rows, center_rows, params, seed, labelled,
+                           used, models, details)
+        return
+    sizes = np.diff(offsets)
+    # Batches of similar size waste less padding; the cost of a batch is
+    # bounded by its largest neighbourhood.
+    rows = rows[np.argsort(sizes[rows], kind="stable")]
+    block = ADAPTIVE_BLOCK if params["confidence"] > 0 else params["iterations"]
+    for batch in _size_batches(rows, sizes, min(block, params["iterations"])):
+        local, valid, batch_sizes = _gather(points, centers, offsets, indices, batch, center_rows)
+        search = _fit_batch(local, valid, batch_sizes, center_ids[batch], params, seed)
+        final = search.labels(local, valid, params["threshold"])[valid]
+        flat = _flat_positions(offsets, batch, batch_sizes)
+        labelled[flat] = final
+        used[batch] = search.iterations
+        if details is not None:
+            details["slope_rejected"][batch] = search.slope_rejected
+            details["found"][batch] = np.isfinite(search.rmse)
+        if models is not None:
+            models.store(indices[flat], centers[batch], batch_sizes, final, search.normal, search.d, search.rmse)
+
+
+def _search_voxel_rows(points, centers, center_ids, offsets, indices, rows, center_rows, params, seed, labelled,
+                       used, models=None, details=None):
+    ''' _search_rows on voxel-reduced neighbourhoods: hypotheses are drawn
+    from the voxel centroids and scored with the voxels' point counts and
+    moments, so the cost of a search depends on the number of occupied
+    voxels rather than of neighbours. The winning planes then label the full
+    neighbourhoods in one pass.
+    '''
+    if len(rows) == 0:
+        return
+    voxels = voxel_neighbourhoods(points, centers, offsets, indices, rows, center_rows, params["voxelSize"])
+    voxel_sizes = np.diff(voxels[0])
+    normal = np.zeros((len(centers), 3))
+    d = np.zeros(len(centers))
+    rmse = np.full(len(centers), np.inf)
+    rows = rows[np.argsort(voxel_sizes[rows], kind="stable")]
+    block = ADAPTIVE_BLOCK if params["confidence"] > 0 else params["iterations"]
+    for batch in _size_batches(rows, voxel_sizes, min(block, params["iterations"])):
+        centroids, valid, batch_sizes, weights = _gather_voxels(voxels, batch)
+        search = _fit_batch(centroids, valid, batch_sizes, center_ids[batch], params, seed, weights)
+        normal[batch], d[batch], rmse[batch] = search.normal, search.d, search.rmse
+        used[batch] = search.iterations
+        if details is not None:
+            details["slope_rejected"][batch] = search.slope_rejected
+            details["found"][batch] = np.isfinite(search.rmse)
+
+    rows = np.sort(rows)
+    sizes = offsets[rows + 1] - offsets[rows]
+    flat = _flat_positions(offsets, rows, sizes)
+    owner = np.repeat(rows, sizes)
+    local = _offsets(points, centers, center_rows, indices[flat], owner, _scratch("flat", (len(flat), 3)))
+    residuals = np.abs(np.einsum("nk,nk->n", local, normal[owner]) + d[owner])
+    final = (residuals <= params["threshold"]) & np.isfinite(rmse)[owner]
+    labelled[flat] = final
+    if models is not None:
+        models.store(indices[flat], centers[rows], sizes, final, normal[rows], d[rows], rmse[rows])
+
+
+def voxel_neighbourhoods(points, centers, offsets, indices, rows, center_rows, voxel_size):
+    ''' Reduces the neighbourhoods of rows to the occupied cells of a grid of
+    voxel_size cubes centred on each center point, so that dense
+    neighbourhoods cost about as much to search as sparse ones.
+
+    Returns (voxel_offsets, counts, sums, products): CSR offsets over all
+    centers (empty for centers not in rows), then per voxel the number of
+    neighbours in it and the sums of their local coordinates and of their
+    coordinate products (see _planes_from_moments). The voxels of a
+    neighbourhood are ordered by their nearest neighbour, so PROSAC sampling
+    still starts close to the center.
+    '''
+    rows = np.sort(rows)
+    sizes = offsets[rows + 1] - offsets[rows]
+    flat = _flat_positions(offsets, rows, sizes)
+    local = _offsets(points, centers, center_rows, indices[flat], np.repeat(rows, sizes))
+    # One integer key per (neighbourhood, voxel), so a single sort groups
+    # the neighbours of every voxel.
+    reach = int(np.ceil(max(local.max(), -local.min(), 0.0) / voxel_size)) + 1
+    span = 2 * reach + 1
+    if len(rows) * float(span) ** 3 >= 2.0 ** 62:
+        raise ValueError("voxelSize {} is too small for these neighbourhoods.".format(voxel_size))
+    cells = np.floor(local * np.float32(1.0 / voxel_size) + np.float32(0.5)).astype(np.int64) + reach
+    owner = np.repeat(np.arange(len(rows)), sizes)
+    keys = ((owner * span + cells[:, 0]) * span + cells[:, 1]) * span + cells[:, 2]
+    order = np.argsort(keys)
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    counts = np.diff(np.append(starts, len(keys)))
+    local = local[order].astype(np.float64)
+    sums = np.add.reduceat(local, starts, axis=0)
+    products = np.add.reduceat(_products(local), starts, axis=0)
+    # Neighbours are sorted by distance within their neighbourhood, so the
+    # first position of a voxel's neighbours ranks it.
+    first_seen = np.minimum.reduceat(order, starts)
+    nearest = np.argsort(first_seen)
+    voxel_sizes = np.zeros(len(centers), dtype=np.int64)
+    voxel_sizes[rows] = np.bincount(owner[first_seen], minlength=len(rows))
+    return (np.concatenate(([0], np.cumsum(voxel_sizes))), counts[nearest], sums[nearest],
+            products[nearest])
+
+
+def _gather_voxels(voxels, rows):
+    ''' Padded voxel-reduced neighbourhoods of rows (see
+    voxel_neighbourhoods): returns (centroids (B, V, 3), valid (B, V), sizes
+    (B,), (counts, sums, products)) with V the largest number of voxels.
+    '''
+    voxel_offsets, counts, sums, products = voxels
+    sizes = voxel_offsets[rows + 1] - voxel_offsets[rows]
+    valid = np.arange(sizes.max())[None, :] < sizes[:, None]
+    flat = _flat_positions(voxel_offsets, rows, sizes)
+    padded_counts = np.zeros(valid.shape, dtype=np.int64)
+    padded_counts[valid] = counts[flat]
+    padded_sums = np.zeros(valid.shape + (3,))
+    padded_sums[valid] = sums[flat]
+    padded_products = np.zeros(valid.shape + (6,))
+    padded_products[valid] = products[flat]
+    centroids = padded_sums / np.maximum(padded_counts, 1)[..., None]
+    return centroids, valid, sizes, (padded_counts, padded_sums, padded_products)
+
+
+def _reuse_rows(points, centers, offsets, indices, rows, center_rows, params, labelled, used, models):
+    ''' Tries the cached planes of the center points of rows on their
+    neighbourhoods. Returns the rows whose plane was accepted.
+    '''
+    sizes = np.diff(offsets)
+    rows = rows[np.argsort(sizes[rows], kind="stable")]
+    accepted_rows = []
+    for batch in _size_batches(rows, sizes, 1):
+        local, valid, batch_sizes = _gather(points, centers, offsets, indices, batch, center_rows)
+        normal, d, rmse = models.planes(center_rows[batch])
+        accepted, normal, d, rmse = reuse_models(local, valid, centers[batch], normal, d, rmse, params)
+        batch, local, valid, batch_sizes = batch[accepted], local[accepted], valid[accepted], batch_sizes[accepted]
+        normal, d, rmse = normal[accepted], d[accepted], rmse[accepted]
+        final = _plane_labels(local, valid, normal, d, params["threshold"])[valid]
+        flat = _flat_positions(offsets, batch, batch_sizes)
+        labelled[flat] = final
+        used[batch] = 0
+        models.store(indices[flat], centers[batch], batch_sizes, final, normal, d, rmse)
+        accepted_rows.append(batch)
+    return np.concatenate(accepted_rows) if accepted_rows else np.zeros(0, dtype=np.int64)
+
+
+def neighbourhood_shape(points, centers, offsets, indices, rows, center_rows=None):
+    ''' Covariance shape of the neighbourhoods of rows, from one eigen-analysis
+    of all of them at once. Returns (linearity, planarity, scattering, normal,
+    d, max_residual): the usual eigenvalue features (l1 - l2) / l1,
+    (l2 - l3) / l1 and l3 / l1, and the least squares plane through each whole
+    neighbourhood (d relative to the center) with its largest residual.
+    '''
+    sizes = offsets[rows + 1] - offsets[rows]
+    flat = _flat_positions(offsets, rows, sizes)
+    local = _offsets(points, centers, center_rows, indices[flat], np.repeat(rows, sizes)).astype(np.float64)
+    starts = np.cumsum(sizes) - sizes
+    normal, d, variances = _planes_from_moments(
+        sizes.astype(np.float64), np.add.reduceat(local, starts, axis=0),
+        np.add.reduceat(_products(local), starts, axis=0))
+    residuals = np.abs(np.sum(local * np.repeat(normal, sizes, axis=0), axis=1) + np.repeat(d, sizes))
+    variances = np.maximum(variances, 0.0)
+    largest = np.maximum(variances[:, 2], 1e-300)
+    linearity = (variances[:, 2] - variances[:, 1]) / largest
+    planarity = (variances[:, 1] - variances[:, 0]) / largest
+    scattering = variances[:, 0] / largest
+    return linearity, planarity, scattering, normal, d, np.maximum.reduceat(residuals, starts)
+
+
+def _prescreen_rows(points, centers, offsets, indices, rows, center_rows, params, labelled, used, models=None):
+    ''' Settles the neighbourhoods of rows that need no RANSAC and returns
+    the rest.
+
+    A neighbourhood is labelled planar outright when it is planar enough,
+    its plane is within the slope limit and passes through the center, and
+    every neighbour is an inlier of it, which is the model RANSAC would stop
+    at. It is rejected outright, labelling nothing, when it is scattered (like
+    vegetation) or linear (like wires or edges) beyond the given limits.
+    '''
+    if len(rows) == 0:
+        return rows
+    threshold = params["threshold"]
+    linearity, planarity, scattering, normal, d, max_residual = neighbourhood_shape(
+        points, centers, offsets, indices, rows, center_rows)
+    planar = (planarity >= params["minPlanarity"]) & (_slope(normal) < params["maxSlope"])
+    planar &= (max_residual < threshold) & (np.abs(d) < threshold)
+    rejected = ~planar & ((scattering >= params["maxScattering"]) | (linearity >= params["maxLinearity"]))
+
+    sizes = np.diff(offsets)
+    flat = _flat_positions(offsets, rows[planar], sizes[rows[planar]])
+    labelled[flat] = True
+    used[rows[planar]] = SCREENED_PLANAR
+    used[rows[rejected]] = SCREENED_OUT
+    if models is not None:
+        # The variances of the whole-neighbourhood fit are not kept, so
+        # store its largest residual as a conservative RMSE.
+        models.store(indices[flat], centers[rows[planar]], sizes[rows[planar]], np.ones(len(flat), dtype=bool),
+                     normal[planar], d[planar], max_residual[planar])
+    return rows[~planar & ~rejected]
+
+
+def label_neighbourhoods(points, centers, center_ids, offsets, indices, params, seed=0, models=None,
+                         center_rows=None, details=None):
+    ''' Runs RANSAC on every neighbourhood given in CSR form (see
+    RadiusIndex.query) around the given center points.
+
+    center_rows are the centers' rows in points. They are needed in seeded
+    mode, and with quantized points (las_io.QuantizedPoints) they let the
+    local offsets be taken exactly from the stored integers.
+
+    In seeded mode (params["search"] == "seeded") models is a ModelCache of
+    the neighbours. A
+    center already labelled on a cached plane first tries that plane, and
+    only gets a full search if it is rejected. Centers are searched in
+    waves of SEED_WAVE, so later ones can reuse the planes of earlier ones.
+    Seeded labels depend on which centers share a cache, so unlike
+    exhaustive ones they can differ slightly between tiled and untiled runs;
+    seeding_report.py measures how far they are from the exhaustive labels.
+
+    With params["prescreen"] == "on" the neighbourhoods first go through
+    the covariance pre-screen (see _prescreen_rows), and only the ambiguous
+    ones get RANSAC.
+
+    Returns (labelled, iterations): a boolean mask over `indices` marking the
+    neighbours that lie on an accepted plane, and the number of iterations
+    used per center (0 where a cached plane was reused, or one of TOO_SMALL,
+    SCREENED_PLANAR and SCREENED_OUT).
+
+    details, if given, is a dict that receives per-center arrays for
+    instrumentation: the hypotheses rejected by the slope gate within the
+    iterations used ("slope_rejected"), whether a plane was accepted
+    ("found") and the number of neighbours labelled on it ("inliers").
+    '''
+    params = resolve_params(params)
+    larger_of_samples = max(params["numSamples"], params["acceptableModelSize"])
+    sizes = np.diff(offsets)
+    labelled = np.zeros(len(indices), dtype=bool)
+    used = np.full(len(centers), TOO_SMALL, dtype=np.int64)
+    rows = np.flatnonzero(sizes > larger_of_samples)
+    if details is not None:
+        details["slope_rejected"] = np.zeros(len(centers), dtype=np.int64)
+        details["found"] = np.zeros(len(centers), dtype=bool)
+    if params["prescreen"] == "on":
+        rows = _prescreen_rows(points, centers, offsets, indices, rows, center_rows, params, labelled, used, models)
+    if params["search"] != "seeded":
+        _search_rows(points, centers, center_ids, offsets, indices, rows, center_rows, params, seed, labelled, used,
+                     details=details)
+        return _finish_details(details, labelled, used, offsets)
+
+    tried = np.zeros(len(centers), dtype=bool)
+    pending = rows
+    while len(pending):
+        candidates = pending[~tried[pending]]
+        candidates = candidates[np.isfinite(models.planes(center_rows[candidates])[2])]
+        if len(candidates):
+            tried[candidates] = True
+            reused = _reuse_rows(points, centers, offsets, indices, candidates, center_rows, params, labelled, used,
+                                 models)
+            pending = pending[~np.isin(pending, reused)]
+        wave, pending = pending[:SEED_WAVE], pending[SEED_WAVE:]
+        _search_rows(points, centers, center_ids, offsets, indices, wave, center_rows, params, seed, labelled, used,
+                     models, details)
+    return _finish_details(details, labelled, used, offsets)
+
+
+def _finish_details(details, labelled, used, offsets):
+    ''' Completes the details of label_neighbourhoods: neighbourhoods settled
+    without a search found their model (a reused plane or a pre-screened
+    plane), and every center gets the number of neighbours it labelled.
+    '''
+    if details is not None:
+        details["found"] |= (used == 0) | (used == SCREENED_PLANAR)
+        labelled_before = np.concatenate(([0], np.cumsum(labelled)))
+        details["inliers"] = labelled_before[offsets[1:]] - labelled_before[offsets[:-1]]
+    return labelled, used
+
+
+def label_neighbourhoods_sweep(points, centers, center_ids, offsets, indices, param_sets, seed=0, center_rows=None):
+    ''' label_neighbourhoods for several parameter sets with the same search
+    distance in one pass. Each neighbourhood is gathered once, and parameter
+    sets with the same numSamples and sampling share one set of hypothesis
+    draws (sized for the largest iteration count among them).
+
+    Returns (labelled, rmse, seconds), one entry per parameter set: the mask
+    over indices, the best model RMSE per center (inf where none) and the
+    time spent on that set, with shared work split evenly.
+    '''
+    param_sets = [resolve_params(p) for p in param_sets]
+    sizes = np.diff(offsets)
+    labelled = [np.zeros(len(indices), dtype=bool) for _ in param_sets]
+    rmse = [np.full(len(centers), np.inf) for _ in param_sets]
+    seconds = [0.0] * len(param_sets)
+
+    groups = {}
+    for k, params in enumerate(param_sets):
+        groups.setdefault((params["numSamples"], params["sampling"]), []).append(k)
+    for (num_samples, sampling), members in sorted(groups.items()):
+        iterations = max(param_sets[k]["iterations"] for k in members)
+        smallest = min(max(num_samples, param_sets[k]["acceptableModelSize"]) for k in members)
+        rows = np.flatnonzero(sizes > smallest)
+        rows = rows[np.argsort(sizes[rows], kind="stable")]
+        for batch in _size_batches(rows, sizes, iterations):
+            started = time.time()
+            local, valid, batch_sizes = _gather(points, centers, offsets, indices, batch, center_rows)
+            hypotheses = draw_hypotheses(local, batch_sizes, center_ids[batch], iterations, num_samples, seed,
+                                         sampling=sampling)
+            flat = _flat_positions(offsets, batch, batch_sizes)
+            shared = (time.time() - started) / len(members)
+            for k in members:
+                started = time.time()
+                params = param_sets[k]
+                final, best_rmse = score_hypotheses(local, valid, batch_sizes, hypotheses, params)
+                # Neighbourhoods too small for this set are skipped, as in a
+                # single run.
+                skip = batch_sizes <= max(num_samples, params["acceptableModelSize"])
+                final[skip] = False
+                best_rmse[skip] = np.inf
+                labelled[k][flat] = final[valid]
+                rmse[k][batch] = best_rmse
+                seconds[k] += shared + time.time() - started
+    return labelled, rmse, seconds
+
+
+def _spread_bits(v):
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x33333333)
+    return (v | (v << np.uint64(1))) & np.uint64(0x55555555)
+
+
+def spatial_order(xy):
+    ''' A permutation of the points along a Z-order (Morton) curve over
+    their XY bounding box, so any run of consecutive points is spatially
+    compact. Ties keep their input order.
+    '''
+    xy = np.asarray(xy, dtype=np.float64)
+    if len(xy) == 0:
+        return np.zeros(0, dtype=np.int64)
+    lo = xy.min(axis=0)
+    extent = np.maximum(xy.max(axis=0) - lo, 1e-9)
+    cells = np.minimum((xy - lo) / extent * 65536.0, 65535.0).astype(np.uint64)
+    codes = _spread_bits(cells[:, 0]) | (_spread_bits(cells[:, 1]) << np.uint64(1))
+    return np.argsort(codes, kind="stable")
+
+
+class Neighbourhoods(object):
+    ''' The filtered (non-noise) points of a cloud and the radius
+    neighbourhoods around them, searched among the last returns.
+
+    rows are the filtered points' positions in the input arrays and xyz their
+    coordinates. Neighbourhoods are produced chunk by chunk for the rows in
+    query_rows, with neighbours given as rows of xyz. Queries are kept in
+    spatial order (see spatial_order), so each chunk covers a compact area.
+
+    xyz may be given as las_io.QuantizedPoints, which keeps the working set
+    at 12 bytes a point instead of 24; rows are stored as int32 where they
+    fit.
+    '''
+    def __init__(self, xyz, classification, return_number, number_of_returns, search_dist, query_mask=None):
+        candidates, last_only = filter_points(classification, return_number, number_of_returns)
+        row_type = index_type(len(candidates))
+        self.rows = np.flatnonzero(candidates).astype(row_type)
+        if isinstance(xyz, las_io.QuantizedPoints):
+            self.xyz = xyz.take(self.rows)
+        else:
+            self.xyz = np.asarray(xyz, dtype=np.float64)[self.rows]
+        self.tree_rows = np.flatnonzero(last_only[self.rows]).astype(row_type)
+        self.index = RadiusIndex(self.xyz, search_dist, rows=self.tree_rows)
+        if query_mask is None:
+            query_rows = np.arange(len(self.rows), dtype=row_type)
+        else:
+            query_rows = np.flatnonzero(query_mask[self.rows]).astype(row_type)
+        self.query_rows = query_rows[spatial_order(self.xyz[query_rows][:, :2])]
+
+    def __len__(self):
+        return len(self.query_rows)
+
+    def chunk(self, start, stop):
+        ''' (rows, offsets, indices) for the queries start..stop: the rows of
+        the center points and their neighbourhoods in CSR form.
+        '''
+        rows = self.query_rows[start:stop]
+        offsets, indices = self.index.query(self.xyz[rows])
+        return rows, offsets, self.tree_rows[indices]
+
+
+class IterationLog(object):
+    ''' Records how many RANSAC iterations each neighbourhood used. Called
+    as log(point_ids, sizes, iterations, **details) for every chunk with the
+    iterations and details returned by label_chunk; neighbourhoods too small
+    to fit are left out. With a file name the records are also written to
+    that CSV file, where 0 marks a reused model and -2 and -3 neighbourhoods
+    labelled and rejected by the pre-screen. See instrumentation.py for a log
+    that keeps the details.
+    '''
+    def __init__(self, file_name=None, budget=DEFAULT_PARAMS["iterations"]):
+        self.budget = budget
+        self.counts = np.zeros(budget + 1, dtype=np.int64)
+        self.screened_planar = 0
+        self.screened_out = 0
+        self.file = None
+        if file_name:
+            self.file = open(file_name, "w")
+            self.file.write("point,neighbours,iterations\n")
+
+    def __call__(self, point_ids, sizes, iterations, **details):
+        fitted = iterations >= 0
+        self.counts += np.bincount(iterations[fitted], minlength=self.budget + 1)[:self.budget + 1]
+        self.screened_planar += np.count_nonzero(iterations == SCREENED_PLANAR)
+        self.screened_out += np.count_nonzero(iterations == SCREENED_OUT)
+        if self.file is not None:
+            logged = iterations != TOO_SMALL
+            np.savetxt(self.file, np.column_stack((point_ids[logged], sizes[logged], iterations[logged])),
+                       fmt="%d", delimiter=",")
+
+    def summary(self):
+        ''' Iteration statistics of the neighbourhoods RANSAC saw, and the
+        fraction of all fitted neighbourhoods handled by each branch.
+        '''
+        fitted = self.counts.sum()
+        used = (self.counts * np.arange(len(self.counts))).sum()
+        total = float(max(fitted + self.screened_planar + self.screened_out, 1))
+        return {
+            "neighbourhoods": int(fitted),
+            "budget": self.budget,
+            "mean": used / float(fitted) if fitted else 0.0,
+            "max": int(np.flatnonzero(self.counts)[-1]) if fitted else 0,
+            "reused": int(self.counts[0]),
+            "saved": 1.0 - used / float(fitted * self.budget) if fitted and self.budget else 0.0,
+            "branches": {
+                "prescreen_planar": self.screened_planar / total,
+                "prescreen_rejected": self.screened_out / total,
+                "reused": self.counts[0] / total,
+                "ransac": (fitted - self.counts[0]) / total,
+            },
+        }
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def label_chunk(neighbourhoods, start, row_ids, params, seed=0):
+    ''' Runs RANSAC on the neighbourhoods of queries start..start+CHUNK_SIZE.
+    row_ids are the point ids of the filtered rows. Returns (planar rows,
+    center ids, neighbourhood sizes, iterations used, details): details are
+    the per-center arrays of label_neighbourhoods plus the chunk's time in
+    seconds.
+
+    Seeded search shares a ModelCache within the chunk only, so the result
+    of a chunk does not depend on which other chunks ran before it.
+    '''
+    started = time.perf_counter()
+    nb = neighbourhoods
+    rows, offsets, indices = nb.chunk(start, start + CHUNK_SIZE)
+    center_ids = row_ids[rows]
+    models = ModelCache(indices) if params["search"] == "seeded" else None
+    details = {}
+    labelled, used = label_neighbourhoods(nb.xyz, nb.xyz[rows], center_ids, offsets, indices, params, seed, models,
+                                          rows, details)
+    details["seconds"] = time.perf_counter() - started
+    return indices[labelled], center_ids, np.diff(offsets), used, details
+
+
+def segment_neighbourhoods(neighbourhoods, n_points, seed=0, progress=None, point_ids=None, iteration_log=None,
+                           workers=1, **params):
+    ''' Segments precomputed Neighbourhoods of a cloud of n_points points and
+    returns the new classification of every point (see segment). With
+    workers > 1 the chunks are shared out to a pool of processes (see
+    parallel.py); the result is the same.
+    '''
+    params = resolve_params(params)
+    nb = neighbourhoods
+    row_ids = nb.rows if point_ids is None else np.asarray(point_ids)[nb.rows]
+    if workers > 1 and len(nb) > CHUNK_SIZE:
+        import parallel
+        planar = parallel.label_parallel(nb, row_ids, params, seed, workers, progress, iteration_log)
+    else:
+        planar = np.zeros(len(nb.rows), dtype=bool)
+        for start in range(0, len(nb), CHUNK_SIZE):
+            planar_rows, center_ids, sizes, used, details = label_chunk(nb, start, row_ids, params, seed)
+            planar[planar_rows] = True
+            if iteration_log is not None:
+                iteration_log(center_ids, sizes, used, **details)
+            if progress is not None:
+                progress("Iterating through each neighbourhood", min(start + CHUNK_SIZE, len(nb)), len(nb))
+
+    result = np.full(n_points, UNCLASSIFIED, dtype=np.uint8)
+    result[nb.rows[planar]] = NEVER_CLASSIFIED
+    return result
+
+
+def segment(xyz, classification, return_number, number_of_returns, seed=0, progress=None,
+            point_ids=None, query_mask=None, iteration_log=None, workers=1, **params):
+    ''' Segments a point cloud, returning the new classification of every
+    point: NEVER_CLASSIFIED for last returns on a planar surface and
+    UNCLASSIFIED for everything else.
+
+    point_ids are the points' numbers in the source file (default 0..n-1),
+    which seed their hypothesis draws. query_mask, if given, limits the
+    neighbourhood searches to those points; the others only serve as
+    neighbours. progress, if given, is called as progress(stage, done, total),
+    and iteration_log (see IterationLog) with the iterations each
+    neighbourhood used. workers > 1 runs RANSAC on that many processes.
+    '''
+    params = resolve_params(params)
+    nb = Neighbourhoods(xyz, classification, return_number, number_of_returns, params["searchDist"], query_mask)
+    return segment_neighbourhoods(nb, len(xyz), seed, progress, point_ids, iteration_log, workers, **params)
+
+
+def run(lidar_file, output_file, seed=0, tile_size=0.0, cache_dir=None, cache_size=20.0,
+        reporter=None, metrics_file=None, iteration_log=None, workers=1, member=None, instrument_every=0,
+        profile_interval=0.0, **params):
+    ''' Segments lidar_file into output_file, reporting progress and stage
+    timings through a progress.ProgressReporter. Returns the run's metrics,
+    which include a summary of the iterations the neighbourhoods used; with
+    iteration_log the per-neighbourhood counts are written to that CSV file.
+    workers > 1 runs RANSAC on that many processes.
+
+    instrument_every > 0 writes per-neighbourhood instrumentation next to
+    the output, keeping the records of every instrument_every-th point, and
+    profile_interval > 0 adds stack samples taken every that many seconds
+    (see instrumentation.py).
+
+    lidar_file may be a zip archive of LAS files, which are read straight
+    from the archive (see run_archive); member selects one of them.
+    '''
+    if member is None and las_io.is_zip(lidar_file):
+        return run_archive(lidar_file, output_file, seed, tile_size, cache_dir, cache_size, reporter, metrics_file,
+                           iteration_log, workers, instrument_every, profile_interval, **params)
+    reporter = reporter or progress.ProgressReporter()
+    print("Reading in points...\n", flush=True)
+    with reporter.stage("read"):
+        las = las_io.open_las(lidar_file, member)
+    budget = resolve_params(params)["iterations"]
+    if instrument_every > 0:
+        import instrumentation
+        log = instrumentation.Instrumentation(instrumentation.output_directory(output_file), iteration_log, budget,
+                                              instrument_every, profile_interval)
+    else:
+        log = IterationLog(iteration_log, budget)
+    try:
+        _run(las, output_file, seed, tile_size, cache_dir, cache_size, reporter, log, workers, params)
+    finally:
+        log.close()
+    metrics = reporter.finish(metrics_file, input=lidar_file, output=output_file, total_points=len(las),
+                              params=resolve_params(params), seed=seed, tile_size=tile_size, workers=workers,
+                              iterations=log.summary(), **({"member": member} if member else {}))
+    summary = log.summary()
+    print("Mean iterations per neighbourhood: {:.1f} of {}".format(summary["mean"], log.budget), flush=True)
+    if instrument_every > 0:
+        print("Instrumentation written to {}".format(log.directory), flush=True)
+    if params.get("prescreen") == "on":
+        print("Pre-screen: {prescreen_planar:.1%} labelled planar, {prescreen_rejected:.1%} rejected, "
+              "{ransac:.1%} sent to RANSAC".format(**summary["branches"]), flush=True)
+    print("Elapsed Time: {} Minutes, Done!".format(metrics["wall"] / 60.0), flush=True)
+    return metrics
+
+
+def _run(las, output_file, seed, tile_size, cache_dir, cache_size, reporter, log, workers, params):
+    if tile_size > 0 and isinstance(las, las_io.ZipLasMember):
+        raise las_io.LasError("Tiled runs need an uncompressed .las input.")
+    if tile_size > 0:
+        import tiling
+        tiling.segment_tiled(las, output_file, tile_size, seed=seed, reporter=reporter, iteration_log=log,
+                             workers=workers, **params)
+    else:
+        search_dist = resolve_params(params)["searchDist"]
+        if cache_dir:
+            import cache
+            with reporter.stage("index"):
+                nb = cache.NeighbourCache(cache_dir, cache_size * 1e9).load_or_build(las, search_dist, reporter)
+        else:
+            with reporter.stage("read"):
+                data = las.read_quantized()
+            with reporter.stage("index"):
+                nb = Neighbourhoods(*data, search_dist=search_dist)
+            del data
+        reporter.points = len(nb)
+        with reporter.stage("ransac"):
+            classes = segment_neighbourhoods(nb, len(las), seed=seed, progress=reporter, iteration_log=log,
+                                             workers=workers, **params)
+        print("Writing output...\n", flush=True)
+        with reporter.stage("write"):
+            las.write(output_file, classes)
+
+
+def run_archive(lidar_file, output_file, seed=0, tile_size=0.0, cache_dir=None, cache_size=20.0,
+                reporter=None, metrics_file=None, iteration_log=None, workers=1, instrument_every=0,
+                profile_interval=0.0, **params):
+    ''' Segments every LAS file in a zip archive, streamed from the archive,
+    into the outputs named by las_io.member_outputs; other members are
+    skipped. With workers > 1 and several members, the members run in
+    parallel, one process each. Returns the combined metrics, with each
+    member's metrics under "members".
+    '''
+    members = las_io.zip_members(lidar_file)
+    if not members:
+        raise las_io.LasError("{} contains no LAS files.".format(lidar_file))
+    outputs = las_io.member_outputs(output_file, members)
+    logs = las_io.member_outputs(iteration_log, members) if iteration_log else [None] * len(members)
+    if len(members) == 1:
+        return run(lidar_file, output_file, seed, tile_size, cache_dir, cache_size, reporter, metrics_file,
+                   iteration_log, workers, members[0], instrument_every, profile_interval, **params)
+
+    reporter = reporter or progress.ProgressReporter()
+    print("Segmenting {} LAS files in {}...\n".format(len(members), lidar_file), flush=True)
+    tasks = [(lidar_file, member, output, seed, tile_size, cache_dir, cache_size, log, instrument_every,
+              profile_interval, params) for member, output, log in zip(members, outputs, logs)]
+    results = []
+    with reporter.stage("ransac"):
+        if workers > 1:
+            from multiprocessing import Pool
+            with Pool(min(workers, len(tasks))) as pool:
+                for metrics in pool.imap_unordered(_run_member, tasks):
+                    results.append(metrics)
+                    reporter("Segmenting archive members", len(results), len(tasks))
+        else:
+            for task in tasks:
+                results.append(_run_member(task))
+                reporter("Segmenting archive members", len(results), len(tasks))
+    results.sort(key=lambda metrics: members.index(metrics["member"]))
+    reporter.points = sum(metrics["points"] for metrics in results)
+    metrics = reporter.finish(metrics_file, input=lidar_file, output=outputs,
+                              total_points=sum(metrics["total_points"] for metrics in results),
+                              params=resolve_params(params), seed=seed, tile_size=tile_size, workers=workers,
+                              members=results)
+    print("Elapsed Time: {} Minutes, Done!".format(metrics["wall"] / 60.0), flush=True)
+    return metrics
+
+
+def _run_member(task):
+    (lidar_file, member, output_file, seed, tile_size, cache_dir, cache_size, iteration_log, instrument_every,
+     profile_interval, params) = task
+    # Members report through the archive's progress only.
+    return run(lidar_file, output_file, seed, tile_size, cache_dir, cache_size,
+               progress.ProgressReporter(text=False), None, iteration_log, 1, member, instrument_every,
+               profile_interval, **params)
+
+
+def physical_cores():
+    import parallel
+    return parallel.physical_cores()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="RANSAC plane segmentation (NumPy backend).")
+    sub = parser.add_subparsers(dest="command")
+    cmd = sub.add_parser("run")
+    cmd.add_argument("--wd", default="", help="Working Directory.")
+    cmd.add_argument("--lidarFile", required=True, help="Name of your input .las file.")
+    cmd.add_argument("--outputFile", required=True, help="Name of output .las file.")
+    for name, default in DEFAULT_PARAMS.items():
+        cmd.add_argument("--" + name, type=type(default), default=default, choices=PARAM_CHOICES.get(name))
+    cmd.add_argument("--seed", type=int, default=0, help="Seed of the hypothesis sampler.")
+    cmd.add_argument("--tileSize", type=float, default=0.0,
+                     help="Process the file in square XY tiles of this size to bound memory (0: whole file at once).")
+    cmd.add_argument("--cacheDir", default="", help="Directory for cached neighbourhood indexes (default: no caching).")
+    cmd.add_argument("--cacheSize", type=float, default=20.0, help="Size limit of the cache directory in GB.")
+    cmd.add_argument("--progress", choices=("text", "json"), default="text",
+                     help="json also sends structured progress events to stderr.")
+    cmd.add_argument("--metricsFile", default="", help="Write stage timings and throughput to this JSON file.")
+    cmd.add_argument("-j", "--workers", type=int, default=1,
+                     help="Processes running RANSAC (0: one per CPU). Results do not depend on it.")
+    cmd.add_argument("--iterationLog", default="", help="Write the iterations used by each neighbourhood to this CSV file.")
+    cmd.add_argument("--instrumentEvery", type=int, default=0,
+                     help="Write per-neighbourhood instrumentation next to the output, keeping the records of every "
+                          "Nth point (0: off).")
+    cmd.add_argument("--profileInterval", type=float, default=0.0,
+                     help="With --instrumentEvery, also sample the call stack every this many milliseconds (0: off).")
+    args = parser.parse_args(argv)
+    if args.command != "run":
+        parser.print_help()
+        return 2
+    if args.cacheDir and args.tileSize > 0:
+        parser.error("--cacheDir cannot be combined with --tileSize.")
+
+    # Same quoting conventions as the compiled tool.
+    lidar_file = args.lidarFile.replace("'", "")
+    output_file = args.outputFile.replace("'", "")
+    params = dict((name, getattr(args, name)) for name in DEFAULT_PARAMS)
+    try:
+        if args.progress == "json":
+            reporter = progress.ProgressReporter(json_stream=sys.stderr, text=False)
+        else:
+            reporter = progress.ProgressReporter()
+        run(lidar_file, output_file, seed=args.seed, tile_size=args.tileSize,
+            cache_dir=args.cacheDir.replace("'", ""), cache_size=args.cacheSize,
+            reporter=reporter, metrics_file=args.metricsFile.replace("'", ""),
+            iteration_log=args.iterationLog.replace("'", ""), workers=args.workers or physical_cores(),
+            instrument_every=args.instrumentEvery, profile_interval=args.profileInterval / 1000.0, **params)
+    except (OSError, las_io.LasError, ValueError) as err:
+        print("Error: {}".format(err), flush=True)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,612 @@
+'''
+The Tk interface of Ransac_runner.py, imported only when the GUI is
+launched. Its parameter widgets are generated from Ransac_runner.PARAMETERS.
+'''
+import os, queue, threading
+from os import path
+from pathlib import Path
+from sys import platform as _platform
+import tkinter as tk
+from tkinter import ttk
+from tkinter.scrolledtext import ScrolledText
+from tkinter import filedialog
+from tkinter import messagebox
+from subprocess import CalledProcessError, Popen, PIPE, STDOUT
+
+import progress
+import Ransac_runner
+
+# How often the GUI drains tool output, and the most lines handled per drain
+# so that a flood of output cannot starve the Tk event loop.
+OUTPUT_POLL_MS = 50
+MAX_LINES_PER_POLL = 2000
+
+# Widget value types of parameter types.
+VALUE_TYPES = {int: "Integer", float: "Float", str: "String"}
+
+class FileSelector(tk.Frame):
+    def __init__(self, spec, runner, master=None, tooltip_label=None):
+        self.tooltip_label = tooltip_label
+
+        # spec is an entry of Ransac_runner.PARAMETERS with a "file" key
+        self.name = spec['label']
+        self.description = spec['description']
+        self.flag = "--" + Ransac_runner.engine_flag(spec)
+        self.file_type = "Lidar"
+        self.parameter_type = {"ExistingFile" if spec['file'] == "input" else "NewFile": self.file_type}
+        self.optional = spec.get('optional', False)
+        default_value = spec['default']
+
+        self.runner = runner
+
+        ttk.Frame.__init__(self, master, padding='0.02i')
+        self.grid()
+
+        self.bind("<Enter>", self.onEnter)
+        self.bind("<Leave>", self.onLeave)
+
+        self.label = ttk.Label(self, text=self.name, justify=tk.LEFT)
+        self.label.grid(row=0, column=0, sticky=tk.W)
+        self.label.columnconfigure(0, weight=1)
+
+        if not self.optional:
+            self.label['text'] = self.label['text'] + "*"
+
+        fs_frame = ttk.Frame(self, padding='0.0i')
+        self.value = tk.StringVar()
+        self.entry = ttk.Entry(
+            fs_frame, width=45, justify=tk.LEFT, textvariable=self.value)
+        self.entry.grid(row=0, column=0, sticky=tk.NSEW)
+        self.entry.columnconfigure(0, weight=1)
+        if default_value:
+            self.value.set(default_value)
+
+        # self.open_button = ttk.Button(fs_frame, width=4, image = self.open_file_icon, command=self.select_file, padding = '0.02i')
+        self.open_button = ttk.Button(fs_frame, width=4, text="...", command=self.select_file, padding = '0.02i')
+        self.open_button.grid(row=0, column=1, sticky=tk.E)
+        self.open_button.columnconfigure(0, weight=1)
+
+        fs_frame.grid(row=1, column=0, sticky=tk.NSEW)
+        fs_frame.columnconfigure(0, weight=10)
+        fs_frame.columnconfigure(1, weight=1)
+        # self.pack(fill=tk.BOTH, expand=1)
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        self.rowconfigure(1, weight=1)
+
+        # Add the bindings
+        if _platform == "darwin":
+            self.entry.bind("<Command-Key-a>", self.select_all)
+        else:
+            self.entry.bind("<Control-Key-a>", self.select_all)
+        
+    def onEnter(self, event=None):
+        self.tooltip_label.configure(text=self.description)
+        # self.update()  # this is needed for cancelling and updating the progress bar
+
+    def onLeave(self, event=None):
+        self.tooltip_label.configure(text="")
+        # self.update()  # this is needed for cancelling and updating the progress bar
+
+    def select_file(self):
+        try:
+            result = self.value.get()
+            if self.parameter_type == "Directory":
+                result = filedialog.askdirectory()
+                
+            elif "ExistingFile" in self.parameter_type:
+                ftypes = [('All files', '*.*')]
+                if 'Lidar' in self.file_type:
+                    ftypes = [("LiDAR files", ('*.las', '*.zip'))]
+
+                result = filedialog.askopenfilename(initialdir=self.runner.working_dir, title="Select file", filetypes=ftypes)
+                
+            elif "NewFile" in self.parameter_type:
+                result = filedialog.asksaveasfilename()
+                
+            self.value.set(result)
+            # update the working directory
+            self.runner.working_dir = os.path.dirname(result)
+            # print(self.runner.working_dir)
+
+        except:
+            t = "file"
+            if self.parameter_type == "Directory":
+                t = "directory"
+            messagebox.showinfo("Warning", "Could not find {}".format(t))
+
+    def get_value(self):
+        if self.value.get():
+            v = self.value.get()
+            # Do some quality assurance here.
+            # Is there a directory included?
+            if not path.dirname(v):
+                v = path.join(self.runner.working_dir, v)
+
+            # What about a file extension?
+            ext = os.path.splitext(v)[-1].lower().strip()
+            if not ext:
+                ext = ""
+                if 'Lidar' in self.file_type:
+                    ext = '.las'
+                v += ext
+            v = path.normpath(v)
+
+            return "{}='{}'".format(self.flag, v)
+        else:
+            t = "file"
+            if self.parameter_type == "Directory":
+                t = "directory"
+            if not self.optional:
+                messagebox.showinfo(
+                    "Error", "Unspecified {} parameter {}.".format(t, self.flag))
+        return None
+
+    def select_all(self, event):
+        self.entry.select_range(0, tk.END)
+        return 'break'
+
+class DataInput(tk.Frame):
+    def __init__(self, spec, master=None, tooltip_label=None):
+        self.tooltip_label = tooltip_label
+
+        # spec is an entry of Ransac_runner.PARAMETERS
+        self.name = spec['label']
+        self.description = spec['description']
+        self.flag = "--" + Ransac_runner.engine_flag(spec)
+        self.parameter_type = VALUE_TYPES[spec['type']]
+        self.optional = spec.get('optional', False)
+        default_value = str(spec.get('gui_default', spec['default']))
+        self.description = "{} (Default: {}).".format(self.description.rstrip("."), default_value)
+
+        ttk.Frame.__init__(self, master)
+        self.grid()
+        self['padding'] = '0.1i'
+
+        self.bind("<Enter>", self.onEnter)
+        self.bind("<Leave>", self.onLeave)
+
+        self.label = ttk.Label(self, text=self.name, justify=tk.LEFT)
+        self.label.grid(row=0, column=0, sticky=tk.W)
+        self.label.columnconfigure(0, weight=1)
+
+        self.value = tk.StringVar()
+        if default_value:
+            self.value.set(default_value)
+        else:
+            self.value.set("")
+
+        self.entry = ttk.Entry(self, justify=tk.LEFT, textvariable=self.value)
+        self.entry.grid(row=0, column=1, sticky=tk.NSEW)
+        self.entry.columnconfigure(1, weight=10)
+
+        if not self.optional:
+            self.label['text'] = self.label['text'] + "*"
+
+        if ("Integer" in self.parameter_type or
+            "Float" in self.parameter_type or
+                "Double" in self.parameter_type):
+            self.entry['justify'] = 'right'
+
+        # Add the bindings
+        if _platform == "darwin":
+            self.entry.bind("<Command-Key-a>", self.select_all)
+        else:
+            self.entry.bind("<Control-Key-a>", self.select_all)
+
+        # self.pack(fill=tk.BOTH, expand=1)
+        self.columnconfigure(0, weight=1)
+        self.columnconfigure(1, weight=10)
+        self.rowconfigure(0, weight=1)
+
+    def onEnter(self, event=None):
+        self.tooltip_label.configure(text=self.description)
+        # self.update()  # this is needed for cancelling and updating the progress bar
+
+    def onLeave(self, event=None):
+        self.tooltip_label.configure(text="")
+        self.update()  # this is needed for cancelling and updating the progress bar
+
+    def RepresentsInt(self, s):
+        try:
+            int(s)
+            return True
+        except ValueError:
+            return False
+
+    def RepresentsFloat(self, s):
+        try:
+            float(s)
+            return True
+        except ValueError:
+            return False
+
+    def get_value(self):
+        v = self.value.get()
+        if v:
+            if "Integer" in self.parameter_type:
+                if self.RepresentsInt(self.value.get()):
+                    return "{}={}".format(self.flag, self.value.get())
+                else:
+                    messagebox.showinfo(
+                        "Error", "Error converting parameter {} to type Integer.".format(self.flag))
+            elif "Float" in self.parameter_type:
+                if self.RepresentsFloat(self.value.get()):
+                    return "{}={}".format(self.flag, self.value.get())
+                else:
+                    messagebox.showinfo(
+                        "Error", "Error converting parameter {} to type Float.".format(self.flag))
+            elif "Double" in self.parameter_type:
+                if self.RepresentsFloat(self.value.get()):
+                    return "{}={}".format(self.flag, self.value.get())
+                else:
+                    messagebox.showinfo(
+                        "Error", "Error converting parameter {} to type Double.".format(self.flag))
+            else:  # String or StringOrNumber types
+                return "{}='{}'".format(self.flag, self.value.get())
+        else:
+            if not self.optional:
+                messagebox.showinfo(
+                    "Error", "Unspecified non-optional parameter {}.".format(self.flag))
+        return None
+
+    def select_all(self, event):
+        self.entry.select_range(0, tk.END)
+        return 'break'
+
+class Gui(tk.Frame):
+    def __init__(self, tool_name=None, master=None, backend="binary", results=None):
+        self.exe_name = "./" + path.basename(Ransac_runner.segmenter_exe())
+
+        self.exe_path = path.dirname(path.abspath(__file__))
+        self.backend = backend
+        self.results = results
+        self.pending_result = None
+        self.metrics_file = None
+        self.run_params = {}
+
+        self.cancel_op = False
+        self.proc = None
+        self.output_queue = None
+        self.open_streams = 0
+        self.adapter = None
+
+        ttk.Frame.__init__(self, master)
+        self.script_dir = os.path.dirname(os.path.realpath(__file__))
+        self.grid()
+        self.tool_name = tool_name
+        self.master.title("RANSAC PLANE SEGMENTATION")
+        # if _platform == "darwin":
+        #     os.system(
+        #         '''/usr/bin/osascript -e 'tell app "Finder" to set frontmost of process "Python" to true' ''')
+        
+        #########################################################
+        #              Overall/Top level Frame                  #
+        #########################################################     
+        #define left-side frame (toplevel_frame) and right-side frame (overall_frame)
+        # toplevel_frame = ttk.Frame(self, padding='0.1i')
+        overall_frame = ttk.Frame(self, padding='0.1i')
+        #set-up layout
+        overall_frame.grid(row=0, column=0, sticky=tk.NSEW)
+        # toplevel_frame.grid(row=0, column=0, sticky=tk.NSEW) 
+
+        ##################
+        # Tool tip label #
+        ##################
+        tooltip_frame = ttk.Frame(overall_frame, padding='0.1i')
+        self.tt_label = ttk.Label(tooltip_frame, text="")
+        style = ttk.Style()
+        style.configure("Blue.Label", foreground="dark blue")
+        self.tt_label.configure(style="Blue.Label")
+        self.tt_label.grid(row=0, column=0, sticky=tk.W)
+        tooltip_frame.grid(row=4, column=0, columnspan=2, sticky=tk.NSEW)
+        
+        # Add GUI elements
+        self.elements_frame = ttk.Frame(overall_frame, padding='0.1i')
+
+        for param_num, spec in enumerate(Ransac_runner.gui_parameters(self.backend)):
+            if "file" in spec:
+                element = FileSelector(spec, self, self.elements_frame, self.tt_label)
+            else:
+                element = DataInput(spec, self.elements_frame, self.tt_label)
+            element.grid(row=param_num, column=0, sticky=tk.NSEW)
+        self.elements_frame.grid(row=0, column=0, sticky=tk.NSEW)
+
+        #########################################################
+        #                   Buttons Frame                       #
+        #########################################################
+
+        #Create the elements of the buttons frame
+        buttons_frame = ttk.Frame(overall_frame, padding='0.1i')
+        self.run_button = ttk.Button(buttons_frame, text="Run", width=8, command=self.run_tool)
+        self.quit_button = ttk.Button(buttons_frame, text="Cancel", width=8, command=self.cancel_operation)
+        self.close_button = ttk.Button(buttons_frame, text="Close", width=8, command=self.quit)
+
+        #Define layout of the frame
+        self.run_button.grid(row=0, column=0)
+        self.quit_button.grid(row=0, column=1)
+        self.close_button.grid(row=0, column=2)
+        if self.results is not None:
+            self.bypass_var = tk.BooleanVar(value=self.results.bypass)
+            self.bypass_check = ttk.Checkbutton(buttons_frame, text="Recompute (bypass result cache)",
+                                                variable=self.bypass_var)
+            self.bypass_check.grid(row=0, column=3, padx=5)
+        buttons_frame.grid(row=1, column=0, columnspan=2, sticky=tk.E)
+
+        #########################################################
+        #                  Output Frame                         #
+        #########################################################              
+        #Create the elements of the output frame
+        output_frame = ttk.Frame(overall_frame)
+        outlabel = ttk.Label(output_frame, text="Output:", justify=tk.LEFT)
+        self.out_text = ScrolledText(output_frame, width=63, height=8, wrap=tk.NONE, padx=7, pady=7, exportselection = 0)
+        output_scrollbar = ttk.Scrollbar(output_frame, orient=tk.HORIZONTAL, command = self.out_text.xview)
+        self.out_text['xscrollcommand'] = output_scrollbar.set
+        #Retreive and insert the text for the current tool
+        # k = wbt.tool_help(self.tool_name)   
+        # self.out_text.insert(tk.END, k)
+        #Define layout of the frame
+        outlabel.grid(row=0, column=0, sticky=tk.NW)
+        self.out_text.grid(row=1, column=0, sticky=tk.NSEW)
+        output_frame.grid(row=2, column=0, columnspan = 2, sticky=(tk.NS, tk.E))
+        output_scrollbar.grid(row=2, column=0, sticky=(tk.W, tk.E))
+
+        #Configure rows and columns of the frame
+        self.out_text.columnconfigure(0, weight=1)
+        output_frame.columnconfigure(0, weight=1)
+        # Add the binding
+        if _platform == "darwin":
+            self.out_text.bind("<Command-Key-a>", self.select_all)
+        else:
+            self.out_text.bind("<Control-Key-a>", self.select_all)
+            
+        #########################################################
+        #                  Progress Frame                       #
+        #########################################################        
+        #Create the elements of the progress frame
+        progress_frame = ttk.Frame(overall_frame, padding='0.1i')
+        self.progress_label = ttk.Label(progress_frame, text="Progress:", justify=tk.LEFT)
+        self.progress_var = tk.DoubleVar()
+        self.progress = ttk.Progressbar(progress_frame, orient="horizontal", variable=self.progress_var, length=200, maximum=100)
+
+        #Define layout of the frame
+        self.progress_label.grid(row=0, column=0, sticky=tk.E, padx=5)
+        self.progress.grid(row=0, column=1, sticky=tk.E)
+        progress_frame.grid(row=3, column=0, columnspan = 2, sticky=tk.SE)
+
+        self.working_dir = str(Path.home())
+
+    def run_tool(self):
+        if self.proc is not None:
+            return
+        try:
+            args = []
+            for widget in self.elements_frame.winfo_children():
+                v = widget.get_value()
+                if v:
+                    args.append(v)
+                elif not widget.optional:
+                    messagebox.showinfo(
+                        "Error", "Non-optional tool parameter not specified.")
+                    return
+
+            ''' 
+            Starts a tool with the specified tool arguments without blocking
+            the Tk thread; its output is handled by poll_output.
+            Returns 0 if the tool was started.
+            Returns 1 if error encountered (details are sent to callback).
+            '''
+
+            os.chdir(self.exe_path)
+            args2 = []
+            
+            if self.backend == "python":
+                args2.extend(Ransac_runner.segmenter_command(self.backend))
+            else:
+                args2.append("." + path.sep + self.exe_name)
+            # args2.append("--run=\"{}\"".format(to_camelcase(tool_name)))
+            args2.append("run")
+
+            if self.working_dir not in args2:
+                args2.append("--wd=\"{}\"".format(self.working_dir)) 
+
+            for arg in args:
+                args2.append(arg)
+
+            cl = ""
+            for v in args2:
+                cl += v + " "
+            self.custom_callback(cl.strip() + "\n")
+
+            # Every run leaves its stage timings next to its output, like
+            # batch runs do.
+            files = dict(filter(None, map(Ransac_runner.parse_flag, args2)))
+            self.metrics_file = Ransac_runner.metrics_path(files["outputFile"]) if files.get("outputFile") else None
+            self.run_params = dict(Ransac_runner.result_parameters(args2))
+
+            if self.results is not None and self.use_cached_result(args2):
+                return 0
+
+            # The python backend sends structured progress events on stderr
+            # and writes its own metrics; the compiled tool's text progress
+            # goes through an adapter, which also yields its metrics.
+            structured = self.backend == "python"
+            if structured:
+                args2.append("--progress=json")
+                if self.metrics_file:
+                    args2.append("--metricsFile={}".format(self.metrics_file))
+            self.adapter = progress.TextProgressAdapter()
+            self.proc = Popen(args2, shell=False, stdout=PIPE, stderr=PIPE if structured else STDOUT,
+                              bufsize=1, universal_newlines=True)
+            self.output_queue = queue.Queue()
+            streams = [self.proc.stdout] + ([self.proc.stderr] if structured else [])
+            self.open_streams = len(streams)
+            for stream in streams:
+                reader = threading.Thread(target=self.read_output, args=(stream, self.output_queue))
+                reader.daemon = True
+                reader.start()
+
+            self.run_button['state'] = 'disabled'
+            self.after(OUTPUT_POLL_MS, self.poll_output)
+            return 0
+        except (OSError, ValueError, CalledProcessError) as err:
+            self.custom_callback(str(err))
+            self.reset_progress()
+            return 1
+
+    def use_cached_result(self, args):
+        ''' Restores the output of args from the result cache. Returns True on
+        a hit; on a miss the job is remembered so finish_run can cache it.
+        '''
+        files = dict(filter(None, map(Ransac_runner.parse_flag, args)))
+        input_file, output_file = files.get("lidarFile"), files.get("outputFile")
+        if not input_file or not output_file:
+            return False
+        self.results.bypass = self.bypass_var.get()
+        key = self.results.key(input_file, args)
+        if self.results.restore(key, output_file, self.metrics_file):
+            self.print_line_to_output("Output restored from the result cache.")
+            self.print_line_to_output(self.results.summary())
+            return True
+        # The segmenter may write into an existing output, which may be a
+        # read-only link into the cache restored by an earlier version.
+        import cache
+        cache.remove_file(output_file)
+        self.pending_result = (key, output_file, self.metrics_file)
+        return False
+
+    def read_output(self, stream, output_queue):
+        ''' Runs on a background thread, moving one of the tool's output
+        streams into a queue that the Tk thread drains in poll_output. JSON
+        progress events are queued as dicts. None marks the end of the stream.
+        '''
+        try:
+            for line in stream:
+                event = progress.parse_event(line)
+                output_queue.put(event if event is not None else line)
+        finally:
+            stream.close()
+            output_queue.put(None)
+
+    def poll_output(self):
+        ''' Drains the output queue on a timer. Log lines are inserted into the
+        output box in one batch and only the latest progress update is shown.
+        '''
+        lines = []
+        latest = None
+        for _ in range(MAX_LINES_PER_POLL):
+            try:
+                item = self.output_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.open_streams -= 1
+                if self.open_streams == 0:
+                    break
+                continue
+            if isinstance(item, dict):
+                if item["type"] == "progress":
+                    latest = item
+                elif item["type"] == "done":
+                    lines.append(Ransac_runner.format_metrics(item))
+                continue
+            line = item.strip()
+            event = self.adapter.feed(line)
+            if event is not None:
+                latest = event
+            else:
+                lines.append(line)
+
+        if lines:
+            self.print_to_output("\n".join(lines) + "\n")
+        if latest is not None:
+            self.show_progress(latest)
+
+        if self.open_streams == 0:
+            self.finish_run()
+        else:
+            self.after(OUTPUT_POLL_MS, self.poll_output)
+
+    def show_progress(self, event):
+        self.progress_label['text'] = Ransac_runner.format_progress(event)
+        self.progress_var.set(int(100.0 * event["done"] / event["total"]) if event["total"] else 100)
+
+    def finish_run(self):
+        ''' Returns 0 if the tool completed without error, 1 if it failed and
+        2 if it was cancelled by the user.
+        '''
+        returncode = self.proc.wait()
+        if self.cancel_op:
+            self.cancel_op = False
+            self.print_line_to_output("Operation cancelled.")
+            status = 2
+        elif returncode != 0:
+            self.print_line_to_output("Tool exited with code {}.".format(returncode))
+            status = 1
+        else:
+            status = 0
+        if self.backend != "python" and self.metrics_file:
+            self.write_metrics(returncode)
+        if self.pending_result is not None:
+            if status == 0:
+                try:
+                    self.results.store(*self.pending_result)
+                except OSError as err:
+                    self.print_line_to_output("Could not cache the result: {}".format(err))
+                self.print_line_to_output(self.results.summary())
+            self.pending_result = None
+        self.proc = None
+        self.run_button['state'] = 'normal'
+        self.reset_progress()
+        return status
+
+    def write_metrics(self, returncode):
+        ''' Writes the metrics of a compiled tool run, derived from its text
+        output, to the run's metrics file.
+        '''
+        files = dict(filter(None, map(Ransac_runner.parse_flag, self.proc.args)))
+        metrics = self.adapter.metrics(input=files.get("lidarFile"), output=files.get("outputFile"),
+                                       params=self.run_params, returncode=returncode)
+        try:
+            progress.write_metrics(self.metrics_file, metrics)
+        except OSError as err:
+            self.print_line_to_output("Could not write {}: {}".format(self.metrics_file, err))
+            return
+        if returncode == 0:
+            self.print_line_to_output(Ransac_runner.format_metrics(metrics))
+
+    def reset_progress(self):
+        self.progress_var.set(0)
+        self.progress_label['text'] = "Completion:"
+
+    def custom_callback(self, value):
+        ''' A custom callback for dealing with tool output.
+        '''
+        parsed = progress.parse_percent(value)
+        if parsed is not None:
+            self.progress_label['text'], percent = parsed
+            self.progress_var.set(int(percent))
+        else:
+            self.print_line_to_output(value)
+
+    def print_to_output(self, value):
+        self.out_text.insert(tk.END, value)
+        self.out_text.see(tk.END)
+
+    def print_line_to_output(self, value):
+        self.out_text.insert(tk.END, value + "\n")
+        self.out_text.see(tk.END)
+        
+    def cancel_operation(self):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.cancel_op = True
+        self.print_line_to_output("Cancelling operation...")
+        # poll_output reports the cancellation once the reader sees the pipe close.
+        self.proc.terminate()
+
+    def select_all(self, event):
+        self.out_text.tag_add(tk.SEL, "1.0", tk.END)
+        self.out_text.mark_set(tk.INSERT, "1.0")
+        self.out_text.see(tk.INSERT)
+        return 'break'
@@ -0,0 +1,109 @@
+'''
+Correctness report of the seeded search against the exhaustive search.
+
+Both modes segment the same file with the same parameters and seed, sharing
+one neighbourhood index. The report gives the share of neighbourhoods the
+seeded mode settled by reusing a plane, the RANSAC time of each mode, and
+how the seeded planar labels (class 0) differ from the exhaustive ones. For
+synthetic tiles (see synthetic_las.py) --truth also scores both modes
+against the ground truth.
+
+    python seeding_report.py --lidarFile=in.las --threshold=0.15 --output=report.json
+'''
+import argparse, json, sys, time
+
+import numpy as np
+
+import las_io
+import ransac_engine
+import synthetic_las
+
+
+def agreement(reference, labels):
+    ''' Counts and rates of the planar labels in labels against reference.
+    '''
+    both = np.count_nonzero(reference & labels)
+    return {
+        "points": int(len(reference)),
+        "planar_reference": int(np.count_nonzero(reference)),
+        "planar": int(np.count_nonzero(labels)),
+        "only_reference": int(np.count_nonzero(reference & ~labels)),
+        "only_labels": int(np.count_nonzero(labels & ~reference)),
+        "agreement": float(np.mean(reference == labels)) if len(reference) else 1.0,
+        "precision": both / float(max(np.count_nonzero(labels), 1)),
+        "recall": both / float(max(np.count_nonzero(reference), 1)),
+    }
+
+
+def seeding_report(lidar_file, seed=0, truth=False, progress=None, **params):
+    ''' Runs both search modes on lidar_file and returns the report as a dict.
+    '''
+    params = ransac_engine.resolve_params(params)
+    las = las_io.LasFile(lidar_file)
+    nb = ransac_engine.Neighbourhoods(*las.read_quantized(), search_dist=params["searchDist"])
+    report = {"input": lidar_file, "params": params, "seed": seed, "modes": {}}
+    planar = {}
+    for mode in ("exhaustive", "seeded"):
+        log = ransac_engine.IterationLog(budget=params["iterations"])
+        started = time.perf_counter()
+        classes = ransac_engine.segment_neighbourhoods(nb, len(las), seed=seed, progress=progress, iteration_log=log,
+                                                       **dict(params, search=mode))
+        planar[mode] = classes == ransac_engine.NEVER_CLASSIFIED
+        summary = log.summary()
+        report["modes"][mode] = {
+            "seconds": time.perf_counter() - started,
+            "planar": int(np.count_nonzero(planar[mode])),
+            "mean_iterations": summary["mean"],
+            "reused_fraction": summary["reused"] / float(max(summary["neighbourhoods"], 1)),
+        }
+        if truth:
+            report["modes"][mode]["truth"] = agreement(synthetic_las.truth(las), planar[mode])
+    report["seeded_vs_exhaustive"] = agreement(planar["exhaustive"], planar["seeded"])
+    seconds = report["modes"]["seeded"]["seconds"]
+    report["speedup"] = report["modes"]["exhaustive"]["seconds"] / seconds if seconds > 0 else None
+    return report
+
+
+def print_report(report, echo=print):
+    for mode, result in report["modes"].items():
+        text = "{:>10}: {:8.2f} s  {:>10,} planar  {:5.1f} iterations/neighbourhood  {:5.1%} reused".format(
+            mode, result["seconds"], result["planar"], result["mean_iterations"], result["reused_fraction"])
+        if "truth" in result:
+            text += "  truth P {:.4f} R {:.4f}".format(result["truth"]["precision"], result["truth"]["recall"])
+        echo(text)
+    diff = report["seeded_vs_exhaustive"]
+    echo("Seeded vs exhaustive: {:.4%} of points agree; {:,} planar only in exhaustive, {:,} only in seeded "
+         "(precision {:.4f}, recall {:.4f})".format(diff["agreement"], diff["only_reference"], diff["only_labels"],
+                                                    diff["precision"], diff["recall"]))
+    if report["speedup"]:
+        echo("Speedup: {:.2f}x".format(report["speedup"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare seeded and exhaustive RANSAC labels on one file.")
+    parser.add_argument("--lidarFile", required=True, help="Name of your input .las file.")
+    for name, default in ransac_engine.DEFAULT_PARAMS.items():
+        if name != "search":
+            parser.add_argument("--" + name, type=type(default), default=default,
+                                choices=ransac_engine.PARAM_CHOICES.get(name))
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the hypothesis sampler.")
+    parser.add_argument("--truth", action="store_true",
+                        help="Also score both modes against the ground truth of a synthetic tile.")
+    parser.add_argument("--output", default="", help="Write the report to this JSON file.")
+    args = parser.parse_args(argv)
+
+    params = dict((name, getattr(args, name)) for name in ransac_engine.DEFAULT_PARAMS if name != "search")
+    try:
+        report = seeding_report(args.lidarFile.replace("'", ""), args.seed, args.truth, **params)
+    except (OSError, las_io.LasError, ValueError) as err:
+        print("Error: {}".format(err), flush=True)
+        return 1
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+'''
+Parameter sweeps: evaluates many RANSAC settings in one pass over a tile.
+
+The points are read and their neighbourhoods found once (and stored on disk,
+in the neighbourhood cache if one is given). Worker processes then map the
+stored neighbourhoods and evaluate every parameter combination for their
+share of the points. Combinations with the same numSamples reuse the same
+hypothesis draws. One labelled output is written per combination, plus a
+summary table:
+
+    python sweep.py --lidarFile=in.las --outputDir=sweep --threshold=0.1:0.3:0.05 --iterations=25,50,100
+'''
+import argparse, csv, itertools, os, shutil, sys, tempfile, time
+from multiprocessing import Pool
+
+import numpy as np
+
+import cache
+import las_io
+import progress
+import ransac_engine
+
+SWEPT_PARAMETERS = ["threshold", "iterations", "maxSlope", "numSamples", "acceptableModelSize"]
+
+
+def parse_values(text, kind):
+    ''' Parses a comma separated list of values and inclusive start:stop:step
+    ranges, e.g. "0.1,0.2:0.4:0.1".
+    '''
+    values = []
+    for item in str(text).split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if ":" in item:
+            parts = item.split(":")
+            if len(parts) != 3:
+                raise ValueError("Ranges are written start:stop:step, got '{}'.".format(item))
+            start, stop, step = (kind(p) for p in parts)
+            if step <= 0:
+                raise ValueError("Range step must be positive in '{}'.".format(item))
+            count = int(np.floor((stop - start) / step + 1e-9)) + 1
+            values.extend(kind(round(start + i * step, 12)) for i in range(count))
+        else:
+            values.append(kind(item))
+    if not values:
+        raise ValueError("No values in '{}'.".format(text))
+    return values
+
+
+def combinations(grid):
+    ''' Every parameter set of a {name: [values]} grid, in a stable order.
+    '''
+    names = [name for name in SWEPT_PARAMETERS if name in grid]
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+# Per-process state of the sweep workers, set by _init_worker.
+_worker = {}
+
+
+def _init_worker(directory, n_points, param_sets, seed):
+    _worker["nb"] = cache.StoredNeighbourhoods(directory)
+    _worker["n_points"] = n_points
+    _worker["param_sets"] = param_sets
+    _worker["seed"] = seed
+
+
+def _evaluate_chunk(start):
+    ''' Evaluates every parameter set for one chunk of neighbourhoods.
+    Returns (planar rows, RMSE sum, models found, seconds) per set.
+    '''
+    nb = _worker["nb"]
+    rows, offsets, indices = nb.chunk(start, start + ransac_engine.CHUNK_SIZE)
+    labelled, rmse, seconds = ransac_engine.label_neighbourhoods_sweep(
+        nb.xyz, np.asarray(nb.xyz[rows]), np.asarray(nb.rows[rows]), offsets, indices,
+        _worker["param_sets"], _worker["seed"], rows)
+    results = []
+    for k in range(len(labelled)):
+        found = np.isfinite(rmse[k])
+        results.append((np.unique(indices[labelled[k]]), rmse[k][found].sum(), found.sum(), seconds[k]))
+    return results
+
+
+def run_sweep(lidar_file, output_dir, grid, search_dist=ransac_engine.DEFAULT_PARAMS["searchDist"], seed=0,
+              workers=None, cache_dir=None, cache_size=20.0, progress=None, echo=print):
+    ''' Runs every combination of the parameter grid on one file. Returns the
+    summary rows, one dict per combination.
+    '''
+    param_sets = combinations(grid)
+    full_sets = [dict(p, searchDist=search_dist) for p in param_sets]
+    for params in full_sets:
+        ransac_engine.resolve_params(params)
+    os.makedirs(output_dir, exist_ok=True)
+    las = las_io.LasFile(lidar_file)
+
+    started = time.time()
+    temp = None
+    if cache_dir:
+        nb = cache.NeighbourCache(cache_dir, cache_size * 1e9).load_or_build(las, search_dist, progress)
+    else:
+        temp = tempfile.mkdtemp(prefix="ransac_sweep_", dir=output_dir)
+        cache.save_neighbourhoods(ransac_engine.Neighbourhoods(*las.read_quantized(), search_dist=search_dist), temp, progress)
+        nb = cache.StoredNeighbourhoods(temp)
+    echo("Neighbourhoods ready in {:.1f} s; evaluating {} combinations...".format(time.time() - started, len(full_sets)))
+
+    try:
+        planar = [np.zeros(len(nb.rows), dtype=bool) for _ in full_sets]
+        rmse_sum = [0.0] * len(full_sets)
+        found = [0] * len(full_sets)
+        seconds = [0.0] * len(full_sets)
+        chunks = range(0, len(nb), ransac_engine.CHUNK_SIZE)
+        with Pool(workers or os.cpu_count() or 1, _init_worker, (nb.directory, len(las), full_sets, seed)) as pool:
+            for done, results in enumerate(pool.imap_unordered(_evaluate_chunk, chunks), 1):
+                for k, (rows, rmse, count, secs) in enumerate(results):
+                    planar[k][rows] = True
+                    rmse_sum[k] += rmse
+                    found[k] += count
+                    seconds[k] += secs
+                if progress is not None:
+                    progress("Evaluating parameter combinations", done, len(chunks))
+
+        stem = os.path.splitext(os.path.basename(lidar_file))[0]
+        summary = []
+        for k, params in enumerate(param_sets):
+            classes = np.full(len(las), ransac_engine.UNCLASSIFIED, dtype=np.uint8)
+            classes[nb.rows[planar[k]]] = ransac_engine.NEVER_CLASSIFIED
+            output_file = os.path.join(output_dir, "{}_sweep{:03d}.las".format(stem, k))
+            las.write(output_file, classes)
+            row = dict(params)
+            row.update({
+                "planar_fraction": planar[k].sum() / float(max(len(las), 1)),
+                "mean_rmse": rmse_sum[k] / found[k] if found[k] else float("nan"),
+                "seconds": seconds[k],
+                "output": output_file,
+            })
+            summary.append(row)
+    finally:
+        del nb
+        if temp:
+            shutil.rmtree(temp, ignore_errors=True)
+    return summary
+
+
+def write_summary(summary, file_name):
+    with open(file_name, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(summary[0]))
+        writer.writeheader()
+        writer.writerows(summary)
+
+
+def print_summary(summary, echo=print):
+    names = [name for name in SWEPT_PARAMETERS if name in summary[0]]
+    echo("  ".join("{:>10}".format(name[:10]) for name in names) + "  {:>8}  {:>9}  {:>8}".format("planar", "mean RMSE", "seconds"))
+    for row in summary:
+        echo("  ".join("{:>10}".format(row[name]) for name in names) +
+             "  {:>8.3f}  {:>9.4f}  {:>8.2f}".format(row["planar_fraction"], row["mean_rmse"], row["seconds"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate many RANSAC parameter combinations on one file.")
+    parser.add_argument("--lidarFile", required=True, help="Name of your input .las file.")
+    parser.add_argument("--outputDir", required=True, help="Directory for the labelled outputs and the summary.")
+    parser.add_argument("--searchDist", type=float, default=ransac_engine.DEFAULT_PARAMS["searchDist"],
+                        help="Radius distance used in neighbourhood calculation (a single value).")
+    for name in SWEPT_PARAMETERS:
+        parser.add_argument("--" + name, default=str(ransac_engine.DEFAULT_PARAMS[name]),
+                            help="Comma separated values and start:stop:step ranges.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the hypothesis sampler.")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Worker processes (default: CPU count).")
+    parser.add_argument("--cacheDir", default="", help="Neighbourhood cache directory (default: temporary files).")
+    parser.add_argument("--cacheSize", type=float, default=20.0, help="Size limit of the cache directory in GB.")
+    args = parser.parse_args(argv)
+
+    try:
+        grid = dict((name, parse_values(getattr(args, name), type(ransac_engine.DEFAULT_PARAMS[name])))
+                    for name in SWEPT_PARAMETERS)
+    except ValueError as err:
+        parser.error(str(err))
+    lidar_file = args.lidarFile.replace("'", "")
+    try:
+        summary = run_sweep(lidar_file, args.outputDir, grid, args.searchDist, args.seed, args.workers,
+                            args.cacheDir, args.cacheSize, progress.ProgressReporter())
+    except (OSError, las_io.LasError) as err:
+        print("Error: {}".format(err), flush=True)
+        return 1
+    summary_file = os.path.join(args.outputDir, "sweep_summary.csv")
+    write_summary(summary, summary_file)
+    print_summary(summary)
+    print("Summary written to {}".format(summary_file))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+'''
+Synthetic LAS tiles with known ground truth, for benchmarks.
+
+A tile contains gently sloping ground, buildings with gable roofs at set
+slopes, trees whose pulses produce several returns, and low (7) and high
+(18) noise. Points are generated in fixed-size chunks and streamed to disk,
+so tiles of 10^8 points need no more memory than one chunk.
+
+The ground truth is stored in each point's user data byte: 1 for last
+returns on the ground or a roof (what the segmenter should label planar),
+0 for everything else.
+
+    python synthetic_las.py tile.las --points 1e6 --density 10 --seed 1
+'''
+import argparse, sys
+
+import numpy as np
+
+import las_io
+
+TRUTH_PLANAR = 1
+
+# Building lattice: one building per cell, some cells left empty.
+BUILDING_SPACING = 40.0
+BUILDING_SIZE = (16.0, 10.0)
+BUILDING_FILL = 0.7
+DEFAULT_ROOF_SLOPES = (0.0, 15.0, 30.0, 45.0)
+
+# Tree lattice, offset from the buildings.
+TREE_SPACING = 15.0
+TREE_RADIUS = 3.5
+TREE_FILL = 0.5
+
+NOISE_SIGMA = 0.02
+LOW_NOISE_FRACTION = 0.003
+HIGH_NOISE_FRACTION = 0.002
+
+CHUNK = 1 << 20
+
+
+def _cell_random(cells, seed, salt):
+    ''' Deterministic uniform numbers per lattice cell, so every chunk agrees
+    on where the buildings and trees are.
+    '''
+    rng_keys = (cells[:, 0] * 73856093) ^ (cells[:, 1] * 19349663) ^ (seed * 83492791 + salt)
+    return (np.abs(rng_keys) % 1000003) / 1000003.0
+
+
+def ground_z(xy):
+    return 100.0 + 0.02 * xy[:, 0] + 0.01 * xy[:, 1]
+
+
+def roof_z(xy, seed, slopes):
+    ''' Roof height of the building over each point, or NaN outside roofs.
+    '''
+    cells = np.floor(xy / BUILDING_SPACING).astype(np.int64)
+    local = xy - (cells + 0.5) * BUILDING_SPACING
+    half = np.array(BUILDING_SIZE) / 2.0
+    inside = np.all(np.abs(local) < half, axis=1) & (_cell_random(cells, seed, 1) < BUILDING_FILL)
+    slope = np.asarray(slopes)[(_cell_random(cells, seed, 2) * len(slopes)).astype(int) % len(slopes)]
+    eave = 4.0 + 6.0 * _cell_random(cells, seed, 3)
+    # Gable roof with the ridge along x.
+    z = ground_z(xy) + eave + (half[1] - np.abs(local[:, 1])) * np.tan(np.radians(slope))
+    return np.where(inside, z, np.nan)
+
+
+def tree_height(xy, seed):
+    ''' Crown height of the tree over each point, or NaN outside crowns.
+    '''
+    shifted = xy + TREE_SPACING / 2.0
+    cells = np.floor(shifted / TREE_SPACING).astype(np.int64)
+    local = shifted - (cells + 0.5) * TREE_SPACING
+    inside = (np.hypot(local[:, 0], local[:, 1]) < TREE_RADIUS) & (_cell_random(cells, seed, 4) < TREE_FILL)
+    return np.where(inside, 6.0 + 10.0 * _cell_random(cells, seed, 5), np.nan)
+
+
+def generate_chunk(rng, count, side, seed, slopes):
+    ''' count points over a side x side square: (xyz, classification,
+    return_number, number_of_returns, truth).
+    '''
+    xy = rng.uniform(0.0, side, (count, 2))
+    ground = ground_z(xy)
+    z = ground + rng.normal(0.0, NOISE_SIGMA, count)
+    truth = np.full(count, TRUTH_PLANAR, dtype=np.uint8)
+    return_number = np.ones(count, dtype=np.uint8)
+    number_of_returns = np.ones(count, dtype=np.uint8)
+
+    roof = roof_z(xy, seed, slopes)
+    on_roof = ~np.isnan(roof)
+    z[on_roof] = roof[on_roof] + rng.normal(0.0, NOISE_SIGMA, on_roof.sum())
+
+    # Pulses through a crown give 2-4 returns; only a last return that
+    # reaches the ground lies on a planar surface.
+    crown = tree_height(xy, seed)
+    in_tree = ~np.isnan(crown) & ~on_roof
+    k = in_tree.sum()
+    returns = rng.integers(2, 5, k).astype(np.uint8)
+    which = (rng.random(k) * returns).astype(np.uint8) + 1
+    reaches_ground = (which == returns) & (rng.random(k) < 0.6)
+    canopy = ground[in_tree] + crown[in_tree] * rng.uniform(0.3, 1.0, k)
+    z[in_tree] = np.where(reaches_ground, z[in_tree], canopy)
+    truth[in_tree] = np.where(reaches_ground, TRUTH_PLANAR, 0)
+    return_number[in_tree] = which
+    number_of_returns[in_tree] = returns
+
+    classification = np.ones(count, dtype=np.uint8)
+    noise = rng.random(count)
+    low = noise < LOW_NOISE_FRACTION
+    high = (noise >= LOW_NOISE_FRACTION) & (noise < LOW_NOISE_FRACTION + HIGH_NOISE_FRACTION)
+    z[low] = ground[low] - rng.uniform(2.0, 5.0, low.sum())
+    z[high] = ground[high] + rng.uniform(20.0, 50.0, high.sum())
+    classification[low] = 7
+    classification[high] = 18
+    truth[low | high] = 0
+    return np.column_stack((xy, z)), classification, return_number, number_of_returns, truth
+
+
+def generate(file_name, points, density=10.0, seed=1, slopes=DEFAULT_ROOF_SLOPES, progress=None):
+    ''' Writes a synthetic tile of the given number of points at the given
+    density (points per square metre).
+    '''
+    points = int(points)
+    side = np.sqrt(points / float(density))
+    rng = np.random.default_rng(seed)
+    with las_io.LasWriter(file_name, 1) as writer:
+        for start in range(0, points, CHUNK):
+            count = min(CHUNK, points - start)
+            xyz, classification, return_number, number_of_returns, truth = generate_chunk(rng, count, side, seed, slopes)
+            records = writer.empty(count)
+            writer.set_xyz(records, xyz)
+            records["return_bits"] = return_number | (number_of_returns << 3)
+            records["classification_bits"] = classification
+            records["user_data"] = truth
+            records["gps_time"] = np.arange(start, start + count) * 1e-5
+            writer.write(records)
+            if progress is not None:
+                progress("Generating points", start + count, points)
+
+
+def truth(las):
+    ''' Ground-truth planar mask of a synthetic tile.
+    '''
+    return np.asarray(las.points["user_data"]) == TRUTH_PLANAR
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic LAS tile with ground truth in user data.")
+    parser.add_argument("output", help="Output .las file.")
+    parser.add_argument("--points", type=float, default=1e5, help="Number of points (e.g. 1e6).")
+    parser.add_argument("--density", type=float, default=10.0, help="Points per square metre.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--slopes", default=",".join(str(s) for s in DEFAULT_ROOF_SLOPES),
+                        help="Comma separated roof slopes in degrees.")
+    args = parser.parse_args(argv)
+    slopes = [float(s) for s in args.slopes.split(",")]
+    generate(args.output, args.points, args.density, args.seed, slopes)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
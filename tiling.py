@@ -0,0 +1,116 @@
+'''
+Out-of-core segmentation for LAS files larger than memory.
+
+The file is split into square XY tiles. Each tile is segmented on its own
+together with a halo of surrounding points, and writes the labels of its
+core points straight into the output file. Only one tile is in memory at a
+time, so peak memory depends on the tile size rather than the file size.
+
+The halo is two search distances wide: points up to one search distance
+outside the core are also used as neighbourhood centers, because their
+planes can label core points, and their own neighbourhoods reach one search
+distance further. Together with the per-point seeded hypothesis draws this
+makes the tiled result identical to an untiled run.
+'''
+import os, shutil, tempfile
+
+import numpy as np
+
+import las_io
+import progress
+import ransac_engine
+
+
+def tile_bounds(tile, tile_size, origin):
+    lo = origin + np.asarray(tile) * tile_size
+    return lo, lo + tile_size
+
+
+def bucket_points(las, tile_size, halo, directory, chunk=las_io.WRITE_CHUNK):
+    ''' Streams through the file once and writes, for every tile, the sorted
+    numbers of the points in its core or halo to <directory>/<tx>_<ty>.idx.
+    Returns the list of (tx, ty) tiles that contain points.
+    '''
+    origin = las.header.mins[:2]
+    tiles = set()
+    for start in range(0, len(las), chunk):
+        xy = las.xyz(slice(start, start + chunk))[:, :2] - origin
+        ids = np.arange(start, start + len(xy))
+        home = np.floor(xy / tile_size).astype(np.int64)
+        keys = []
+        members = []
+        # With halo <= tile_size a point can only lie in the 3x3 block of
+        # tiles around its own.
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                tile = home + (dx, dy)
+                lo = tile * tile_size - halo
+                hi = (tile + 1) * tile_size + halo
+                inside = np.all((xy >= lo) & (xy < hi), axis=1)
+                keys.append(tile[inside])
+                members.append(ids[inside])
+        keys = np.concatenate(keys)
+        members = np.concatenate(members)
+        order = np.lexsort((members, keys[:, 1], keys[:, 0]))
+        keys, members = keys[order], members[order]
+        starts = np.flatnonzero(np.r_[True, np.any(keys[1:] != keys[:-1], axis=1)])
+        for first, last in zip(starts, np.r_[starts[1:], len(keys)]):
+            tile = (int(keys[first, 0]), int(keys[first, 1]))
+            tiles.add(tile)
+            with open(os.path.join(directory, "{}_{}.idx".format(*tile)), "ab") as f:
+                members[first:last].tofile(f)
+    return sorted(tiles)
+
+
+def segment_tiled(las, output_file, tile_size, seed=0, reporter=None, temp_dir=None, iteration_log=None, workers=1,
+                  **params):
+    ''' Segments an open LasFile tile by tile, writing the result to
+    output_file. tile_size must be at least twice the search distance.
+
+    reporter (a progress.ProgressReporter) times the bucketing pass as the
+    "read" stage and the tile loop, which reads, segments and writes each
+    tile in turn, as the "ransac" stage. iteration_log (see
+    ransac_engine.IterationLog) is given the neighbourhoods of core points only,
+    so each is recorded once. workers > 1 runs the RANSAC of each tile on
+    that many processes.
+    '''
+    reporter = reporter or progress.ProgressReporter(text=False)
+    params = ransac_engine.resolve_params(params)
+    search_dist = params["searchDist"]
+    halo = 2.0 * search_dist
+    if tile_size < halo:
+        raise ValueError("Tile size {} must be at least twice the search distance ({}).".format(tile_size, halo))
+
+    origin = las.header.mins[:2]
+    directory = tempfile.mkdtemp(prefix="ransac_tiles_", dir=temp_dir or os.path.dirname(os.path.abspath(output_file)))
+    try:
+        with reporter.stage("read"):
+            tiles = bucket_points(las, tile_size, halo, directory)
+            las_io.replace_file(las.file_name, output_file)
+        reporter.points = len(las)
+        with reporter.stage("ransac"), las_io.ClassificationWriter(output_file) as writer:
+            for done, tile in enumerate(tiles, 1):
+                ids = np.fromfile(os.path.join(directory, "{}_{}.idx".format(*tile)), dtype=np.int64)
+                xyz, classification, return_number, number_of_returns = las.read_quantized(ids)
+                lo, hi = tile_bounds(tile, tile_size, origin)
+                xy = xyz[:][:, :2]
+                core = np.all(np.floor((xy - origin) / tile_size).astype(np.int64) == tile, axis=1)
+                near = np.all((xy >= lo - search_dist) & (xy < hi + search_dist), axis=1)
+                del xy
+                tile_log = None
+                if iteration_log is not None:
+                    core_ids = ids[core]
+                    def _core_log(point_ids, sizes, iterations, **details):
+                        keep = np.isin(point_ids, core_ids, assume_unique=True)
+                        details = dict((name, value if np.ndim(value) == 0 else value[keep])
+                                       for name, value in details.items())
+                        iteration_log(point_ids[keep], sizes[keep], iterations[keep], **details)
+                    _core_log.profile_interval = getattr(iteration_log, "profile_interval", 0.0)
+                    tile_log = _core_log
+                classes = ransac_engine.segment(xyz, classification, return_number, number_of_returns, seed=seed,
+                                                point_ids=ids, query_mask=near, iteration_log=tile_log,
+                                                workers=workers, **params)
+                writer.set(ids[core], classes[core])
+                reporter("Processing tiles", done, len(tiles))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,387 @@
+'''
+Watch-folder service: segments tiles as they are dropped into a directory.
+
+    python Ransac_runner.py --backend python serve incoming -o segmented --failedDir failed --port 8765
+
+New .las and .zip files in the watch directory are queued once their size
+and modification time have stopped changing for a settle period, so files
+still being copied in are left alone. Queued tiles run on a bounded pool of
+segmenter processes with the configured parameters (see
+Ransac_runner.run_job). Outputs, with their logs and metrics, go to the
+output directory; the input and log of a failed tile are moved to the failed
+directory. The python backend reads .zip archives of LAS files directly;
+for the compiled tool their .las members are extracted one at a time.
+
+The queue is kept in a JSON state file (by default .ransac_queue.json in the
+watch directory), rewritten after every change. A tile is identified by its
+name, size and modification time, so it is processed only once however
+often the service restarts; tiles that were running when it stopped are run
+again.
+
+GET /status on the localhost HTTP port returns the queue depth, the running
+jobs with their progress and the throughput since the service started;
+GET /jobs returns every job in the state file.
+'''
+import json, os, shutil, signal, tempfile, threading, time, zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import Ransac_runner
+
+INPUT_EXTENSIONS = (".las", ".zip")
+STATE_FILE = ".ransac_queue.json"
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def job_key(name, size, mtime):
+    return "{}|{}|{}".format(name, size, mtime)
+
+
+class JobQueue(object):
+    ''' The persistent job list: one record per tile, by job_key, written to
+    state_file (atomically) after every change.
+    '''
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.jobs = {}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                self.jobs = json.load(f)["jobs"]
+        for record in self.jobs.values():
+            if record["state"] == RUNNING:
+                # The service stopped while the tile was running.
+                record["state"] = QUEUED
+        self.save()
+
+    def save(self):
+        temp = self.state_file + ".tmp"
+        with open(temp, "w") as f:
+            json.dump({"jobs": self.jobs}, f, indent=1, sort_keys=True)
+        os.replace(temp, self.state_file)
+
+    def add(self, key, record):
+        ''' Queues a new tile. Returns False if it is already known.
+        '''
+        with self.lock:
+            if key in self.jobs:
+                return False
+            self.jobs[key] = dict(record, state=QUEUED, queued=time.time())
+            self.save()
+            return True
+
+    def update(self, key, **fields):
+        with self.lock:
+            self.jobs[key].update(fields)
+            self.save()
+
+    def take(self):
+        ''' Marks the oldest queued job running and returns its key, or None.
+        '''
+        with self.lock:
+            queued = [(record["queued"], key) for key, record in self.jobs.items() if record["state"] == QUEUED]
+            if not queued:
+                return None
+            key = min(queued)[1]
+            self.jobs[key].update(state=RUNNING, started=time.time())
+            self.save()
+            return key
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.jobs))
+
+    def count(self, state):
+        with self.lock:
+            return sum(1 for record in self.jobs.values() if record["state"] == state)
+
+
+class FolderWatcher(object):
+    ''' Finds the input files of a directory that are fully written: their
+    size and modification time have not changed for settle seconds.
+    '''
+    def __init__(self, directory, settle=5.0):
+        self.directory = directory
+        self.settle = settle
+        self.seen = {}
+
+    def scan(self):
+        ''' Returns (path, size, mtime in ns) of every settled input file.
+        '''
+        now = time.time()
+        current = {}
+        ready = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith(".") or not name.lower().endswith(INPUT_EXTENSIONS):
+                continue
+            file_name = os.path.join(self.directory, name)
+            try:
+                info = os.stat(file_name)
+            except OSError:
+                continue
+            signature = (info.st_size, info.st_mtime_ns)
+            previous = self.seen.get(file_name)
+            since = previous[1] if previous is not None and previous[0] == signature else now
+            current[file_name] = (signature, since)
+            if now - since >= self.settle:
+                ready.append((file_name,) + signature)
+        self.seen = current
+        return ready
+
+
+class WatchService(object):
+    ''' Queues the tiles dropped into watch_dir and segments them on a pool
+    of workers, like Ransac_runner.run_batch. params are the segmenter
+    parameters of a batch run and results an optional
+    Ransac_runner.JobResults.
+    '''
+    def __init__(self, watch_dir, output_dir, failed_dir, params, workers=1, backend="binary", exe=None,
+                 state_file=None, settle=5.0, poll=1.0, suffix="_ransac", results=None, echo=print):
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.failed_dir = os.path.abspath(failed_dir)
+        for directory in (self.output_dir, self.failed_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.params = params
+        self.workers = max(1, workers)
+        self.backend = backend
+        self.command = Ransac_runner.segmenter_command(backend, exe)
+        self.queue = JobQueue(state_file or os.path.join(self.watch_dir, STATE_FILE))
+        self.watcher = FolderWatcher(self.watch_dir, settle)
+        self.poll = poll
+        self.suffix = suffix
+        self.results = results
+        self.echo = echo
+        self.started = time.time()
+        self.progress = {}
+        self.finished = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def scan(self):
+        ''' Queues the settled input files not seen before. Returns how many.
+        '''
+        added = 0
+        for file_name, size, mtime in self.watcher.scan():
+            record = {"input": file_name, "name": os.path.basename(file_name), "size": size, "mtime": mtime}
+            if self.queue.add(job_key(record["name"], size, mtime), record):
+                self.echo("Queued {}".format(record["name"]))
+                added += 1
+        return added
+
+    def serve(self, port=8765, once=False):
+        ''' Runs until stop() is called (or SIGTERM/Ctrl+C), or with once
+        until the tiles present at start have been processed. Running jobs
+        are finished before it returns.
+        '''
+        server = None
+        if port:
+            server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(self))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.echo("Status on http://127.0.0.1:{}/status".format(server.server_address[1]))
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            # Ctrl+C and SIGTERM only set stopping, before the pool waits for
+            # the running jobs, so jobs whose segmenter died with the signal
+            # are requeued rather than filed as failures.
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                handlers[signum] = signal.signal(signum, lambda *_: self.stop())
+        self.echo("Watching {} with {} worker(s)...".format(self.watch_dir, self.workers))
+        running = set()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while not self.stopping.is_set():
+                    self.scan()
+                    running = set(f for f in running if not f.done())
+                    while len(running) < self.workers:
+                        key = self.queue.take()
+                        if key is None:
+                            break
+                        running.add(pool.submit(self.process, key))
+                    if once and not running and not self.queue.count(QUEUED) and not self.unsettled():
+                        break
+                    self.stopping.wait(self.poll)
+                if running:
+                    self.echo("Waiting for {} running job(s)...".format(len(running)))
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+
+    def unsettled(self):
+        ''' Whether input files are still waiting to settle.
+        '''
+        return any(job_key(os.path.basename(file_name), size, mtime) not in self.queue.jobs
+                   for file_name, ((size, mtime), _) in list(self.watcher.seen.items()))
+
+    def stop(self):
+        self.stopping.set()
+
+    def process(self, key):
+        ''' Segments one queued tile and files its result.
+        '''
+        record = self.queue.jobs[key]
+        state = self.progress[key] = {"stage": None, "percent": 0.0}
+        started = time.time()
+
+        def on_event(event):
+            state["stage"] = event["stage"]
+            state["percent"] = 100.0 * event["done"] / event["total"] if event["total"] else 100.0
+
+        try:
+            if not os.path.isfile(record["input"]):
+                jobs, error = [], "input file disappeared"
+            elif record["input"].lower().endswith(".zip") and self.backend != "python":
+                jobs, error = self.run_archive(record["input"], on_event)
+            else:
+                stem = os.path.splitext(record["name"])[0]
+                jobs, error = [self.run_tile(record["input"], stem + self.suffix, on_event)], None
+            failed = [job for job in jobs if job.returncode != 0]
+            if failed:
+                error = failed[0].error or "exit code {}".format(failed[0].returncode)
+        except (OSError, ValueError, zipfile.BadZipFile) as err:
+            jobs, error = [], str(err)
+        finally:
+            del self.progress[key]
+        elapsed = time.time() - started
+        points = sum((job.metrics or {}).get("total_points") or 0 for job in jobs)
+        if error is not None and self.stopping.is_set():
+            # Stopping the service may have stopped the segmenter too; run
+            # the tile again after the restart.
+            self.remove_outputs(jobs)
+            self.queue.update(key, state=QUEUED)
+            self.echo("Interrupted {}, left in the queue".format(record["name"]))
+            return
+        if error is None:
+            outputs = []
+            for job in jobs:
+                # The python backend writes one output per member of an archive.
+                output = (job.metrics or {}).get("output", job.output_file)
+                outputs.extend(output if isinstance(output, list) else [output])
+            self.queue.update(key, state=DONE, finished=time.time(), elapsed=elapsed, points=points,
+                              outputs=outputs, cached=all(job.cached for job in jobs))
+            self.echo("Done {} ({:.1f} s)".format(record["name"], elapsed))
+        else:
+            self.file_failure(record, jobs)
+            self.queue.update(key, state=FAILED, finished=time.time(), elapsed=elapsed, error=error)
+            self.echo("FAILED {}: {}".format(record["name"], error))
+        with self.lock:
+            self.finished.append((time.time(), points, error is None))
+
+    def run_tile(self, input_file, output_stem, on_event):
+        job = Ransac_runner.BatchJob(input_file, os.path.join(self.output_dir, output_stem + ".las"))
+        return Ransac_runner.run_job(self.command, job, self.params, self.output_dir, self.backend, self.results,
+                                     on_event)
+
+    def run_archive(self, archive, on_event):
+        ''' Segments the .las members of a zip archive one at a time for the
+        compiled tool, which cannot read archives, extracting each in turn.
+        Outputs are named like the python backend's (see
+        las_io.member_outputs). Returns (jobs, error).
+        '''
+        stem = os.path.splitext(os.path.basename(archive))[0]
+        temp = tempfile.mkdtemp(prefix=".ransac_zip_", dir=self.output_dir)
+        jobs = []
+        try:
+            with zipfile.ZipFile(archive) as zf:
+                members = [m for m in zf.infolist() if not m.is_dir() and m.filename.lower().endswith(".las")]
+                if not members:
+                    return [], "no .las files in the archive"
+                for member in members:
+                    member_stem = os.path.splitext(os.path.basename(member.filename))[0]
+                    extracted = os.path.join(temp, member_stem + ".las")
+                    with zf.open(member) as source, open(extracted, "wb") as target:
+                        shutil.copyfileobj(source, target)
+                    output_stem = stem + self.suffix + ("_" + member_stem if len(members) > 1 else "")
+                    jobs.append(self.run_tile(extracted, output_stem, on_event))
+                    os.remove(extracted)
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+        return jobs, None
+
+    def file_failure(self, record, jobs):
+        ''' Moves a failed tile with its logs and metrics to the failed
+        directory and removes partial outputs.
+        '''
+        self.remove_outputs(jobs)
+        if os.path.isfile(record["input"]):
+            shutil.move(record["input"], os.path.join(self.failed_dir, record["name"]))
+        for job in jobs:
+            for file_name in (job.log_file, job.metrics_file):
+                if os.path.isfile(file_name):
+                    shutil.move(file_name, os.path.join(self.failed_dir, os.path.basename(file_name)))
+
+    def remove_outputs(self, jobs):
+        ''' Removes every output the jobs of an unfinished tile may have
+        written, including those of archive members that succeeded, so a
+        retry does not find partial results.
+        '''
+        outputs = set()
+        for job in jobs:
+            outputs.add(job.output_file)
+            output = (job.metrics or {}).get("output")
+            if isinstance(output, list):
+                outputs.update(output)
+            if job.input_file.lower().endswith(".zip") and os.path.isfile(job.input_file):
+                # The python backend writes one output per member, named by
+                # las_io.member_outputs.
+                import las_io
+                try:
+                    outputs.update(las_io.member_outputs(job.output_file, las_io.zip_members(job.input_file)))
+                except (OSError, zipfile.BadZipFile):
+                    pass
+        for output in outputs:
+            if os.path.lexists(output):
+                os.remove(output)
+
+    def status(self):
+        uptime = time.time() - self.started
+        with self.lock:
+            finished = list(self.finished)
+        succeeded = [points for _, points, ok in finished if ok]
+        jobs = self.queue.snapshot()
+        running = []
+        for key, state in list(self.progress.items()):
+            record = jobs.get(key, {})
+            running.append({"name": record.get("name"), "stage": state["stage"], "percent": state["percent"],
+                            "elapsed": time.time() - record.get("started", time.time())})
+        return {
+            "watch_dir": self.watch_dir,
+            "uptime": uptime,
+            "queue_depth": sum(1 for record in jobs.values() if record["state"] == QUEUED),
+            "running": running,
+            "done": sum(1 for record in jobs.values() if record["state"] == DONE),
+            "failed": sum(1 for record in jobs.values() if record["state"] == FAILED),
+            "throughput": {
+                "tiles": len(succeeded),
+                "tiles_per_hour": 3600.0 * len(succeeded) / uptime if uptime > 0 else 0.0,
+                "points_per_second": sum(succeeded) / uptime if uptime > 0 else 0.0,
+            },
+        }
+
+
+def make_handler(service):
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path in ("/", "/status"):
+                body = service.status()
+            elif self.path == "/jobs":
+                body = service.queue.snapshot()
+            else:
+                self.send_error(404)
+                return
+            data = json.dumps(body, indent=2, sort_keys=True).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # Requests are not worth a line in the service log.
+            pass
+
+    return StatusHandler